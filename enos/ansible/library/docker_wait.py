@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+---
+module: docker_wait
+short_description: Block until a docker container exits
+description:
+  - Calls C(docker wait) on a container and returns its exit code along
+    with the time spent waiting. Fails as soon as the container exits
+    with a non zero code.
+options:
+  container:
+    description:
+      - Id or name of the container to wait for.
+    required: true
+  timeout:
+    description:
+      - Maximum number of seconds to wait for, 0 means no limit.
+    default: 0
+  logs_lines:
+    description:
+      - Number of lines of the container logs to return when it fails.
+    default: 50
+'''
+
+EXAMPLES = '''
+- docker_wait:
+    container: "{{ docker_output.ansible_facts.docker_container.Id }}"
+  register: container_exit
+'''
+
+from datetime import datetime
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            container=dict(required=True, type='str'),
+            timeout=dict(default=0, type='int'),
+            logs_lines=dict(default=50, type='int'),
+        ),
+        supports_check_mode=False
+    )
+    container = module.params['container']
+    timeout = module.params['timeout']
+
+    cmd = ['docker', 'wait', container]
+    if timeout > 0:
+        cmd = ['timeout', str(timeout)] + cmd
+
+    start = time.time()
+    rc, out, err = module.run_command(cmd)
+    end = time.time()
+
+    result = dict(
+        changed=False,
+        container=container,
+        start=datetime.utcfromtimestamp(start).isoformat(),
+        end=datetime.utcfromtimestamp(end).isoformat(),
+        duration=end - start
+    )
+
+    if rc != 0:
+        msg = "Waiting for container %s failed" % container
+        if timeout > 0 and rc == 124:
+            msg = "Container %s still running after %ss" % (container,
+                                                             timeout)
+        module.fail_json(msg=msg, stderr=err, **result)
+
+    status_code = int(out.strip())
+    result.update(status_code=status_code)
+    if status_code != 0:
+        _, logs, _ = module.run_command(
+            ['docker', 'logs', '--tail', str(module.params['logs_lines']),
+             container])
+        module.fail_json(msg="Container %s exited with code %s" %
+                         (container, status_code),
+                         logs=logs.splitlines(), **result)
+
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,21 +4,209 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 from datetime import datetime
+import atexit
+import json
 import os
 import pwd
+import tempfile
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 from influxdb import InfluxDBClient
 
+from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.plugins.callback import CallbackBase
 
 
+# Max number of events waiting to be written, further events are spooled
+QUEUE_SIZE = 1000
+
+# Max number of events per write
+BATCH_SIZE = 100
+
+# Max delay (in seconds) before an event is written
+FLUSH_INTERVAL = 2
+
+# Delay (in seconds) before writing again after a failed write
+RETRY_INTERVAL = 30
+
+# Timeout (in seconds) of the requests to InfluxDB
+TIMEOUT = 5
+
+# Directory of the events that could not be written, one spool file (one
+# JSON event per line) per user and InfluxDB database, so that they are
+# only written again to the database of their deployment
+SPOOL_DIR = os.getenv('ENOS_EVENTS_SPOOL_DIR') or tempfile.gettempdir()
+SPOOL_FILE = 'enos-events-%(user)s-%(host)s-%(port)s-%(dbname)s.spool'
+
+# Marks the end of the events in the queue
+_STOP = object()
+
+# Enos phase of the playbooks run by enos. `ENOS_PHASE` overrides it, enos
+# sets it to `os` for the playbooks of kolla-ansible (see
+# `enos.utils.extra.in_kolla`)
+PHASES = {
+    'up.yml': 'up',
+    'bootstrap_kolla.yml': 'os',
+    'init_os.yml': 'init',
+    'run-bench.yml': 'bench',
+    'backup.yml': 'backup',
+    'utils.yml': 'utils'
+}
+
+# Phase of the other playbooks
+DEFAULT_PHASE = 'other'
+
+STATUS_OK = 'ok'
+STATUS_CHANGED = 'changed'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+STATUS_UNREACHABLE = 'unreachable'
+
+# Started writers, stopped at exit if a run is interrupted before the end of
+# its playbook
+_WRITERS = set()
+
+
+def _stop_writers():
+    for writer in list(_WRITERS):
+        writer.stop()
+
+
+# Do not lose the queued events if the run is interrupted
+atexit.register(_stop_writers)
+
+
+class EventWriter(threading.Thread):
+    """
+    Writes the events to InfluxDB from a background thread:
+    1. Events are put in a bounded queue, or spooled on disk if it is full;
+    2. They are written by batches of at most BATCH_SIZE events, at most
+    FLUSH_INTERVAL seconds after they have been reported;
+    3. Batches that cannot be written are appended to the spool file, the
+    spooled events are written again with the next batch once InfluxDB is
+    back (possibly by another run).
+    """
+
+    def __init__(self, spool_path=None):
+        super(EventWriter, self).__init__()
+        self.daemon = True
+        self.client = None
+        self.spool_path = spool_path
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.retry_at = 0
+        self.spooled = 0
+        self.error = None
+
+
+    def start(self):
+        _WRITERS.add(self)
+        super(EventWriter, self).start()
+
+
+    def put(self, event):
+        """Queue an event, spool it if the queue is full"""
+
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.spool([event])
+
+
+    def stop(self):
+        """Write the remaining events and wait for the thread"""
+
+        if self.ident is None:
+            return
+        if self.is_alive():
+            self.queue.put(_STOP)
+            self.join()
+        _WRITERS.discard(self)
+
+
+    def run(self):
+        done = False
+        while not done:
+            batch = []
+            deadline = time.time() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                try:
+                    event = self.queue.get(
+                        timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if event is _STOP:
+                    done = True
+                    break
+                batch.append(event)
+            self.write(batch)
+
+
+    def write(self, batch):
+        """Write a batch along with the spooled events"""
+
+        if time.time() < self.retry_at:
+            self.spool(batch)
+            return
+        events = self.unspool() + batch
+        if not events:
+            return
+        try:
+            self.client.write_points(events, time_precision='u',
+                                     batch_size=BATCH_SIZE)
+            self.error = None
+        except Exception as e:
+            self.error = e
+            self.retry_at = time.time() + RETRY_INTERVAL
+            self.spool(events)
+
+
+    def spool(self, events):
+        """Append events to the spool file"""
+
+        if not events or self.spool_path is None:
+            # No InfluxDB known yet
+            return
+        lines = ''.join(json.dumps(e) + '\n' for e in events)
+        # A single write in append mode, several runs may share the spool
+        with open(self.spool_path, 'a') as f:
+            f.write(lines)
+        self.spooled = self.spooled + len(events)
+
+
+    def unspool(self):
+        """Take the events out of the spool file"""
+
+        # Claim the spool first so that concurrent runs do not write the
+        # same events twice
+        claimed = '%s.%s' % (self.spool_path, os.getpid())
+        try:
+            os.rename(self.spool_path, claimed)
+        except OSError:
+            return []
+        with open(claimed) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        os.remove(claimed)
+        self.spooled = max(self.spooled - len(events), 0)
+        return events
+
+
 class CallbackModule(CallbackBase):
     """
     This callback module fills an InfluxDB with Ansible events:
-    1. Create an empty list at the beginning of playbooks;
-    2. Add an event to the list for each playbook/play/task;
-    3. Connect to InfluxDB at the end of playbooks if succeeded and commit
-    events.
+    1. Add an event to the queue of the writer for each playbook/play/task;
+    2. Start the writer once InfluxDB is known (first play), events are then
+    written while the playbook runs (see `EventWriter`);
+    3. Write the remaining events at the end of playbooks.
+
+    Unless `enable_task_metrics` is false, a point of the `tasks` measurement
+    is also added for each task and host with its duration in microseconds
+    and the status, phase, role and kolla information as tags.
     """
 
     CALLBACK_VERSION = 2.0
@@ -30,15 +218,20 @@ class CallbackModule(CallbackBase):
     def __init__(self):
         super(CallbackModule, self).__init__()
 
-        self.timer = None
-        self.events = []
+        # Start time of the running tasks (by uuid), several tasks may run
+        # at the same time (e.g. free strategy)
+        self.timers = {}
+        self.writer = EventWriter()
         self.host_vars = None
-        self.timer = None
+        # Kolla-related tags of the running play (see `kolla_tags`)
+        self.extra_tags = {}
+        self.phase = None
+        self.metrics = False
         self.username = pwd.getpwuid(os.getuid()).pw_name
 
 
     def report_event(self, fields):
-        """Add a new event in the list"""
+        """Add a new event in the queue of the writer"""
 
         current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
 
@@ -48,35 +241,102 @@ class CallbackModule(CallbackBase):
             'fields': fields
         }
 
-        self.events.append(event)
+        self.writer.put(event)
 
 
-    def add_extra_tags(self, fields):
-        """Add extra tags to the event"""
+    def start_writer(self):
+        """Connect to InfluxDB and start writing events"""
 
-        # Add Kolla-related information in tags
-        fields['tags'] = '%s %s %s %s' % (fields['tags'],
-                self.host_vars.get('kolla_ref'),
-                self.host_vars.get('kolla_base_distro') or \
-                        self.host_vars['kolla']['kolla_base_distro'],
-                self.host_vars.get('kolla_install_type') or \
-                        self.host_vars['kolla']['kolla_install_type']
-        )
+        if self.writer.ident is not None:
+            return
+
+        # Set InfluxDB host from an environment variable if provided
+        _host = os.getenv('influx_vip') or self.host_vars['influx_vip']
+        _port = "8086"
+        _user = "None"
+        _pass = "None"
+        _dbname = "events"
+        self.writer.client = InfluxDBClient(_host, _port, _user, _pass,
+                                            _dbname, timeout=TIMEOUT)
+        self.writer.spool_path = os.path.join(SPOOL_DIR, SPOOL_FILE % {
+            'user': self.username,
+            'host': _host,
+            'port': _port,
+            'dbname': _dbname
+        })
+        self.writer.start()
+
+
+    def report_metric(self, result, status):
+        """Add a task duration point in the queue of the writer"""
+
+        task = result._task
+        start = self.timers.get(task._uuid)
+        if not self.metrics or start is None:
+            return
+
+        tags = {
+            'host': result._host.get_name(),
+            'task': task.get_name(),
+            'role': task._role.get_name() if task._role else None,
+            'tag': task.tags[0] if task.tags else None,
+            'status': status,
+            'phase': self.phase,
+            'user': self.username
+        }
+        tags.update(self.extra_tags)
+
+        metric = {
+            'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            'measurement': 'tasks',
+            'tags': tags,
+            'fields': {'duration': int((time.time() - start) * 1000000)}
+        }
+
+        self.writer.put(metric)
+
+
+    def kolla_tags(self):
+        """Kolla-related information of the run"""
+
+        tags = {
+            'kolla_ref': self.host_vars.get('kolla_ref'),
+            'kolla_base_distro': self.host_vars.get('kolla_base_distro') or
+                    self.host_vars['kolla']['kolla_base_distro'],
+            'kolla_install_type': self.host_vars.get('kolla_install_type') or
+                    self.host_vars['kolla']['kolla_install_type']
+        }
 
         # Set the variables only available during the `os_install` phase
         if self.host_vars.get('openstack_release', 'auto') != 'auto':
-            fields['tags'] = '%s %s' % (fields['tags'],
-                    self.host_vars.get('openstack_release'))
+            tags['openstack_release'] = self.host_vars.get('openstack_release')
 
         if 'openstack_region_name' in self.host_vars:
-            fields['tags'] = '%s %s' % (fields['tags'],
-                    self.host_vars.get('openstack_region_name'))
+            tags['openstack_region_name'] = \
+                    self.host_vars.get('openstack_region_name')
+
+        return tags
+
+
+    def add_extra_tags(self, fields):
+        """Add extra tags to the event"""
+
+        # Add Kolla-related information in tags
+        tags = self.extra_tags
+        fields['tags'] = ' '.join(['%s' % fields['tags']] + [
+            '%s' % tags[k] for k in ['kolla_ref', 'kolla_base_distro',
+                                     'kolla_install_type',
+                                     'openstack_release',
+                                     'openstack_region_name']
+            if k in tags])
 
 
     def v2_playbook_on_start(self, playbook):
         """Log each starting playbook"""
 
         playbook_name = os.path.basename(playbook._file_name)
+        self.phase = os.getenv('ENOS_PHASE') or \
+            PHASES.get(playbook_name, DEFAULT_PHASE)
 
         fields = {
             'tags': 'playbook %s' % self.username,
@@ -91,7 +351,7 @@ class CallbackModule(CallbackBase):
     def v2_playbook_on_play_start(self, play):
         """Log each starting play"""
 
-        host = play._variable_manager._hostvars.keys()[0]
+        host = list(play._variable_manager._hostvars.keys())[0]
         self.host_vars = play._variable_manager._hostvars[str(host)]
 
         if not self.host_vars.get('enable_monitoring', True):
@@ -100,6 +360,12 @@ class CallbackModule(CallbackBase):
             self._display.warning("The plugin %s is disabled since "
                 "monitoring is disabled in the config file." %
                 self._original_path)
+            return
+
+        self.metrics = boolean(self.host_vars.get('enable_task_metrics', True),
+                               strict=False)
+        self.extra_tags = self.kolla_tags()
+        self.start_writer()
 
         fields = {
             'tags': 'play %s' % self.username,
@@ -113,21 +379,42 @@ class CallbackModule(CallbackBase):
 
 
     def v2_playbook_on_task_start(self, task, is_conditional):
-        """Restart the timer when a task starts"""
+        """Start the timer of the task"""
+
+        self.timers[task._uuid] = time.time()
+
+
+    def v2_playbook_on_handler_task_start(self, task):
+        """Start the timer of the handler"""
+
+        self.timers[task._uuid] = time.time()
+
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.report_metric(result, STATUS_FAILED)
+
+
+    def v2_runner_on_skipped(self, result):
+        self.report_metric(result, STATUS_SKIPPED)
+
 
-        self.timer = datetime.now()
+    def v2_runner_on_unreachable(self, result):
+        self.report_metric(result, STATUS_UNREACHABLE)
 
 
     def v2_runner_on_ok(self, result):
         """Log each finished task marked as 'changed'"""
 
-        # Log only "changed" tasks
         if not result.is_changed():
+            self.report_metric(result, STATUS_OK)
+            # Log only "changed" tasks
             return
+        self.report_metric(result, STATUS_CHANGED)
 
         # Record the time at the end of a task
-        end_timer = datetime.now()
-        m, s = divmod((end_timer - self.timer).seconds, 60)
+        elapsed = time.time() - self.timers.get(result._task._uuid,
+                                                time.time())
+        m, s = divmod(int(elapsed), 60)
         h, m = divmod(m, 60)
 
         taskname = result._task.get_name()
@@ -144,32 +431,22 @@ class CallbackModule(CallbackBase):
         }
 
         # Add the event tag if it is not the default value
-        event_tag = result._task.tags[0]
-        if event_tag != 'always':
-            fields['tags'] = '%s %s' % (fields['tags'], event_tag)
+        event_tags = result._task.tags
+        if event_tags and event_tags[0] != 'always':
+            fields['tags'] = '%s %s' % (fields['tags'], event_tags[0])
 
         self.add_extra_tags(fields)
         self.report_event(fields)
 
 
     def v2_playbook_on_stats(self, stats):
-        """Connect to InfluxDB and commit events"""
+        """Write the remaining events"""
 
-        # Set InfluxDB host from an environment variable if provided
-        _host = os.getenv('influx_vip') or self.host_vars['influx_vip']
-        _port = "8086"
-        _user = "None"
-        _pass = "None"
-        _dbname = "events"
-        influxdb = InfluxDBClient(_host, _port, _user, _pass, _dbname)
-
-        try:
-            influxdb.write_points(self.events, time_precision='u')
-        except Exception:
-            # Disable the plugin if writes fail
-            self.disabled = True
+        self.writer.stop()
+        if self.writer.error is not None:
             self._display.warning(
                 "Cannot write to InfluxDB, check the service state "
-                "on %s." % _host)
-            return
-
+                "on %s (%s). %s event(s) spooled in %s will be written "
+                "by the next run." % (
+                    self.writer.client._host, self.writer.error,
+                    self.writer.spooled, self.writer.spool_path))
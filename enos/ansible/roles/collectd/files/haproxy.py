@@ -8,15 +8,16 @@
 #
 # Modified by "Warren Turkal" <wt@signalfuse.com>, "Volodymyr Zhabiuk" <vzhabiuk@signalfx.com>
 
-import cStringIO as StringIO
+import array
 import socket
 import csv
-import pprint
+import time
 
 import collectd
 
 PLUGIN_NAME = 'haproxy'
-RECV_SIZE = 1024
+RECV_SIZE = 65536
+SOCKET_TIMEOUT = 5
 
 METRIC_TYPES = {
     #Metrics that are collected for the whole haproxy instance.
@@ -96,96 +97,301 @@ METRIC_DELIM = '.'  # for the frontend/backend stats
 DEFAULT_SOCKET = '/var/lib/haproxy/stats'
 DEFAULT_PROXY_MONITORS = [ 'server', 'frontend', 'backend' ]
 HAPROXY_SOCKET = None
+VERBOSE = False
+RATES = False
+ONLY_CHANGED = False
+DEFAULT_HEARTBEAT = 12
+HEARTBEAT = DEFAULT_HEARTBEAT
+MAX_SERVERS = 0
+
+NAN = float('nan')
+
+# Every response of HAProxy in interactive mode is followed by this prompt
+PROMPT = b'\n> '
 
 
 class HAProxySocket(object):
     """
             Encapsulates communication with HAProxy via the socket interface
+
+    The socket is kept open between two reads: HAProxy is switched to the
+    interactive mode (`prompt` command) so that it does not close the
+    connection after each command. The connection is opened again if HAProxy
+    closed it in the meantime (e.g. `stats timeout`, reload).
      """
 
     def __init__(self, socket_file=DEFAULT_SOCKET):
         self.socket_file = socket_file
+        self.stat_sock = None
 
     def connect(self):
         stat_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stat_sock.settimeout(SOCKET_TIMEOUT)
         stat_sock.connect(self.socket_file)
-        return stat_sock
-
-    def communicate(self, command):
-        '''Get response from single command.
+        self.stat_sock = stat_sock
+        self._send_recv(['prompt'])
+
+    def close(self):
+        if self.stat_sock is not None:
+            self.stat_sock.close()
+            self.stat_sock = None
+
+    def _send_recv(self, commands):
+        self.stat_sock.sendall(('\n'.join(commands) + '\n').encode('ascii'))
+        chunks = []
+        # End of the data received, the prompt may be split over two reads
+        tail = b''
+        while True:
+            buf = self.stat_sock.recv(RECV_SIZE)
+            if not buf:
+                raise socket.error('connection closed by HAProxy')
+            chunks.append(buf)
+            tail = (tail + buf)[-len(PROMPT):]
+            # HAProxy waits for the next command after the last prompt
+            if tail == PROMPT:
+                data = b''.join(chunks)
+                if data.count(PROMPT) >= len(commands):
+                    break
+        if not isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        return data.split(PROMPT.decode('ascii'))[:len(commands)]
+
+    def communicate(self, *commands):
+        '''Get the responses of pipelined commands.
 
         Args:
-            command: string command to send to haproxy stat socket
+            commands: string commands to send to haproxy stat socket
 
         Returns:
-            a string of the response data
+            a list of the response data (one string per command)
         '''
-        if not command.endswith('\n'):
-            command += '\n'
-        stat_sock = self.connect()
-        stat_sock.sendall(command)
-        result_buf = StringIO.StringIO()
-        buf = stat_sock.recv(RECV_SIZE)
-        while buf:
-            result_buf.write(buf)
-            buf = stat_sock.recv(RECV_SIZE)
-        stat_sock.close()
-        return result_buf.getvalue()
-
-    def get_server_info(self):
-        result = {}
-        output = self.communicate('show info')
-        for line in output.splitlines():
+        try:
+            if self.stat_sock is None:
+                self.connect()
+            return self._send_recv(commands)
+        except socket.error:
+            # The connection may have been closed by HAProxy, try again
+            self.close()
             try:
-                key, val = line.split(':', 1)
-            except ValueError:
+                self.connect()
+                return self._send_recv(commands)
+            except socket.error:
+                self.close()
+                raise
+
+
+def parse_info(output):
+    """
+        Returns the (metric name, value) of the metrics of `show info`
+    """
+    result = []
+    for line in output.splitlines():
+        key, sep, val = line.partition(':')
+        if not sep or key.strip().lower() not in METRIC_TYPES:
+            continue
+        try:
+            result.append((key.strip().lower(), int(val)))
+        except ValueError:
+            pass
+    return result
+
+
+class StatParser(object):
+    """
+        Parses the CSV of `show stat`
+
+    The indexes of the columns of METRIC_TYPES are computed once, when the
+    header changes (i.e. on HAProxy upgrades), other columns are never read.
+    """
+
+    def __init__(self):
+        self.header = None
+        self.columns = []
+        self.pxname = 0
+        self.svname = 1
+
+    def _parse_header(self, header):
+        names = [n.strip().lower() for n in header.lstrip('# ').split(',')]
+        self.header = header
+        self.pxname = names.index('pxname')
+        self.svname = names.index('svname')
+        self.columns = [(i, n) for i, n in enumerate(names)
+                        if n in METRIC_TYPES]
+
+    def parse(self, output):
+        """
+            Yields (pxname, svname, [(metric name, value), ...]) for the
+            proxies and servers matching PROXY_MONITORS
+        """
+        lines = output.strip().splitlines()
+        if not lines:
+            return
+        if lines[0] != self.header:
+            self._parse_header(lines[0])
+        pxname, svname, columns = self.pxname, self.svname, self.columns
+        for row in csv.reader(lines[1:]):
+            if len(row) <= svname:
+                continue
+            if not (row[svname].lower() in PROXY_MONITORS or
+                    row[pxname].lower() in PROXY_MONITORS):
                 continue
-            result[key.strip()] = val.strip()
-        return result
+            values = []
+            for i, name in columns:
+                try:
+                    values.append((name, int(row[i])))
+                except (IndexError, ValueError):
+                    pass
+            yield row[pxname], row[svname], values
+
+
+HAPROXY = None
+STAT_PARSER = StatParser()
 
-    def get_server_stats(self):
-        output = self.communicate('show stat')
-        #sanitize and make a list of lines
-        output = output.lstrip('# ').strip()
-        output = [l.strip(',') for l in output.splitlines()]
-        csvreader = csv.DictReader(output)
-        result = [d.copy() for d in csvreader]
-        return result
+# Service name of the metrics of the servers aggregated by proxy
+AGGREGATED_SERVICE_NAME = 'SERVERS'
+
+# Proxy level rows of `show stat`, other rows are servers
+PROXY_SVNAMES = frozenset(['FRONTEND', 'BACKEND'])
+
+
+class SeriesState(object):
+    """
+        State of the series dispatched by the plugin
+
+    Series are numbered on first use (by plugin instance and metric name), and
+    their state is kept in compact arrays indexed by these numbers: the last
+    value read (and when), the last value dispatched and the number of reads
+    since the last dispatch.
+
+    With RATES, `derive` metrics are dispatched as `gauge` rates per second
+    (type instance suffixed by `_rate`) computed from two consecutive reads.
+    With ONLY_CHANGED, a value equal to the last dispatched one is skipped,
+    unless it has been skipped HEARTBEAT times in a row.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.templates = []
+        self.rates = array.array('b')
+        self.last = array.array('d')
+        self.last_time = array.array('d')
+        self.sent = array.array('d')
+        self.skipped = array.array('l')
+
+    def _add(self, key):
+        metric_name, dimensions = key
+        translated_metric_name, val_type = METRIC_TYPES[metric_name]
+        rate = RATES and val_type == 'derive'
+        if rate:
+            translated_metric_name += '_rate'
+            val_type = 'gauge'
+        template = collectd.Values(plugin=PLUGIN_NAME, type=val_type,
+                                   type_instance=translated_metric_name)
+        if dimensions:
+            template.plugin_instance = _format_dimensions(dict(dimensions))
+        self.index[key] = len(self.templates)
+        self.templates.append(template)
+        self.rates.append(rate)
+        self.last.append(NAN)
+        self.last_time.append(NAN)
+        self.sent.append(NAN)
+        self.skipped.append(0)
+        return self.index[key]
+
+    def update(self, metric_name, dimensions, value, now):
+        """
+            Returns the (collectd.Values template, value) to dispatch for a
+            new value of a series, or None if nothing has to be dispatched
+        """
+        key = (metric_name, dimensions)
+        i = self.index.get(key)
+        if i is None:
+            i = self._add(key)
+        previous, previous_time = self.last[i], self.last_time[i]
+        self.last[i] = value
+        self.last_time[i] = now
+        if self.rates[i]:
+            # Nothing to compare to yet, or the counter has been reset
+            if not (previous <= value and previous_time < now):
+                return None
+            value = (value - previous) / (now - previous_time)
+        if ONLY_CHANGED and value == self.sent[i] and \
+                self.skipped[i] < HEARTBEAT:
+            self.skipped[i] += 1
+            return None
+        self.sent[i] = value
+        self.skipped[i] = 0
+        return self.templates[i], value
+
+
+STATE = SeriesState()
+
+
+def aggregate_servers(rows):
+    """
+        Aggregates the metrics of the servers by proxy
+
+    Metrics are summed up, except for the average times which are averaged.
+    Returns the rows of the proxies with the aggregated server metrics
+    (service name AGGREGATED_SERVICE_NAME).
+    """
+    proxies = {}
+    for pxname, svname, values in rows:
+        if svname in PROXY_SVNAMES:
+            continue
+        aggregated = proxies.setdefault(pxname, {})
+        for metric_name, val in values:
+            total, count = aggregated.get(metric_name, (0, 0))
+            aggregated[metric_name] = (total + val, count + 1)
+    result = []
+    for pxname, aggregated in proxies.items():
+        values = []
+        for metric_name, (total, count) in aggregated.items():
+            if METRIC_TYPES[metric_name][0].endswith('_time_avg'):
+                total = total // count
+            values.append((metric_name, total))
+        result.append((pxname, AGGREGATED_SERVICE_NAME, values))
+    return result
 
 
 def get_stats():
     """
-        Makes two calls to haproxy to fetch server info and server stats.
-        Returns the dict containing metric name as the key and a tuple of metric value and the dict of dimensions if any
+        Fetches server info and server stats from haproxy in one round trip.
+        Returns a list of (metric name, dimensions, value)
+
+    Server metrics are aggregated by proxy (see `aggregate_servers`) when
+    there are more than MAX_SERVERS servers.
     """
+    global HAPROXY
     if HAPROXY_SOCKET is None:
         collectd.error("Socket configuration parameter is undefined. Couldn't get the stats")
         return
+    if HAPROXY is None:
+        HAPROXY = HAProxySocket(HAPROXY_SOCKET)
     stats = []
-    haproxy = HAProxySocket(HAPROXY_SOCKET)
 
     try:
-        server_info = haproxy.get_server_info()
-        server_stats = haproxy.get_server_stats()
+        server_info, server_stats = HAPROXY.communicate('show info',
+                                                        'show stat')
     except socket.error:
         collectd.warning(
             'status err Unable to connect to HAProxy socket at %s' %
             HAPROXY_SOCKET)
         return stats
 
-    for key, val in server_info.iteritems():
-        try:
-            stats.append((key, int(val), None))
-        except (TypeError, ValueError):
-            pass
-    for statdict in server_stats:
-        if not (statdict['svname'].lower() in PROXY_MONITORS or statdict['pxname'].lower() in PROXY_MONITORS):
-              continue
-        for metricname, val in statdict.items():
-            try:
-                stats.append((metricname, int(val), {'proxy_name': statdict['pxname'], 'service_name': statdict['svname']}))
-            except (TypeError, ValueError):
-                pass
+    for metric_name, val in parse_info(server_info):
+        stats.append((metric_name, None, val))
+
+    rows = list(STAT_PARSER.parse(server_stats))
+    if MAX_SERVERS:
+        servers = sum(1 for row in rows if row[1] not in PROXY_SVNAMES)
+        if servers > MAX_SERVERS:
+            rows = [row for row in rows if row[1] in PROXY_SVNAMES] + \
+                aggregate_servers(rows)
+    for pxname, svname, values in rows:
+        dimensions = (('proxy_name', pxname), ('service_name', svname))
+        for metric_name, val in values:
+            stats.append((metric_name, dimensions, val))
     return stats
 
 
@@ -196,19 +402,36 @@ def config(config_values):
     config_values (collectd.Config): Object containing config values
     """
 
-    global PROXY_MONITORS, HAPROXY_SOCKET
+    global PROXY_MONITORS, HAPROXY_SOCKET, HAPROXY, VERBOSE, STATE
+    global RATES, ONLY_CHANGED, HEARTBEAT, MAX_SERVERS
     PROXY_MONITORS = [ ]
     HAPROXY_SOCKET = DEFAULT_SOCKET
+    VERBOSE, RATES, ONLY_CHANGED = False, False, False
+    HEARTBEAT, MAX_SERVERS = DEFAULT_HEARTBEAT, 0
     for node in config_values.children:
         if node.key == "ProxyMonitor":
               PROXY_MONITORS.append(node.values[0].lower())
         elif  node.key == "Socket":
             HAPROXY_SOCKET = node.values[0]
+        elif node.key == "Verbose":
+            VERBOSE = bool(node.values[0])
+        elif node.key == "Rates":
+            RATES = bool(node.values[0])
+        elif node.key == "OnlyChanged":
+            ONLY_CHANGED = bool(node.values[0])
+        elif node.key == "Heartbeat":
+            HEARTBEAT = int(node.values[0])
+        elif node.key == "MaxServers":
+            MAX_SERVERS = int(node.values[0])
         else:
             collectd.warning('Unknown config key: %s' % node.key)
     if not PROXY_MONITORS:
         PROXY_MONITORS += DEFAULT_PROXY_MONITORS
-    PROXY_MONITORS = [ p.lower() for p in PROXY_MONITORS ]
+    PROXY_MONITORS = frozenset(p.lower() for p in PROXY_MONITORS)
+    if HAPROXY is not None:
+        HAPROXY.close()
+        HAPROXY = None
+    STATE = SeriesState()
 
 
 def _format_dimensions(dimensions):
@@ -224,15 +447,16 @@ def _format_dimensions(dimensions):
     str: Comma-separated list of dimensions
     """
 
-    dim_pairs = ["%s=%s" % (k, v) for k, v in dimensions.iteritems()]
+    dim_pairs = ["%s=%s" % (k, v) for k, v in dimensions.items()]
     return "[%s]" % (",".join(dim_pairs))
 
 
 def collect_metrics():
-    collectd.debug('beginning collect_metrics')
     """
         A callback method that gets metrics from HAProxy and records them to collectd.
     """
+    if VERBOSE:
+        collectd.debug('beginning collect_metrics')
 
     info = get_stats()
 
@@ -240,30 +464,17 @@ def collect_metrics():
         collectd.warning('%s: No data received' % PLUGIN_NAME)
         return
 
-    for metric_name, metric_value, dimensions in info:
-        if not metric_name.lower() in METRIC_TYPES:
-            collectd.debug("Metric %s is not in the metric types" % metric_name)
+    now = time.time()
+    for metric_name, dimensions, metric_value in info:
+        datapoint = STATE.update(metric_name, dimensions, metric_value, now)
+        if datapoint is None:
             continue
-
-        translated_metric_name, val_type = METRIC_TYPES[metric_name.lower()]
-
-        collectd.debug('Collecting {0}: {1}'.format(translated_metric_name, metric_value))
-        datapoint = collectd.Values()
-        datapoint.type = val_type
-        datapoint.type_instance = translated_metric_name
-        datapoint.plugin = PLUGIN_NAME
-        if dimensions:
-            datapoint.plugin_instance = _format_dimensions(dimensions)
-        datapoint.values = (metric_value,)
-        pprint_dict = {
-                    'plugin': datapoint.plugin,
-                    'plugin_instance': datapoint.plugin_instance,
-                    'type': datapoint.type,
-                    'type_instance': datapoint.type_instance,
-                    'values': datapoint.values
-                }
-        collectd.debug(pprint.pformat(pprint_dict))
-        datapoint.dispatch()
+        template, metric_value = datapoint
+        if VERBOSE:
+            collectd.debug('Collecting %s%s: %s' % (
+                template.plugin_instance, template.type_instance,
+                metric_value))
+        template.dispatch(values=(metric_value,))
 
 collectd.register_config(config)
 collectd.register_read(collect_metrics)
@@ -22,9 +22,11 @@ Commands:
   init           Initialise OpenStack with the bare necessities.
   bench          Run rally on this OpenStack.
   backup         Backup the environment
+  results        Index the rally reports and show their durations.
   ssh-tunnel     Print configuration for port forwarding with horizon.
   tc             Enforce network constraints
   info           Show information of the actual deployment.
+  inventory      Print the Ansible dynamic inventory of the deployment.
   destroy        Destroy the deployment and optionally the related resources.
   deploy         Shortcut for enos up, then enos os and enos config.
   kolla          Runs arbitrary kolla command on nodes
@@ -36,11 +38,10 @@ command.
 """
 
 import logging
-from os import path
+from os import environ as osenv, path
 from docopt import docopt
 import yaml
 
-import enos.task as t
 from enos.utils.constants import VERSION
 from enos.utils.errors import EnosFilePathError
 
@@ -64,7 +65,8 @@ def load_config(config_file):
 def up(**kwargs):
     """
     usage: enos up  [-e ENV|--env=ENV][-f CONFIG_FILE] [--force-deploy]
-                    [-t TAGS|--tags=TAGS] [-s|--silent|-vv]
+                    [--force] [--refresh-reference] [-t TAGS|--tags=TAGS]
+                    [-s|--silent|-vv]
 
     Get resources and install the docker registry.
 
@@ -76,11 +78,16 @@ def up(**kwargs):
                          deployment [default: ./reservation.yaml].
     -h --help            Show this help message.
     --force-deploy       Force deployment [default: False].
+    --force              Run all the roles, even the ones that are up to
+                         date [default: False].
+    --refresh-reference  Read the clusters from the Grid'5000 reference API
+                         again instead of the cache [default: False].
     -s --silent          Quiet mode.
     -t TAGS --tags=TAGS  Only run ansible tasks tagged with these values.
     -vv                  Verbose mode.
 
     """
+    import enos.task as t
     logger.debug(kwargs)
     config_file, config = load_config(kwargs['-f'])
     t.up(config, config_file=config_file, **kwargs)
@@ -103,6 +110,7 @@ def os(**kwargs):
     -t TAGS --tags=TAGS  Only run ansible tasks tagged with these values.
     -vv                  Verbose mode.
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.install_os(**kwargs)
 
@@ -125,6 +133,7 @@ def init(**kwargs):
     -s --silent          Quiet mode.
     -vv                  Verbose mode.
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.init_os(**kwargs)
 
@@ -132,7 +141,7 @@ def init(**kwargs):
 def bench(**kwargs):
     """
     usage: enos bench [-e ENV|--env=ENV] [-s|--silent|-vv]
-        [--workload=WORKLOAD] [--reset]
+        [--workload=WORKLOAD] [--reset] [--parallel] [--resume]
 
     Run rally on this OpenStack.
 
@@ -148,7 +157,12 @@ def bench(**kwargs):
                          that contains the description of the different
                          scenarios to launch [default: workload/].
     --reset              Force the creation of benchmark environment.
+    --parallel           Run the benchmarks concurrently, one per bench
+                         host.
+    --resume             Skip the benchmarks already completed by a
+                         previous run on this environment.
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.bench(**kwargs)
 
@@ -156,12 +170,15 @@ def bench(**kwargs):
 def backup(**kwargs):
     """
     usage: enos backup [--backup_dir=BACKUP_DIR] [-e ENV|--env=ENV]
-                    [-s|--silent|-vv]
+                    [--incremental] [-s|--silent|-vv]
 
     Backup the environment
 
     Options:
     --backup_dir=BACKUP_DIR  Backup directory.
+    --incremental        Mirror the hosts with rsync in BACKUP_DIR/mirrors
+                         instead of fetching archives. Only changes since
+                         the last backup are transferred.
     -e ENV --env=ENV     Path to the environment directory. You should
                          use this option when you want to link a specific
                          experiment [default: current].
@@ -169,10 +186,38 @@ def backup(**kwargs):
     -s --silent          Quiet mode.
     -vv                  Verbose mode.
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.backup(**kwargs)
 
 
+def results(**kwargs):
+    """
+    usage: enos results [--backup_dir=BACKUP_DIR] [-e ENV|--env=ENV]
+                        [--db=DB] [--scenario=SCENARIO] [--out=json]
+                        [-s|--silent|-vv]
+
+    Index the rally reports of the backup tarballs and show the
+    percentiles of the iteration durations per scenario and args.
+
+    Options:
+    --backup_dir=BACKUP_DIR  Backup directory.
+    --db=DB              Path to the results index. Defaults to
+                         results.sqlite in the environment directory.
+    -e ENV --env=ENV     Path to the environment directory. You should
+                         use this option when you want to link a specific
+                         experiment [default: current].
+    -h --help            Show this help message.
+    --out=json           Output the results in json.
+    -s --silent          Quiet mode.
+    --scenario=SCENARIO  Only show the results of this scenario file.
+    -vv                  Verbose mode.
+    """
+    import enos.task as t
+    logger.debug(kwargs)
+    t.results(**kwargs)
+
+
 def new(**kwargs):
     """
     usage: enos new [-e ENV|--env=ENV] [-s|--silent|-vv]
@@ -186,13 +231,14 @@ def new(**kwargs):
     -s --silent          Quiet mode.
     -vv                  Verbose mode.
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.new(**kwargs)
 
 
 def tc(**kwargs):
     """
-    usage: enos tc [-e ENV|--env=ENV] [--test] [-s|--silent|-vv]
+    usage: enos tc [-e ENV|--env=ENV] [--test] [--force] [-s|--silent|-vv]
 
     Enforce network constraints
 
@@ -203,8 +249,11 @@ def tc(**kwargs):
     -h --help            Show this help message.
     -s --silent          Quiet mode.
     --test               Test the rules by generating various reports.
+    --force              Apply the rules of all the devices, not only the
+                         ones that changed since the last run.
     -vv                  Verbose mode.
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.tc(**kwargs)
 
@@ -224,10 +273,43 @@ def info(**kwargs):
     --out {json,pickle,yaml} Output the result in either json, pickle or
                              yaml format.
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.info(**kwargs)
 
 
+def inventory(**kwargs):
+    """
+    usage: enos inventory [-e ENV|--env=ENV] [--list] [--host=HOST]
+
+    Print the Ansible dynamic inventory of the `ENV` deployment (JSON).
+
+    Options:
+
+    -e ENV --env=ENV  Path to the environment directory. You should use
+                      this option when you want to link a specific
+                      experiment [default: current].
+    --list            Print the whole inventory (default).
+    --host=HOST       Print the variables of HOST.
+    """
+    import enos.task as t
+    logger.debug(kwargs)
+    t.inventory(**kwargs)
+
+
+def inventory_script():
+    """Entry point of `enos-inventory`, an Ansible dynamic inventory.
+
+    usage: enos-inventory [--list] [--host=HOST]
+
+    The environment is the one of the `ENOS_ENV` variable (the current one
+    by default), e.g.: ENOS_ENV=enos_2018... ansible -i enos-inventory all
+    """
+    kwargs = docopt(inventory_script.__doc__.split('\n\n')[1])
+    kwargs['--env'] = osenv.get('ENOS_ENV')
+    inventory(**kwargs)
+
+
 def destroy(**kwargs):
     """
     usage: enos destroy [-e ENV|--env=ENV] [-s|--silent|-vv] [--hard]
@@ -245,6 +327,7 @@ def destroy(**kwargs):
     -s --silent          Quiet mode.
     -vv                  Verbose mode.
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.destroy(**kwargs)
 
@@ -252,7 +335,7 @@ def destroy(**kwargs):
 def deploy(**kwargs):
     """
     usage: enos deploy [-e ENV|--env=ENV] [-f CONFIG_FILE] [--force-deploy]
-                    [-s|--silent|-vv]
+                    [--refresh-reference] [-s|--silent|-vv]
 
     Shortcut for enos up, then enos os, and finally enos config.
 
@@ -263,9 +346,12 @@ def deploy(**kwargs):
     -f CONFIG_FILE       Path to the configuration file describing the
                          deployment [default: ./reservation.yaml].
     --force-deploy       Force deployment [default: False].
+    --refresh-reference  Read the clusters from the Grid'5000 reference API
+                         again instead of the cache [default: False].
     -s --silent          Quiet mode.
     -vv                  Verbose mode.
     """
+    import enos.task as t
     logger.debug(kwargs)
     config_file, config = load_config(kwargs['-f'])
     t.deploy(config, config_file=config_file, **kwargs)
@@ -286,6 +372,7 @@ def kolla(**kwargs):
     -vv                  Verbose mode.
     command              Kolla command (e.g prechecks, checks, pull)
     """
+    import enos.task as t
     logger.debug(kwargs)
     t.kolla(**kwargs)
 
@@ -323,9 +410,11 @@ def main():
     pushtask(enostasks, destroy)
     pushtask(enostasks, kolla)
     pushtask(enostasks, info)
+    pushtask(enostasks, inventory)
     pushtask(enostasks, init)
     pushtask(enostasks, os)
     pushtask(enostasks, new)
+    pushtask(enostasks, results)
     pushtask(enostasks, tc)
     pushtask(enostasks, up)
 
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 import copy
+import json
 import logging
+import os
+import time
 
+import execo as ex
+from execo.process import ProcessOutputHandler
 from enoslib.api import expand_groups
 from enoslib.infra.enos_g5k import (api, provider)
 
@@ -25,6 +30,41 @@ DEFAULT_CONFIG = {
 
 DEFAULT_CONN_PARAMS = {'user': 'root'}
 
+# On-disk cache of the clusters metadata read from the reference API
+REFERENCE_CACHE = os.path.join(os.path.expanduser('~'), '.enos',
+                               'g5k_reference.json')
+
+# Time (in seconds) after which a cached cluster is read again from the API
+DEFAULT_REFERENCE_TTL = 7 * 24 * 3600
+
+# Directories of the nodes bound in /tmp (free storage location on G5k)
+BIND_DIRS = ['docker/volumes', 'nova']
+
+# Prefix of the lines reporting the steps of the provisioning script
+PROVISION_MARKER = 'enos-provision:'
+
+# Run on every node so we can run Ansible on it. Each step is skipped if
+# it is already satisfied, and reported as `<step> done|skipped`.
+PROVISION_SCRIPT = """
+step() { echo "%(marker)s $1 $2"; }
+if command -v python > /dev/null; then
+  step python skipped
+else
+  (apt-get update && apt-get -y --force-yes install python) > /dev/null \\
+    || exit 1
+  step python done
+fi
+for dir in %(dirs)s; do
+  if mountpoint -q /var/lib/$dir; then
+    step $dir skipped
+  else
+    mkdir -p /tmp/$dir /var/lib/$dir \\
+      && mount --bind /tmp/$dir /var/lib/$dir || exit 1
+    step $dir done
+  fi
+done
+""" % {'marker': PROVISION_MARKER, 'dirs': ' '.join(BIND_DIRS)}
+
 
 PRIMARY_NETWORK = {
     "id": "int-net",
@@ -39,13 +79,96 @@ SECONDARY_NETWORK = {
     "role": NEUTRON_EXTERNAL_INTERFACE}
 
 
-def _count_common_interfaces(clusters):
-    interfaces = api.get_clusters_interfaces(clusters)
+class ReferenceCache(object):
+    """On-disk cache of the clusters metadata of the reference API.
+
+    Sites and interfaces of the clusters are cached (per cluster) in a JSON
+    file and read again from the reference API once older than `ttl`
+    seconds. In `offline` mode the API is never called: cached clusters
+    are used whatever their age, and a missing one is an error.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_REFERENCE_TTL, offline=False):
+        self.path = path or REFERENCE_CACHE
+        self.ttl = ttl
+        self.offline = offline
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = "%s.%s" % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def _expired(self, entry, now):
+        if entry is None:
+            return True
+        return not self.offline and now - entry['time'] > self.ttl
+
+    def get(self, kind, clusters, fetch):
+        """Returns the `kind` metadata of the clusters (cluster -> value).
+
+        `fetch` is called with the clusters missing from the cache (or
+        expired) and returns their metadata (cluster -> value).
+        """
+        data = self._load()
+        entries = data.setdefault(kind, {})
+        now = time.time()
+        missing = sorted(c for c in set(clusters)
+                         if self._expired(entries.get(c), now))
+        if missing and self.offline:
+            raise Exception("%s of %s not in %s (offline mode)" %
+                            (kind, missing, self.path))
+        cached = sorted(set(clusters) - set(missing))
+        if cached:
+            age = now - min(entries[c]['time'] for c in cached)
+            LOGGER.info("Using the %s of %s cached %.1f hour(s) ago in %s "
+                        "(see enos up --refresh-reference)" %
+                        (kind, cached, age / 3600, self.path))
+        if missing:
+            LOGGER.debug("Getting %s of %s from the reference API" %
+                         (kind, missing))
+            for cluster, value in fetch(missing).items():
+                entries[cluster] = {'time': now, 'value': value}
+            self._save(data)
+        return dict((c, entries[c]['value']) for c in clusters)
+
+    def invalidate(self, clusters=None):
+        """Removes the clusters (all of them by default) from the cache."""
+        if clusters is None:
+            data = {}
+        else:
+            data = self._load()
+            for entries in data.values():
+                for cluster in clusters:
+                    entries.pop(cluster, None)
+        self._save(data)
+
+
+def _count_common_interfaces(clusters, cache=None):
+    if cache is None:
+        interfaces = api.get_clusters_interfaces(clusters)
+    else:
+        interfaces = cache.get('interfaces', clusters,
+                               api.get_clusters_interfaces)
     return min([len(x) for x in interfaces.values()])
 
 
-def _get_sites(clusters):
-    clusters_sites = api.get_clusters_sites(clusters)
+def _get_sites(clusters, cache=None):
+    if cache is None:
+        clusters_sites = api.get_clusters_sites(clusters)
+    else:
+        clusters_sites = cache.get('sites', clusters,
+                                   api.get_clusters_sites)
     return set(clusters_sites.values())
 
 
@@ -53,6 +176,11 @@ def _build_enoslib_conf(config):
     conf = copy.deepcopy(config)
     enoslib_conf = conf.get("provider", {})
 
+    # Options of the reference cache (unknown to enoslib)
+    cache = ReferenceCache(
+        ttl=enoslib_conf.pop("reference_cache_ttl", DEFAULT_REFERENCE_TTL),
+        offline=enoslib_conf.pop("reference_offline", False))
+
     # NOTE(msimonin): Force some enoslib/g5k parameters here.
     # * dhcp: True means that network card will be brought up and the dhcp
     #   client will be called. As for now (2018-08-16) this is disabled by
@@ -92,7 +220,7 @@ def _build_enoslib_conf(config):
             machines.append(machine)
 
     # check the location of the clusters
-    sites = _get_sites(clusters)
+    sites = _get_sites(clusters, cache=cache)
     if len(sites) > 1:
         raise Exception("Multisite deployment isn't supported yet")
 
@@ -102,7 +230,7 @@ def _build_enoslib_conf(config):
     networks = [PRIMARY_NETWORK]
 
     # check minimum available number of interfaces in each cluster
-    network_count = _count_common_interfaces(clusters)
+    network_count = _count_common_interfaces(clusters, cache=cache)
     if network_count > 1:
         networks.append(SECONDARY_NETWORK)
 
@@ -117,43 +245,72 @@ def _build_enoslib_conf(config):
     return enoslib_conf
 
 
+class _ProvisionProgress(ProcessOutputHandler):
+    """Logs the steps of the provisioning script as each node completes them.
+
+    The steps (name, status, duration) of each node are recorded in `steps`.
+    """
+
+    def __init__(self):
+        super(_ProvisionProgress, self).__init__()
+        self.steps = {}
+        self.last = {}
+
+    def read_line(self, process, stream, string, eof, error):
+        if not string.startswith(PROVISION_MARKER):
+            return
+        address = process.host.address
+        step, status = string[len(PROVISION_MARKER):].split()
+        now = time.time()
+        duration = now - self.last.get(address, process.start_date or now)
+        self.last[address] = now
+        self.steps.setdefault(address, []).append((step, status, duration))
+        LOGGER.info("[%s] %s %s (%.1fs)" % (address, step, status, duration))
+
+
 def _provision(roles):
+    """Provisions the nodes so we can run Ansible on them.
+
+    The provisioning script runs concurrently on all the nodes, each node
+    going through the steps at its own pace.
+
+    Returns the timings of the nodes as a dict (address -> {'duration':
+    total time, 'steps': list of (step, status, duration)}).
+    """
     nodes = []
     for value in roles.values():
         nodes.extend(value)
 
     # remove duplicate hosts
     # Note(jrbalderrama): do we have to implement hash/equals in Host?
-    nodes = set([node.address for node in nodes])
-
-    # Provision nodes so we can run Ansible on it
-    api.exec_command_on_nodes(
-        nodes,
-        'apt-get update && apt-get -y --force-yes install python',
-        'Installing python...')
-
-    # Bind volumes of docker in /tmp (free storage location on G5k)
-    api.exec_command_on_nodes(
-        nodes,
-        ('mkdir -p /tmp/docker/volumes; '
-         'mkdir -p /var/lib/docker/volumes'),
-        'Creating docker volumes directory in /tmp')
-    api.exec_command_on_nodes(
-        nodes,
-        ('(mount | grep /tmp/docker/volumes) || '
-         'mount --bind /tmp/docker/volumes /var/lib/docker/volumes'),
-        'Bind mount')
-
-    # Bind nova local storage in /tmp
-    api.exec_command_on_nodes(
-        nodes,
-        'mkdir -p /tmp/nova ; mkdir -p /var/lib/nova',
-        'Creating nova directory in /tmp')
-    api.exec_command_on_nodes(
-        nodes,
-        ('(mount | grep /tmp/nova) || '
-         'mount --bind /tmp/nova /var/lib/nova'),
-        'Bind mount')
+    nodes = sorted(set([node.address for node in nodes]))
+
+    LOGGER.info("Provisioning %s node(s)..." % len(nodes))
+    progress = _ProvisionProgress()
+    remote = ex.Remote(PROVISION_SCRIPT, nodes, DEFAULT_CONN_PARAMS,
+                       process_args={'stdout_handlers': [progress]})
+    remote.run()
+
+    timings = {}
+    failed = []
+    for process in remote.processes:
+        address = process.host.address
+        timings[address] = {
+            'duration': (process.end_date or 0) - (process.start_date or 0),
+            'steps': progress.steps.get(address, [])
+        }
+        if not process.ok:
+            LOGGER.error("[%s] provisioning failed: %s" %
+                         (address, process.stderr.strip()))
+            failed.append(address)
+    if timings:
+        slowest = max(timings, key=lambda a: timings[a]['duration'])
+        LOGGER.info("Nodes provisioned, the slowest one (%s) took %.1fs" %
+                    (slowest, timings[slowest]['duration']))
+    if failed:
+        raise Exception('An error occcured during the provisioning of %s' %
+                        failed)
+    return timings
 
 
 class G5k(Provider):
@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
-from enoslib.task import enostask
-from enoslib.api import run_ansible, emulate_network, validate_network
-
+# NOTE: Modules importing ansible, git or netaddr (enoslib.api,
+# enos.utils.bench, enos.utils.ippool, enos.utils.kolla_cache) are imported
+# by the tasks that need them, so that light commands (e.g. `enos info`)
+# start fast.
 from enos.utils.constants import (SYMLINK_NAME, ANSIBLE_DIR, INVENTORY_DIR,
                                   NEUTRON_EXTERNAL_INTERFACE,
                                   NETWORK_INTERFACE, TEMPLATE_DIR)
 from enos.utils.errors import EnosFilePathError
-from enos.utils.extra import (bootstrap_kolla, generate_inventory, pop_ip,
+from enos.utils.extra import (KOLLA_MANDATORY_GROUPS, bootstrap_kolla,
+                              bootstrap_digest, generate_inventory,
                               make_provider, mk_enos_values, load_config,
                               seekpath, get_vip_pool, lookup_network, in_kolla)
-from enos.utils.enostask import check_env
+from enos.utils.enostask import check_env, enostask
+from enos.utils.envstore import load_env
+from enos.utils.inventory import dynamic_inventory
+from enos.utils.backup import MIRROR_DIR, dedup_backup, promote_snapshot
+from enos.utils.results import (PERCENTILES, RESULTS_DB, index_results,
+                                query_results)
+from enos.utils.regions import REGION_INVENTORY, init_regions, merge_regions
+from enos.utils.fingerprint import (UP_FINGERPRINTS, UP_ROLES, boot_ids,
+                                    outdated_roles, role_fingerprint)
 
 from datetime import datetime
 import logging
@@ -23,60 +33,96 @@ import json
 import pickle
 import yaml
 
-import itertools
 import operator
 
 
-def get_and_bootstrap_kolla(env, force=False):
-    """This gets kolla in the current directory.
+def get_and_bootstrap_kolla(env, force=False, update=False):
+    """This gets kolla in the result directory.
 
     force iff a potential previous installation must be overwritten.
+
+    update iff a previous installation must be moved to `kolla_ref` (in
+    place). Kolla is then bootstrapped again only if the checkout, the
+    values or the patches changed (see `bootstrap_digest`).
     """
+    from enos.utils.kolla_cache import (KOLLA_ANSIBLE, KollaCache,
+                                        head_commit, link_venv,
+                                        reset_checkout)
 
     kolla_path = os.path.join(env['resultdir'], 'kolla')
+    # Sources and virtualenv come from the kolla cache, shared by the
+    # environments (see `enos.utils.kolla_cache`)
+    cache = KollaCache()
+    repo, ref = env['config']['kolla_repo'], env['config']['kolla_ref']
 
     if force and os.path.isdir(kolla_path):
         logging.info("Remove previous Kolla installation")
         check_call("rm -rf %s" % kolla_path, shell=True)
-    if not os.path.isdir(kolla_path):
-        logging.info("Cloning Kolla repository...")
-        check_call("git clone %s --branch %s --single-branch --quiet %s" %
-                       (env['config']['kolla_repo'],
-                        env['config']['kolla_ref'],
-                        kolla_path),
-                   shell=True)
-
+    if os.path.isdir(kolla_path):
+        if not update:
+            return kolla_path
+        moved = cache.update(repo, ref, kolla_path)
+    else:
+        logging.info("Checking out Kolla %s..." % ref)
+        cache.checkout(repo, ref, kolla_path)
+        env.pop('kolla_bootstrap', None)
+        moved = True
+
+    commit = head_commit(kolla_path)
+    digest = bootstrap_digest(env, commit)
+    if digest != env.get('kolla_bootstrap'):
+        # Start from pristine sources, patches may have been disabled
+        reset_checkout(kolla_path)
         # Bootstrap kolla running by patching kolla sources (if any) and
         # generating admin-openrc, globals.yml, passwords.yml
         bootstrap_kolla(env)
+        env['kolla_bootstrap'] = digest
+    else:
+        logging.info("Kolla is already bootstrapped")
 
-        # Installing the kolla dependencies in the kolla venv
+    # Installing the kolla dependencies in the kolla venv, unless it is
+    # the one of the cache
+    venv = cache.venv(repo, commit)
+    if not link_venv(venv) and moved:
         in_kolla('cd %s && pip install .' % kolla_path)
-        # Kolla recommends installing ansible manually.
-        # Currently anything over 2.3.0 is supported, not sure about the future
-        # So we hardcode the version to something reasonnable for now
-        in_kolla('cd %s && pip install ansible==2.5.7' % kolla_path)
+        in_kolla('cd %s && pip install %s' % (kolla_path, KOLLA_ANSIBLE))
 
     return kolla_path
 
 
 @enostask(new=True)
 def up(config, config_file=None, env=None, **kwargs):
+    from enoslib.api import run_ansible
+    from enos.utils.ippool import get_ip_pool
+
     logging.debug('phase[up]: args=%s' % kwargs)
+    if kwargs.get('--refresh-reference'):
+        # Imported here since it imports execo
+        from enos.provider.g5k import ReferenceCache
+        ReferenceCache().invalidate()
     # Calls the provider and initialise resources
 
-    provider_conf = config['provider']
-    provider = make_provider(provider_conf)
+    regions = []
+    if config.get('regions'):
+        # Each region gets its resources from its own provider, all the
+        # regions at the same time
+        env['config'] = config
+        env['config_file'] = config_file
+        regions = init_regions(config, kwargs['--force-deploy'])
+        rsc, networks = merge_regions(regions)
+    else:
+        provider_conf = config['provider']
+        provider = make_provider(provider_conf)
 
-    # Applying default configuration
-    config = load_config(config,
-                         provider.default_config())
-    env['config'] = config
-    env['config_file'] = config_file
-    logging.debug("Loaded config: %s", config)
+        # Applying default configuration
+        config = load_config(config,
+                             provider.default_config())
+        env['config'] = config
+        env['config_file'] = config_file
+        logging.debug("Loaded config: %s", config)
 
-    rsc, networks = \
-        provider.init(env['config'], kwargs['--force-deploy'])
+        rsc, networks = \
+            provider.init(env['config'], kwargs['--force-deploy'])
 
     env['rsc'] = rsc
     env['networks'] = networks
@@ -92,29 +138,76 @@ def up(config, config_file=None, env=None, **kwargs):
         base_inventory = os.path.join(INVENTORY_DIR, 'inventory.sample')
     else:
         base_inventory = seekpath(inventory_conf)
+    env['base_inventory'] = base_inventory
 
-    generate_inventory(env['rsc'], env['networks'], base_inventory, inventory)
+    env['inventory_digest'] = generate_inventory(env['rsc'], env['networks'],
+                                                 base_inventory, inventory)
     logging.info('Generates inventory %s' % inventory)
 
     env['inventory'] = inventory
 
     # Set variables required by playbooks of the application
-    vip_pool = get_vip_pool(networks)
+    vip_pool = get_ip_pool(env, get_vip_pool(networks))
     env['config'].update({
-       'vip':               pop_ip(vip_pool),
-       'registry_vip':      pop_ip(vip_pool),
-       'influx_vip':        pop_ip(vip_pool),
-       'grafana_vip':       pop_ip(vip_pool),
+       'vip':               vip_pool.allocate('vip'),
+       'registry_vip':      vip_pool.allocate('registry_vip'),
+       'influx_vip':        vip_pool.allocate('influx_vip'),
+       'grafana_vip':       vip_pool.allocate('grafana_vip'),
        'resultdir':         env['resultdir'],
        'rabbitmq_password': "demo",
        'database_password': "demo"
     })
 
+    # Each region gets its own inventory and vip
+    env['regions'] = {}
+    for name, region_config, region_rsc, region_networks in regions:
+        region_inventory = os.path.join(env['resultdir'],
+                                        REGION_INVENTORY % name)
+        generate_inventory(region_rsc, region_networks, base_inventory,
+                           region_inventory)
+        logging.info('Generates inventory %s for region %s' %
+                     (region_inventory, name))
+        region_vip = env['config']['vip'] if not env['regions'] \
+            else get_ip_pool(env, get_vip_pool(region_networks)).allocate(
+                'vip-%s' % name)
+        env['regions'][name] = {
+            'config': region_config,
+            'rsc': region_rsc,
+            'networks': region_networks,
+            'inventory': region_inventory,
+            'vip': region_vip
+        }
+
     # Runs playbook that initializes resources (eg,
     # installs the registry, install monitoring tools, ...)
+    # Roles whose inputs did not change since their last successful run are
+    # skipped (unless forced)
     up_playbook = os.path.join(ANSIBLE_DIR, 'up.yml')
+    if kwargs['--force-deploy']:
+        env.pop(UP_FINGERPRINTS, None)
+    # Nodes of a new reservation, or rebooted, may have the same aliases and
+    # addresses: their boot ids tell that the roles must run again
+    host_boot_ids = boot_ids(inventory)
+    fingerprints = dict(
+        (role, role_fingerprint(role, up_playbook, inventory, env['config'],
+                                boot_ids=host_boot_ids))
+        for role in UP_ROLES)
+    if kwargs['--tags']:
+        tags = kwargs['--tags'].split(',')
+    elif kwargs.get('--force'):
+        tags = list(UP_ROLES)
+    else:
+        tags = outdated_roles(env, fingerprints)
+        skipped = [r for r in UP_ROLES if r not in tags]
+        if skipped:
+            logging.info("Skipping the up-to-date roles %s" % skipped)
+    if not tags:
+        return
+
     run_ansible([up_playbook], inventory, extra_vars=env['config'],
-                tags=kwargs['--tags'])
+                tags=tags)
+    env.setdefault(UP_FINGERPRINTS, {}).update(
+        (r, fingerprints[r]) for r in tags if r in fingerprints)
 
 
 @enostask()
@@ -122,7 +215,7 @@ def up(config, config_file=None, env=None, **kwargs):
 def install_os(env=None, **kwargs):
     logging.debug('phase[os]: args=%s' % kwargs)
 
-    kolla_path = get_and_bootstrap_kolla(env, force=True)
+    kolla_path = get_and_bootstrap_kolla(env, update=True)
     # Construct kolla-ansible command...
     kolla_cmd = [os.path.join(kolla_path, "tools", "kolla-ansible")]
 
@@ -146,6 +239,8 @@ def install_os(env=None, **kwargs):
 @enostask()
 @check_env
 def init_os(env=None, **kwargs):
+    from enoslib.api import run_ansible
+
     logging.debug('phase[init]: args=%s' % kwargs)
     playbook_values = mk_enos_values(env)
     playbook_path = os.path.join(ANSIBLE_DIR, 'init_os.yml')
@@ -176,73 +271,33 @@ def init_os(env=None, **kwargs):
 @enostask()
 @check_env
 def bench(env=None, **kwargs):
-    def cartesian(d):
-        """returns the cartesian product of the args."""
-        logging.debug(d)
-        f = []
-        for k, v in d.items():
-            if isinstance(v, list):
-                f.extend([[[k, vv] for vv in v]])
-            else:
-                f.append([[k, v]])
-        logging.debug(f)
-        product = []
-        for e in itertools.product(*f):
-            product.append(dict(e))
-        return product
+    from enos.utils.bench import (expand_workload, get_bench_hosts,
+                                  schedule_benchs)
 
     logging.debug('phase[bench]: args=%s' % kwargs)
     playbook_values = mk_enos_values(env)
     workload_dir = seekpath(kwargs["--workload"])
+    inventory_path = os.path.join(env['resultdir'], 'multinode')
     with open(os.path.join(workload_dir, "run.yml")) as workload_f:
         workload = yaml.load(workload_f)
-        for bench_type, desc in workload.items():
-            scenarios = desc.get("scenarios", [])
-            reset = kwargs.get("--reset")
-            for idx, scenario in enumerate(scenarios):
-                # merging args
-                top_args = desc.get("args", {})
-                args = scenario.get("args", {})
-                top_args.update(args)
-                # merging enabled, skipping if not enabled
-                top_enabled = desc.get("enabled", True)
-                enabled = scenario.get("enabled", True)
-                if not (top_enabled and enabled):
-                    continue
-                for a in cartesian(top_args):
-                    playbook_path = os.path.join(ANSIBLE_DIR, 'run-bench.yml')
-                    inventory_path = os.path.join(
-                        env['resultdir'], 'multinode')
-                    # NOTE(msimonin) all the scenarios and plugins
-                    # must reside on the workload directory
-                    scenario_location = os.path.join(
-                        workload_dir, scenario["file"])
-                    bench = {
-                        'type': bench_type,
-                        'scenario_location': scenario_location,
-                        'file': scenario["file"],
-                        'args': a
-                    }
-                    bench.update({'reset': False})
-                    if reset and idx == 0:
-                        bench.update({'reset': True})
-
-                    if "plugin" in scenario:
-                        plugin = os.path.join(workload_dir,
-                                           scenario["plugin"])
-                        if os.path.isdir(plugin):
-                            plugin = plugin + "/"
-                        bench['plugin_location'] = plugin
-                    playbook_values.update(bench=bench)
-
-                    run_ansible([playbook_path],
-                                inventory_path,
-                                extra_vars=playbook_values)
+
+    # Spread the points on the bench hosts if asked to
+    hosts = None
+    if kwargs.get("--parallel"):
+        hosts = get_bench_hosts(inventory_path)
+        logging.info("Running benchs in parallel on %s" % hosts)
+
+    benchs = expand_workload(workload, workload_dir,
+                             reset=kwargs.get("--reset"))
+    schedule_benchs(benchs, playbook_values, inventory_path,
+                    env['resultdir'], hosts=hosts,
+                    resume=kwargs.get("--resume"))
 
 
 @enostask()
 @check_env
 def backup(env=None, **kwargs):
+    from enoslib.api import run_ansible
 
     backup_dir = kwargs['--backup_dir'] \
         or kwargs['--env'] \
@@ -254,9 +309,48 @@ def backup(env=None, **kwargs):
         os.mkdir(backup_dir)
     # update the env
     env['config']['backup_dir'] = backup_dir
+    extra_vars = dict(env['config'])
+    incremental = kwargs.get('--incremental')
+    if incremental:
+        mirror_dir = os.path.join(backup_dir, MIRROR_DIR)
+        snapshot = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        extra_vars.update(backup_incremental=True,
+                          backup_mirror_dir=mirror_dir,
+                          backup_snapshot=snapshot)
     playbook_path = os.path.join(ANSIBLE_DIR, 'backup.yml')
     inventory_path = os.path.join(env['resultdir'], 'multinode')
-    run_ansible([playbook_path], inventory_path, extra_vars=env['config'])
+    run_ansible([playbook_path], inventory_path, extra_vars=extra_vars)
+    if incremental:
+        promote_snapshot(mirror_dir, snapshot)
+        dedup_backup(mirror_dir)
+
+
+@enostask(save=False)
+@check_env
+def results(env=None, **kwargs):
+    logging.debug('phase[results]: args=%s' % kwargs)
+    backup_dir = kwargs['--backup_dir'] \
+        or kwargs['--env'] \
+        or SYMLINK_NAME
+    backup_dir = os.path.abspath(backup_dir)
+    db_path = kwargs['--db'] or os.path.join(env['resultdir'], RESULTS_DB)
+
+    runs = index_results(db_path, backup_dir)
+    logging.info("%s new rally run(s) indexed in %s" % (runs, db_path))
+
+    rows = query_results(db_path, scenario=kwargs['--scenario'])
+    if kwargs['--out'] == 'json':
+        print(json.dumps(rows))
+        return
+
+    header = ['scenario', 'workload', 'args', 'runs', 'iterations',
+              'errors'] + ['p%s' % p for p in PERCENTILES]
+    print('\t'.join(header))
+    for row in rows:
+        values = [row[h] for h in header]
+        values[2] = json.dumps(values[2], sort_keys=True)
+        print('\t'.join(['%.3f' % v if isinstance(v, float) else str(v)
+                         for v in values]))
 
 
 @enostask()
@@ -267,11 +361,11 @@ def new(env=None, **kwargs):
         print(content.read())
 
 
-@enostask()
+@enostask(keys=['rsc', 'inventory', 'config'])
 @check_env
 def tc(env=None, **kwargs):
     """
-    Usage: enos tc [-e ENV|--env=ENV] [--test] [-s|--silent|-vv]
+    Usage: enos tc [-e ENV|--env=ENV] [--test] [--force] [-s|--silent|-vv]
     Enforce network constraints
     Options:
     -e ENV --env=ENV     Path to the environment directory. You should
@@ -280,8 +374,12 @@ def tc(env=None, **kwargs):
     -h --help            Show this help message.
     -s --silent          Quiet mode.
     --test               Test the rules by generating various reports.
+    --force              Apply the rules of all the devices, not only the
+                        ones that changed since the last run.
     -vv                  Verbose mode.
     """
+    from enoslib.api import validate_network
+    from enos.utils.tc import emulate_network
 
     roles = env["rsc"]
     inventory = env["inventory"]
@@ -290,10 +388,11 @@ def tc(env=None, **kwargs):
         validate_network(roles, inventory)
     else:
         network_constraints = env["config"]["network_constraints"]
-        emulate_network(roles, inventory, network_constraints)
+        emulate_network(roles, inventory, network_constraints,
+                        env['resultdir'], force=kwargs['--force'])
 
 
-@enostask()
+@enostask(save=False)
 def info(env=None, **kwargs):
     if not kwargs['--out']:
         pprint.pprint(env)
@@ -308,15 +407,45 @@ def info(env=None, **kwargs):
         print(info.__doc__)
 
 
+@check_env
+def inventory(**kwargs):
+    """Prints the dynamic inventory of the env.
+
+    Not an enostask: the env is only read, and only if the cached inventory
+    is out of date (see `enos.utils.inventory.dynamic_inventory`).
+    """
+    resultdir = kwargs['--env'] or SYMLINK_NAME
+    env = load_env(resultdir, keys=['base_inventory', 'config'])
+    base_inventory = env.get('base_inventory')
+    if base_inventory is None:
+        # Env made before the base inventory was recorded
+        inventory_conf = env.get('config', {}).get('inventory')
+        base_inventory = seekpath(inventory_conf) if inventory_conf \
+            else os.path.join(INVENTORY_DIR, 'inventory.sample')
+    inventory = dynamic_inventory(resultdir, base_inventory,
+                                  KOLLA_MANDATORY_GROUPS)
+    if kwargs['--host']:
+        hostvars = json.loads(inventory)['_meta']['hostvars']
+        print(json.dumps(hostvars.get(kwargs['--host'], {})))
+    else:
+        print(inventory)
+
+
 @enostask()
 @check_env
 def destroy(env=None, **kwargs):
     hard = kwargs['--hard']
     if hard:
         logging.info('Destroying all the resources')
-        provider_conf = env['config']['provider']
-        provider = make_provider(provider_conf)
-        provider.destroy(env)
+        env.pop(UP_FINGERPRINTS, None)
+        for name, region in env.get('regions', {}).items():
+            logging.info('Destroying the resources of region %s' % name)
+            provider = make_provider(region['config']['provider'])
+            provider.destroy(dict(env, config=region['config']))
+        if not env.get('regions'):
+            provider_conf = env['config']['provider']
+            provider = make_provider(provider_conf)
+            provider.destroy(env)
     else:
         command = ['destroy', '--yes-i-really-really-mean-it']
         if kwargs['--include-images']:
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+
+# Directory (in the backup dir) of the mirrors of the incremental backup
+MIRROR_DIR = 'mirrors'
+
+# Directory (in the mirror dir) of the content-addressed store
+OBJECTS_DIR = '.objects'
+
+# Link (in the mirror of a host) to its last complete snapshot
+LATEST = 'latest'
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _object_name(sha, st):
+    # Hard links share the attributes of their inode: files only share an
+    # object if they have the attributes rsync preserves in common
+    return '%s-%o-%d-%d-%d' % (sha, st.st_mode, st.st_uid, st.st_gid,
+                               int(st.st_mtime * 10 ** 9))
+
+
+def promote_snapshot(mirror_dir, snapshot):
+    """Points the `LATEST` link of the host mirrors to `snapshot`.
+
+    Only the hosts with this snapshot are updated: the others keep their
+    previous one.
+    """
+    for host in os.listdir(mirror_dir):
+        host_dir = os.path.join(mirror_dir, host)
+        if host == OBJECTS_DIR or \
+           not os.path.isdir(os.path.join(host_dir, snapshot)):
+            continue
+        tmp_path = os.path.join(host_dir, LATEST + '.enos-tmp')
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(snapshot, tmp_path)
+        os.rename(tmp_path, os.path.join(host_dir, LATEST))
+
+
+def _object_inodes(objects_dir):
+    inodes = set()
+    for root, _, files in os.walk(objects_dir):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            inodes.add((st.st_dev, st.st_ino))
+    return inodes
+
+
+def _remove_orphans(objects_dir):
+    for root, _, files in os.walk(objects_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.lstat(path).st_nlink == 1:
+                os.remove(path)
+
+
+def dedup_backup(mirror_dir):
+    """Deduplicates the files of the incremental backup in mirror_dir.
+
+    Every regular file of the host snapshots
+    (<mirror_dir>/<host>/<snapshot>/...) is stored once in a
+    content-addressed store (<mirror_dir>/.objects, one file per sha1
+    and attributes) and the snapshots hold hard links to it. Files that
+    are already links to the store are not hashed again, so that only
+    the files changed by the last backup are.
+
+    Note that each backup is a new snapshot that rsync hard links to the
+    previous one of the host (--link-dest) when a file did not change,
+    content and attributes: objects of the store are never modified.
+
+    Objects that are no longer linked from a mirror are removed.
+
+    Returns a tuple (number of files hashed, number of bytes saved).
+    """
+    objects_dir = os.path.join(mirror_dir, OBJECTS_DIR)
+    if not os.path.isdir(objects_dir):
+        os.makedirs(objects_dir)
+    known = _object_inodes(objects_dir)
+
+    hashed = 0
+    saved = 0
+    for root, dirs, files in os.walk(mirror_dir):
+        if root == mirror_dir:
+            # Only walk the host mirrors
+            dirs[:] = [d for d in dirs if d != OBJECTS_DIR]
+            continue
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            if (st.st_dev, st.st_ino) in known:
+                continue
+            sha = _hash_file(path)
+            hashed = hashed + 1
+            object_dir = os.path.join(objects_dir, sha[:2])
+            object_path = os.path.join(object_dir, _object_name(sha, st))
+            if not os.path.isdir(object_dir):
+                os.mkdir(object_dir)
+            if os.path.exists(object_path):
+                # Replace the file by a link to the object (atomically)
+                tmp_path = path + '.enos-dedup'
+                os.link(object_path, tmp_path)
+                os.rename(tmp_path, path)
+                saved = saved + st.st_size
+            else:
+                os.link(path, object_path)
+                known.add((st.st_dev, st.st_ino))
+
+    _remove_orphans(objects_dir)
+    logging.info("Deduplicated %s: %s file(s) hashed, %s bytes saved" %
+                 (mirror_dir, hashed, saved))
+    return hashed, saved
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+from ansible.executor.playbook_executor import PlaybookExecutor
+from ansible.executor.task_queue_manager import TaskQueueManager
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.dataloader import DataLoader
+from ansible.vars.manager import VariableManager
+
+from .constants import ANSIBLE_DIR, ENOS_PATH
+from .errors import (EnosError, EnosFailedHostsError,
+                     EnosUnreachableHostsError)
+
+from collections import namedtuple
+import hashlib
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Group of the inventory hosting the benchmark tools
+BENCH_GROUP = 'disco/bench'
+
+# Name of the file (in the result dir) indexing the points run by `enos bench`
+BENCH_INDEX = 'bench_index.json'
+
+# Name of the file (in the result dir) journaling the completed points
+BENCH_JOURNAL = 'bench_journal'
+
+# Name of the directory (in the result dir) caching the facts of the hosts
+BENCH_FACTS = 'facts'
+
+# Playbook run for each point
+RUN_BENCH = os.path.join(ANSIBLE_DIR, 'run-bench.yml')
+
+# Options of the Ansible command line (same defaults as enoslib.api)
+Options = namedtuple('Options', [
+    'listtags', 'listtasks', 'listhosts', 'syntax', 'connection',
+    'module_path', 'forks', 'private_key_file', 'ssh_common_args',
+    'ssh_extra_args', 'sftp_extra_args', 'scp_extra_args', 'become',
+    'become_method', 'become_user', 'remote_user', 'verbosity', 'check',
+    'tags', 'diff', 'basedir'])
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+
+
+def cartesian(args):
+    """Lazily yields the cartesian product of the args.
+
+    List values are expanded, any other value is taken as is. Points
+    are generated in the order of the sorted keys so that the expansion
+    is deterministic.
+    """
+    keys = sorted(args)
+    values = [args[k] if isinstance(args[k], list) else [args[k]]
+              for k in keys]
+    for combination in itertools.product(*values):
+        yield dict(zip(keys, combination))
+
+
+def bench_id(bench):
+    "Returns a stable identifier of a point of the workload."
+    key = json.dumps([bench['type'], bench['file'], bench['args']],
+                     sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def expand_workload(workload, workload_dir, reset=False):
+    """Lazily yields a `bench` description per point of the workload.
+
+    Scenario args shadow the top level args of their type, the same goes
+    for `enabled`. Points are identified by their `id` (see
+    :func:`bench_id`) and a point appearing twice is only yielded once.
+
+    :param workload: workload description (content of run.yml).
+
+    :param workload_dir: directory of the scenarios and plugins.
+
+    :param reset: whether the points of the first scenario of each type
+        reset the benchmark environment.
+    """
+    seen = set()
+    for bench_type, desc in workload.items():
+        top_args = desc.get("args", {})
+        top_enabled = desc.get("enabled", True)
+        for idx, scenario in enumerate(desc.get("scenarios", [])):
+            if not (top_enabled and scenario.get("enabled", True)):
+                continue
+            # merging args
+            args = dict(top_args)
+            args.update(scenario.get("args", {}))
+            for a in cartesian(args):
+                # NOTE(msimonin) all the scenarios and plugins
+                # must reside on the workload directory
+                bench = {
+                    'type': bench_type,
+                    'scenario_location': os.path.join(workload_dir,
+                                                      scenario["file"]),
+                    'file': scenario["file"],
+                    'args': a,
+                    'reset': bool(reset and idx == 0)
+                }
+                if "plugin" in scenario:
+                    plugin = os.path.join(workload_dir, scenario["plugin"])
+                    if os.path.isdir(plugin):
+                        plugin = plugin + "/"
+                    bench['plugin_location'] = plugin
+
+                bench['id'] = bench_id(bench)
+                if bench['id'] in seen:
+                    logging.debug("Skipping duplicated bench %s" % bench)
+                    continue
+                seen.add(bench['id'])
+                yield bench
+
+
+def load_bench_journal(resultdir):
+    "Returns the ids of the points completed in resultdir."
+    journal_path = os.path.join(resultdir, BENCH_JOURNAL)
+    if not os.path.isfile(journal_path):
+        return set()
+    with open(journal_path) as f:
+        return set(json.loads(line)['id'] for line in f if line.strip())
+
+
+def _journal(resultdir, record):
+    with open(os.path.join(resultdir, BENCH_JOURNAL), 'a') as f:
+        f.write(json.dumps({k: record[k] for k in
+                            ['id', 'type', 'file', 'args']},
+                           sort_keys=True) + "\n")
+
+
+def get_bench_hosts(inventory_path):
+    "Returns the name of the hosts in the bench group of the inventory."
+    inventory = InventoryManager(loader=DataLoader(), sources=inventory_path)
+    return [host.get_name() for host in inventory.get_hosts(BENCH_GROUP)]
+
+
+class AnsibleSession(object):
+    """Runs playbooks against an inventory loaded once.
+
+    Unlike `enoslib.api.run_ansible`, the loader and the inventory are
+    built once and reused by every call to :meth:`run`. Facts are kept
+    by the fact cache of the Ansible configuration: the bench workers
+    set a jsonfile cache with smart gathering (see :class:`BenchWorker`)
+    so that facts are gathered once for all the runs.
+    """
+
+    def __init__(self, inventory_path):
+        self.loader = DataLoader()
+        self.loader.set_basedir('.')
+        self.inventory = InventoryManager(loader=self.loader,
+                                          sources=inventory_path)
+        self.options = Options(
+            listtags=False, listtasks=False, listhosts=False, syntax=False,
+            connection='ssh', module_path=None, forks=100,
+            private_key_file=None, ssh_common_args=None,
+            ssh_extra_args=None, sftp_extra_args=None, scp_extra_args=None,
+            become=None, become_method='sudo', become_user='root',
+            remote_user=None, verbosity=2, check=False, tags=[], diff=None,
+            basedir='.')
+
+    def run(self, playbook_path, extra_vars):
+        """Runs a playbook with the given extra vars.
+
+        Raises `EnosFailedHostsError` or `EnosUnreachableHostsError` (with
+        the hosts of the playbook) like `ansible-playbook` exits with an
+        error: the failed hosts are reported in the output of Ansible.
+        """
+        logging.info("Running playbook %s with vars:\n%s" %
+                     (playbook_path, extra_vars))
+        # A variable manager per run: registered variables must not leak
+        # from one run to the next
+        variable_manager = VariableManager(loader=self.loader,
+                                           inventory=self.inventory)
+        variable_manager.safe_basedir = True
+        variable_manager.extra_vars = extra_vars
+        pbex = PlaybookExecutor(playbooks=[playbook_path],
+                                inventory=self.inventory,
+                                variable_manager=variable_manager,
+                                loader=self.loader,
+                                options=self.options,
+                                passwords={})
+        result = pbex.run()
+        if result == TaskQueueManager.RUN_OK:
+            return
+        hosts = [extra_vars.get('bench_host', BENCH_GROUP)]
+        if result == TaskQueueManager.RUN_UNREACHABLE_HOSTS:
+            logging.error("Unreachable hosts in %s" % hosts)
+            raise EnosUnreachableHostsError(hosts)
+        logging.error("Failed hosts in %s" % hosts)
+        raise EnosFailedHostsError(hosts)
+
+
+# Sessions of the current process, see `get_session`
+_SESSIONS = {}
+
+
+def get_session(inventory_path):
+    """Returns the session of the current process for this inventory.
+
+    The session is created on the first call, so that each worker
+    process of the bench scheduler gets its own.
+    """
+    if inventory_path not in _SESSIONS:
+        _SESSIONS[inventory_path] = AnsibleSession(inventory_path)
+    return _SESSIONS[inventory_path]
+
+
+def _new_record(bench, bench_host):
+    return {
+        'id': bench['id'],
+        'type': bench['type'],
+        'file': bench['file'],
+        'args': bench['args'],
+        'reset': bench['reset'],
+        'host': bench_host,
+        'start': time.time()
+    }
+
+
+def _end_record(record, error=None):
+    if error is None:
+        record['status'] = STATUS_OK
+    else:
+        logging.error("Bench %s with args %s failed: %s" %
+                      (record['file'], record['args'], error))
+        record['status'] = STATUS_FAILED
+        record['error'] = repr(error)
+    record['end'] = time.time()
+    record['duration'] = record['end'] - record['start']
+    return record
+
+
+def run_bench(playbook_values, inventory_path, bench_host=None,
+              playbook_path=RUN_BENCH):
+    """Runs one point of the workload.
+
+    The point is described by the `bench` key of `playbook_values`. If
+    `bench_host` is set, the run-bench playbook is limited to this host,
+    otherwise it targets all the bench hosts. The playbook runs in the
+    Ansible session of the current process (see :func:`get_session`).
+
+    Never raises: the outcome is reported in the returned record so
+    that this function can safely be called from a worker process.
+    """
+    extra_vars = dict(playbook_values)
+    if bench_host is not None:
+        extra_vars.update(bench_host=bench_host)
+
+    record = _new_record(playbook_values['bench'], bench_host)
+    try:
+        session = get_session(inventory_path)
+        session.run(playbook_path, extra_vars)
+    except Exception as e:
+        return _end_record(record, e)
+    return _end_record(record)
+
+
+def serve(inventory_path, playbook_path, bench_host=None):
+    """Runs the points read on stdin and writes their records on stdout.
+
+    Main loop of the worker processes (see :class:`BenchWorker`), one
+    JSON document per line. The output of Ansible goes to stderr.
+    """
+    records = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    for line in iter(sys.stdin.readline, ''):
+        record = run_bench(json.loads(line), inventory_path,
+                           bench_host=bench_host,
+                           playbook_path=playbook_path)
+        records.write(json.dumps(record, sort_keys=True) + '\n')
+        records.flush()
+
+
+class BenchWorker(object):
+    """Runs points on a bench host from a worker process.
+
+    The worker is a plain child process, not a daemonic
+    `multiprocessing` one, so that Ansible can start its own processes
+    in it. It keeps its Ansible session from one point to the next (see
+    :func:`serve`).
+
+    If `fact_cache_dir` is set, the facts of the hosts are stored in this
+    directory (jsonfile fact cache) and only gathered for the hosts that
+    are not in the cache yet (smart gathering). This is set in the
+    environment of the worker, where Ansible reads its configuration.
+    """
+
+    def __init__(self, inventory_path, bench_host=None,
+                 fact_cache_dir=None):
+        self.bench_host = bench_host
+        env = dict(os.environ)
+        # The worker imports enos from the same place as this process
+        python_path = [os.path.dirname(ENOS_PATH)]
+        if os.environ.get('PYTHONPATH'):
+            python_path.append(os.environ['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(python_path)
+        if fact_cache_dir is not None:
+            env.update(ANSIBLE_CACHE_PLUGIN='jsonfile',
+                       ANSIBLE_CACHE_PLUGIN_CONNECTION=fact_cache_dir,
+                       ANSIBLE_GATHERING='smart')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'enos.utils.bench', inventory_path,
+             RUN_BENCH, bench_host or ''],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+            universal_newlines=True)
+
+    def run(self, playbook_values):
+        """Runs a point in the worker and returns its record."""
+        record = _new_record(playbook_values['bench'], self.bench_host)
+        try:
+            self.process.stdin.write(json.dumps(playbook_values) + '\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (IOError, OSError) as e:
+            return _end_record(record, e)
+        if not line:
+            return _end_record(record, EnosError(
+                "The bench worker of %s exited with %s" %
+                (self.bench_host, self.process.wait())))
+        return json.loads(line)
+
+    def stop(self):
+        """Stops the worker once its current point is completed."""
+        self.process.stdin.close()
+        self.process.wait()
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+def load_bench_index(resultdir):
+    "Returns the records of the bench index of resultdir (if any)."
+    index_path = os.path.join(resultdir, BENCH_INDEX)
+    if not os.path.isfile(index_path):
+        return []
+    with open(index_path) as f:
+        return json.load(f)['benchs']
+
+
+def write_bench_index(resultdir, records):
+    "Writes the records of the run points in the bench index of resultdir."
+    index_path = os.path.join(resultdir, BENCH_INDEX)
+    with open(index_path, 'w') as f:
+        json.dump({'benchs': records}, f, indent=2, sort_keys=True)
+    logging.info("Bench index written to %s" % index_path)
+    return index_path
+
+
+def schedule_benchs(benchs, playbook_values, inventory_path, resultdir,
+                    hosts=None, resume=False):
+    """Runs all the points of a workload.
+
+    :param benchs: iterable of `bench` descriptions (one per point) as
+        yielded by :func:`expand_workload`.
+
+    :param playbook_values: values passed to the run-bench playbook.
+
+    :param inventory_path: path to the inventory.
+
+    :param resultdir: directory where the bench index and journal are
+        written, and the facts of the hosts cached.
+
+    :param hosts: bench hosts to spread the points on. When `None`,
+        points run one after the other on all the bench hosts. Otherwise
+        a worker process (see :class:`BenchWorker`) is started per host
+        and each point is pinned to the first available host.
+
+    :param resume: skip the points already completed in resultdir
+        according to the bench journal. Otherwise the journal is reset.
+
+    Points with `reset` set act as a barrier: every running point
+    completes before they run alone on all the bench hosts, and no
+    further point starts before they finish.
+
+    The scheduling stops at the first failed point and raises an
+    `EnosError` once the running points are completed. In any case, the
+    records of the run points are written in the bench index.
+    """
+    previous = []
+    completed = set()
+    if resume:
+        completed = load_bench_journal(resultdir)
+        previous = [r for r in load_bench_index(resultdir)
+                    if r.get('id') in completed]
+        logging.info("Resuming bench, %s point(s) already completed" %
+                     len(completed))
+    else:
+        open(os.path.join(resultdir, BENCH_JOURNAL), 'w').close()
+
+    records = []
+
+    def _done(record):
+        if record['status'] == STATUS_OK:
+            _journal(resultdir, record)
+        records.append(record)
+
+    fact_cache_dir = os.path.join(resultdir, BENCH_FACTS)
+    pending = (b for b in benchs if b['id'] not in completed)
+    workers = {}
+
+    def _worker(host):
+        if host not in workers:
+            workers[host] = BenchWorker(inventory_path, bench_host=host,
+                                        fact_cache_dir=fact_cache_dir)
+        return workers[host]
+
+    try:
+        _dispatch(pending, playbook_values, hosts or [], _worker, _done,
+                  records)
+    except BaseException:
+        for worker in workers.values():
+            worker.kill()
+        raise
+    finally:
+        for worker in workers.values():
+            worker.stop()
+        write_bench_index(resultdir, previous + records)
+
+    failed = _failed(records)
+    if failed:
+        raise EnosError("%s bench(s) failed, see %s" %
+                        (len(failed), os.path.join(resultdir, BENCH_INDEX)))
+    return records
+
+
+def _failed(records):
+    return [r for r in records if r['status'] == STATUS_FAILED]
+
+
+def _dispatch(benchs, playbook_values, hosts, worker, done, records):
+    """Dispatches the points on the free bench hosts.
+
+    Reset points, and every point when there is no host, run alone on
+    the worker of all the bench hosts. `worker` returns the worker of a
+    host (`None` for all of them) and `done` is called with the record of
+    each run point, from the calling thread.
+    """
+    free = list(hosts)
+    results = queue.Queue()
+    running = [0]
+
+    def _run(host, worker, values):
+        # Always put a record, so that the host is freed
+        try:
+            record = worker.run(values)
+        except Exception as e:
+            record = _end_record(_new_record(values['bench'], host), e)
+        results.put(record)
+
+    def _wait():
+        # Waits for a running point
+        record = results.get()
+        running[0] -= 1
+        done(record)
+        free.append(record['host'])
+
+    for bench in benchs:
+        values = dict(playbook_values, bench=bench)
+        if bench['reset'] or not hosts:
+            while running[0]:
+                _wait()
+            if _failed(records):
+                break
+            done(worker(None).run(values))
+            continue
+        if not free:
+            _wait()
+        if _failed(records):
+            break
+        host = free.pop(0)
+        logging.info("Scheduling bench %s with args %s on %s" %
+                     (bench['file'], bench['args'], host))
+        thread = threading.Thread(target=_run,
+                                  args=(host, worker(host), values))
+        thread.daemon = True
+        thread.start()
+        running[0] += 1
+    while running[0]:
+        _wait()
+
+
+if __name__ == '__main__':
+    serve(*[arg or None for arg in sys.argv[1:]])
@@ -1,8 +1,49 @@
 # -*- coding: utf-8 -*-
+from enoslib.task import _set_resultdir
+
 from enos.utils.constants import SYMLINK_NAME
+from enos.utils.envstore import ENV_FILE, make_env, save_env
+
+from functools import wraps
+import logging
 import os
 
 
+def enostask(new=False, keys=None, save=True):
+    """Decorator for an Enos Task.
+
+    Same as `enoslib.task.enostask` but the environment is kept in the env
+    store (see `enos.utils.envstore`).
+
+    If `keys` is set, only these keys of the environment are loaded. Such
+    a task (like a task with `save=False`) cannot change the environment:
+    it is not saved.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def decorated(*args, **kwargs):
+            # Constructs the environment
+            # --env or env are reserved keyword to reuse existing env
+            k_env = kwargs.get('--env') or kwargs.get('env')
+            if new:
+                kwargs['env'] = make_env(k_env)
+                kwargs['env']['resultdir'] = _set_resultdir(k_env)
+            else:
+                kwargs['env'] = make_env(k_env or SYMLINK_NAME, keys=keys)
+            try:
+                # Proceeds with the function execution
+                logging.info("- Task %s started -" % fn.__name__)
+                r = fn(*args, **kwargs)
+                logging.info("- Task %s finished -" % fn.__name__)
+                return r
+            # Save the environment
+            finally:
+                if save and keys is None:
+                    save_env(kwargs['env'])
+        return decorated
+    return decorator
+
+
 def check_env(fn):
     """Decorator for an Enos Task.
 
@@ -13,7 +54,7 @@ def check_env(fn):
         # If no directory is provided, set the default one
         resultdir = kwargs.get('--env', SYMLINK_NAME) or SYMLINK_NAME
         # Check if the env file exists
-        env_path = os.path.join(resultdir, 'env')
+        env_path = os.path.join(resultdir, ENV_FILE)
         if not os.path.isfile(env_path):
             raise Exception("The file %s does not exist." % env_path)
 
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import yaml
+
+from enoslib.host import Host as EnoslibHost
+
+from enos.provider.host import Host as EnosHost
+
+try:
+    STRING_TYPES = (basestring,)  # noqa
+except NameError:
+    STRING_TYPES = (str,)
+
+# Types stored as is
+SCALAR_TYPES = (bool, int, float, type(None)) + STRING_TYPES
+
+# Name of the env file in the result dir
+ENV_FILE = 'env'
+
+# Version of the format of the env file
+ENV_VERSION = 1
+
+# First line of the env file, older env files are YAML documents
+HEADER = '# enos env %d\n'
+
+# Key of the line holding the hosts referenced by the other lines
+HOSTS = '__hosts__'
+
+# Classes of the hosts stored as records (see `_Encoder`)
+HOST_CLASSES = {
+    'enoslib.host.Host': EnoslibHost,
+    'enos.provider.host.Host': EnosHost
+}
+
+HOST_FIELDS = ('address', 'alias', 'user', 'keyfile', 'port', 'extra')
+
+
+def _class_name(value):
+    return '%s.%s' % (type(value).__module__, type(value).__name__)
+
+
+class _Encoder(object):
+    """Turns env values into JSON values.
+
+    Hosts are stored once (as a list of their fields) in `hosts` and
+    referenced by index, so that a host in several roles is still a single
+    object once loaded. Tuples are tagged, any other object is stored as a
+    YAML document.
+    """
+
+    def __init__(self):
+        self.hosts = []
+        self.index = {}
+
+    def host(self, value):
+        i = self.index.get(id(value))
+        if i is None:
+            i = self.index[id(value)] = len(self.hosts)
+            record = [self.encode(getattr(value, f)) for f in HOST_FIELDS]
+            self.hosts.append([_class_name(value)] + record)
+        return {'__host__': i}
+
+    def encode(self, value):
+        if isinstance(value, SCALAR_TYPES):
+            return value
+        if isinstance(value, list):
+            return [self.encode(v) for v in value]
+        if isinstance(value, tuple):
+            return {'__tuple__': [self.encode(v) for v in value]}
+        if isinstance(value, dict) and \
+           all(isinstance(k, STRING_TYPES) for k in value):
+            return dict((k, self.encode(v)) for k, v in value.items())
+        if _class_name(value) in HOST_CLASSES:
+            return self.host(value)
+        return {'__yaml__': yaml.dump(value)}
+
+
+class _Decoder(object):
+    """Turns the JSON values of `_Encoder` back into env values.
+
+    The hosts are only made when a value references them.
+    """
+
+    def __init__(self, hosts_line):
+        self.hosts_line = hosts_line
+        self.hosts = None
+
+    def host(self, i):
+        if self.hosts is None:
+            self.hosts = []
+            for record in json.loads(self.hosts_line or '[]',
+                                     object_hook=self.object_hook):
+                cls = HOST_CLASSES[record[0]]
+                self.hosts.append(cls(**dict(zip(HOST_FIELDS, record[1:]))))
+        return self.hosts[i]
+
+    def object_hook(self, value):
+        if len(value) == 1:
+            if '__host__' in value:
+                return self.host(value['__host__'])
+            if '__tuple__' in value:
+                return tuple(value['__tuple__'])
+            if '__yaml__' in value:
+                return yaml.load(value['__yaml__'], Loader=yaml.Loader)
+        return value
+
+    def decode(self, line):
+        return json.loads(line, object_hook=self.object_hook)
+
+
+def load_env(resultdir, keys=None):
+    """Loads the env stored in resultdir (an empty dict if there is none).
+
+    Only the `keys` of the env are decoded if set. Env files written
+    before the store (YAML documents) are loaded as a whole.
+    """
+    env_path = os.path.join(resultdir, ENV_FILE)
+    if not os.path.isfile(env_path):
+        return {}
+    with open(env_path, 'r') as f:
+        header = f.readline()
+        if not header.startswith(HEADER.split('%')[0]):
+            f.seek(0)
+            logging.debug("Loading legacy environment %s" % env_path)
+            return yaml.load(f, Loader=yaml.Loader) or {}
+        version = int(header.split()[-1])
+        if version > ENV_VERSION:
+            raise Exception("%s has been written by a newer enos (version "
+                            "%s of the env)" % (env_path, version))
+        lines = {}
+        for line in f:
+            key, _, data = line.rstrip('\n').partition('\t')
+            if key == HOSTS or keys is None or key in keys:
+                lines[key] = data
+
+    decoder = _Decoder(lines.pop(HOSTS, None))
+    env = dict((k, decoder.decode(v)) for k, v in lines.items())
+    logging.debug("Loaded environment %s (%s)" % (env_path,
+                                                  keys or 'all keys'))
+    return env
+
+
+def save_env(env):
+    """Saves env in its result dir.
+
+    The env file is replaced atomically, so that a concurrent task never
+    reads a partial env.
+    """
+    resultdir = env['resultdir']
+    if not os.path.isdir(resultdir):
+        return
+    env_path = os.path.join(resultdir, ENV_FILE)
+    encoder = _Encoder()
+    lines = ['%s\t%s\n' % (k, json.dumps(encoder.encode(v), sort_keys=True,
+                                         separators=(',', ':')))
+             for k, v in sorted(env.items())]
+    tmp_path = '%s.%s' % (env_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(HEADER % ENV_VERSION)
+        f.write('%s\t%s\n' % (HOSTS, json.dumps(encoder.hosts,
+                                                separators=(',', ':'))))
+        f.writelines(lines)
+    os.rename(tmp_path, env_path)
+
+
+def make_env(resultdir=None, keys=None):
+    """Loads the env from `resultdir` if not `None` or makes a new one.
+
+    Like `enoslib.task._make_env`, the configuration is read again from
+    the configuration file of the env. Only the `keys` of the env are
+    loaded if set (see `load_env`).
+    """
+    env = {
+        'config':      {},          # The config
+        'resultdir':   '',          # Path to the result directory
+        'config_file': '',          # The initial config file
+        'nodes':       {},          # Roles with nodes
+        'phase':       '',          # Last phase that have been run
+        'user':        '',          # User id for this job
+        'cwd':         os.getcwd()  # Current Working Directory
+    }
+
+    if resultdir:
+        if keys is not None:
+            keys = set(keys) | set(['resultdir', 'config_file', 'cwd'])
+        env.update(load_env(resultdir, keys))
+
+        # Resets the configuration of the environment
+        if os.path.isfile(env['config_file']) and \
+           (keys is None or 'config' in keys):
+            with open(env['config_file'], 'r') as f:
+                env['config'].update(yaml.load(f, Loader=yaml.Loader))
+                logging.debug("Reloaded config %s", env['config'])
+
+    return env
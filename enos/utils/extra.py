@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 import copy
-import enoslib.api as api
 from .errors import (EnosProviderMissingConfigurationKeys,
                      EnosFilePathError)
+from .inventory import write_inventory
 from .constants import (ENOS_PATH, ANSIBLE_DIR, VENV_KOLLA,
                         NEUTRON_EXTERNAL_INTERFACE,
                         FAKE_NEUTRON_EXTERNAL_INTERFACE, NETWORK_INTERFACE,
                         API_INTERFACE)
-from netaddr import IPRange
 
+import hashlib
+import json
 import logging
 import os
+import pickle
 from subprocess import check_call
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 # These roles are mandatory for the
 # the original inventory to be valid
 # Note that they may be empty
@@ -26,13 +33,28 @@ KOLLA_MANDATORY_GROUPS = [
     "storage"
 ]
 
+# Snapshot (in the result dir) of the parsed kolla-ansible defaults
+KOLLA_DEFAULTS_SNAPSHOT = 'kolla_defaults.pickle'
+
+# Parsed kolla-ansible defaults, by path (see `load_kolla_defaults`)
+_KOLLA_DEFAULTS = {}
+
+# Snapshot (in the result dir) of the last enos values built, with the
+# digest of their inputs (see `mk_enos_values`)
+ENOS_VALUES_SNAPSHOT = 'enos_values.pickle'
+
+# Enos values already built, by digest of their inputs
+_ENOS_VALUES = {}
+
 
 def generate_inventory(roles, networks, base_inventory, dest):
     """
     Generate the inventory.
     It will generate a group for each role in roles and
     concatenate them with the base_inventory file.
-    The generated inventory is written in dest
+    The generated inventory is written in dest, along with its JSON form
+    (see `enos.utils.inventory`), only if it changed.
+    Returns the digest of the inventory.
     """
     # NOTE(msimonin): if len(networks) is <= 1
     # provision a fake one that will map the external network
@@ -46,28 +68,26 @@ def generate_inventory(roles, networks, base_inventory, dest):
         fake_interfaces = [FAKE_NEUTRON_EXTERNAL_INTERFACE]
         fake_networks = [NEUTRON_EXTERNAL_INTERFACE]
 
+    # Sets the network interfaces of the hosts (in their extra). This needs
+    # an inventory of the hosts, not the one of dest that is only written
+    # if it changed.
+    # Imported here since it imports ansible (see `enos.cli`)
+    import enoslib.api as api
+    check_inventory = '%s.check' % dest
     api.generate_inventory(
         roles,
         networks,
-        dest,
+        check_inventory,
         check_networks=True,
         fake_interfaces=fake_interfaces,
         fake_networks=fake_networks
     )
+    os.remove(check_inventory)
 
-    with open(dest, 'a') as f:
-        f.write("\n")
-        # generate mandatory groups that are empty
-        mandatory = [group for group in KOLLA_MANDATORY_GROUPS
-                       if group not in roles.keys()]
-        for group in mandatory:
-            f.write("[%s]\n" % group)
-
-        with open(base_inventory, 'r') as a:
-            for line in a:
-                f.write(line)
-
-    logging.info("Inventory file written to " + dest)
+    digest = write_inventory(roles, base_inventory, KOLLA_MANDATORY_GROUPS,
+                             dest)
+    logging.info("Inventory file written to %s (%s)" % (dest, digest))
+    return digest
 
 
 def get_kolla_required_values(env):
@@ -107,7 +127,69 @@ based on the Enos environment.
     return values
 
 
-def mk_kolla_values(src_path, required_values, user_values):
+def _sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _load_snapshot(snapshot_path):
+    try:
+        with open(snapshot_path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def _kolla_defaults(src_path, snapshot_dir=None):
+    # Cache entry (path, mtime, size, sha1, values) of the kolla defaults
+    path = os.path.abspath(os.path.join(src_path, 'ansible', 'group_vars',
+                                        'all.yml'))
+    stat = os.stat(path)
+    key = {'path': path, 'mtime': stat.st_mtime, 'size': stat.st_size}
+    snapshot_path = None
+    if snapshot_dir is not None:
+        snapshot_path = os.path.join(snapshot_dir, KOLLA_DEFAULTS_SNAPSHOT)
+
+    cached = _KOLLA_DEFAULTS.get(path)
+    if cached is None and snapshot_path is not None:
+        cached = _load_snapshot(snapshot_path)
+    if cached is not None and cached.get('path') == path:
+        if all(cached[k] == v for k, v in key.items()):
+            _KOLLA_DEFAULTS[path] = cached
+            return cached
+        key['sha1'] = _sha1(path)
+        if cached['sha1'] == key['sha1']:
+            cached.update(key)
+            _KOLLA_DEFAULTS[path] = cached
+            return cached
+
+    logging.debug("Parsing kolla defaults %s" % path)
+    with open(path, 'r') as f:
+        values = yaml.load(f, Loader=SafeLoader)
+    cached = dict(key, sha1=key.get('sha1') or _sha1(path), values=values)
+    _KOLLA_DEFAULTS[path] = cached
+    if snapshot_path is not None:
+        with open(snapshot_path, 'wb') as f:
+            pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+    return cached
+
+
+def load_kolla_defaults(src_path, snapshot_dir=None):
+    """Returns the values of kolla-ansible `group_vars/all.yml`.
+
+    The file is only parsed again when it changed: the parsed values are
+    kept in memory and, if `snapshot_dir` is set, in a snapshot
+    (KOLLA_DEFAULTS_SNAPSHOT) that is faster to load than the YAML. Both
+    are keyed by the path, mtime and size of the file, and by its sha1
+    when the mtime changed (e.g. sources checked out again).
+
+    The returned dict is shared and must not be modified.
+    """
+    return _kolla_defaults(src_path, snapshot_dir=snapshot_dir)['values']
+
+
+def mk_kolla_values(src_path, required_values, user_values,
+                    snapshot_dir=None):
     """Builds a dictionary with all kolla values.
 
     :param src_path: Path to kolla-ansible sources.
@@ -117,14 +199,16 @@ def mk_kolla_values(src_path, required_values, user_values):
     :param user_values: User specic kolla values as defined into
         the reservation file.
 
+    :param snapshot_dir: Directory of the snapshot of the kolla-ansible
+        defaults (see `load_kolla_defaults`).
+
     return values related to kolla-ansible
     """
     kolla_values = {}
 
     # Get kolla-ansible `all.yml` values
-    with open(os.path.join(
-            src_path, 'ansible', 'group_vars', 'all.yml'), 'r') as f:
-        kolla_values.update(yaml.load(f))
+    kolla_values.update(load_kolla_defaults(src_path,
+                                            snapshot_dir=snapshot_dir))
 
     # Override with required values
     kolla_values.update(required_values)
@@ -136,29 +220,55 @@ def mk_kolla_values(src_path, required_values, user_values):
 
 
 def mk_enos_values(env):
-    "Builds a dictionary with all enos values based on the environment."
-    enos_values = {}
-
-    # Get all kolla values
-    enos_values.update(mk_kolla_values(
-        os.path.join(env['resultdir'], 'kolla'),
-        get_kolla_required_values(env),
-        env['config']['kolla']))
-
-    # Update with user specific values (except already got kolla)
-    enos_values.update(
-        {k: v for k, v in env['config'].items() if k != "kolla"})
-
-    # Add the Current Working Directory (cwd)
-    enos_values.update(cwd=env['cwd'])
+    """Builds a dictionary with all enos values based on the environment.
 
-    # Defer the following variables to the environment
-    # These two interfaces are set in the host vars
-    # We don't need them here since they will overwrite those in the inventory
-    enos_values.pop(NEUTRON_EXTERNAL_INTERFACE, None)
-    enos_values.pop(NETWORK_INTERFACE, None)
-
-    return enos_values
+    The values are only built again if the kolla defaults or the
+    configuration changed: they are kept in memory and in a snapshot in
+    the result dir (ENOS_VALUES_SNAPSHOT), so that the next phases (other
+    processes) reuse them. Each call returns a (shallow) copy of them.
+    """
+    kolla_path = os.path.join(env['resultdir'], 'kolla')
+    defaults = _kolla_defaults(kolla_path, snapshot_dir=env['resultdir'])
+    inputs = json.dumps([defaults['sha1'], env['resultdir'], env['cwd'],
+                         env['config']], sort_keys=True, default=str)
+    digest = hashlib.sha1(inputs.encode('utf-8')).hexdigest()
+    snapshot_path = os.path.join(env['resultdir'], ENOS_VALUES_SNAPSHOT)
+
+    if digest not in _ENOS_VALUES:
+        snapshot = _load_snapshot(snapshot_path)
+        if snapshot is not None and snapshot.get('digest') == digest:
+            _ENOS_VALUES[digest] = snapshot['values']
+
+    if digest not in _ENOS_VALUES:
+        enos_values = {}
+
+        # Get all kolla values
+        enos_values.update(mk_kolla_values(
+            kolla_path,
+            get_kolla_required_values(env),
+            env['config']['kolla'],
+            snapshot_dir=env['resultdir']))
+
+        # Update with user specific values (except already got kolla)
+        enos_values.update(
+            {k: v for k, v in env['config'].items() if k != "kolla"})
+
+        # Add the Current Working Directory (cwd)
+        enos_values.update(cwd=env['cwd'])
+
+        # Defer the following variables to the environment
+        # These two interfaces are set in the host vars
+        # We don't need them here since they will overwrite those in the
+        # inventory
+        enos_values.pop(NEUTRON_EXTERNAL_INTERFACE, None)
+        enos_values.pop(NETWORK_INTERFACE, None)
+
+        _ENOS_VALUES[digest] = enos_values
+        with open(snapshot_path, 'wb') as f:
+            pickle.dump({'digest': digest, 'values': enos_values}, f,
+                        pickle.HIGHEST_PROTOCOL)
+
+    return dict(_ENOS_VALUES[digest])
 
 
 # TODO(rcherrueau): Remove this helper function and move code into
@@ -194,9 +304,31 @@ def bootstrap_kolla(env):
     enos_values = mk_enos_values(env)
     playbook = os.path.join(ANSIBLE_DIR, 'bootstrap_kolla.yml')
 
+    import enoslib.api as api
     api.run_ansible([playbook], env['inventory'], extra_vars=enos_values)
 
 
+def bootstrap_digest(env, commit):
+    """Returns a digest of what `bootstrap_kolla` depends on.
+
+    That is the commit of the kolla-ansible checkout, the enos values and
+    the bootstrap_kolla role (patches, templates). Kolla needs to be
+    bootstrapped again only if it changed.
+    """
+    digest = hashlib.sha1(commit.encode('utf-8'))
+    digest.update(json.dumps(mk_enos_values(env), sort_keys=True,
+                             default=str).encode('utf-8'))
+    role_path = os.path.join(ANSIBLE_DIR, 'roles', 'bootstrap_kolla')
+    for root, dirs, files in os.walk(role_path):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, role_path).encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
 def lookup_network(networks, roles):
     """Lookup a network by its roles (in order).
     We assume that one role can't be found in two different networks
@@ -222,32 +354,6 @@ def get_vip_pool(networks):
     raise Exception(msg)
 
 
-def pop_ip(provider_net):
-    """Picks an ip from the provider_net
-    It will first take ips in the extra_ips if possible.
-    extra_ips is a list of isolated ips whereas ips described
-    by the [provider_net.start, provider.end] range is a continuous
-    list of ips.
-    """
-    # Construct the pool of ips
-    extra_ips = provider_net.get('extra_ips', [])
-    if len(extra_ips) > 0:
-        ip = extra_ips.pop()
-        provider_net['extra_ips'] = extra_ips
-        return ip
-
-    ips = list(IPRange(provider_net['start'],
-                       provider_net['end']))
-
-    # Get the next ip
-    ip = str(ips.pop())
-
-    # Remove this ip from the env
-    provider_net['end'] = str(ips.pop())
-
-    return ip
-
-
 def make_provider(provider_conf):
     """Instantiates the provider.
 
@@ -381,4 +487,8 @@ def check_call_in_venv(venv_dir, cmd):
 
 
 def in_kolla(cmd):
+    if isinstance(cmd, list):
+        # Phase of the task metrics of kolla-ansible, unless overridden (see
+        # the influxdb_events callback)
+        cmd = ['ENOS_PHASE=${ENOS_PHASE:-os}'] + cmd
     check_call_in_venv(VENV_KOLLA, cmd)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from .constants import ANSIBLE_DIR
+
+import hashlib
+import json
+import os
+import re
+
+# Key of the env holding the fingerprints of the roles run by `enos up`
+UP_FINGERPRINTS = 'up_fingerprints'
+
+# Roles of the up playbook, each one is tagged with its name
+UP_ROLES = ['common', 'registry', 'influx', 'cadvisor', 'collectd', 'grafana']
+
+# Changes on each boot of a host (raw: python may not be installed yet)
+BOOT_ID = 'cat /proc/sys/kernel/random/boot_id'
+
+
+def _role_files(role):
+    role_path = os.path.join(ANSIBLE_DIR, 'roles', role)
+    for root, dirs, files in os.walk(role_path):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(('.pyc', '.pyo')):
+                yield os.path.join(root, name)
+
+
+def boot_ids(inventory):
+    """Returns the boot id of each host of the inventory (alias -> id).
+
+    Hosts rebooted or deployed again (e.g. in a new reservation) get a new
+    boot id, even with the same alias and address.
+    """
+    # Imported here since it imports ansible (see `enos.task`)
+    from enoslib.api import STATUS_OK, run_play
+    play = {
+        'hosts': 'all',
+        'gather_facts': False,
+        'tasks': [{'name': 'Boot id', 'raw': BOOT_ID}]
+    }
+    return dict((r.host, r.payload['stdout'].strip())
+                for r in run_play('all', play, inventory)
+                if r.status == STATUS_OK)
+
+
+def role_fingerprint(role, playbook, inventory, config, boot_ids=None):
+    """Returns the fingerprint of the inputs of a role of a playbook.
+
+    That is the files of the playbook, of the role and of the group_vars,
+    the inventory, the values of the configuration keys that appear in
+    these files and the boot ids of the hosts (see `boot_ids`). A role
+    run with the same fingerprint gives the same result.
+    """
+    digest = hashlib.sha1()
+    texts = []
+    group_vars = os.path.join(ANSIBLE_DIR, 'group_vars', 'all.yml')
+    for path in [playbook, group_vars] + list(_role_files(role)):
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest.update(os.path.relpath(path, ANSIBLE_DIR).encode('utf-8'))
+        digest.update(content)
+        texts.append(content.decode('utf-8', 'replace'))
+
+    text = '\n'.join(texts)
+    used = dict((k, v) for k, v in config.items()
+                if re.search(r'\b%s\b' % re.escape(k), text))
+    digest.update(json.dumps(used, sort_keys=True, default=str)
+                  .encode('utf-8'))
+
+    with open(inventory, 'rb') as f:
+        digest.update(f.read())
+    digest.update(json.dumps(boot_ids or {}, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def outdated_roles(env, fingerprints):
+    """Returns the roles whose fingerprint is not the one of their last
+    successful run (in the order of UP_ROLES)."""
+    done = env.get(UP_FINGERPRINTS, {})
+    return [r for r in UP_ROLES if done.get(r) != fingerprints[r]]
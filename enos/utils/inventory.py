@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+from .envstore import ENV_FILE, load_env
+
+import hashlib
+import json
+import os
+import re
+import shlex
+
+# The JSON form of an inventory is next to its INI form
+INVENTORY_JSON = '%s.json'
+
+# Cache (in the result dir) of the dynamic inventory of the env
+INVENTORY_CACHE = 'inventory-cache.json'
+
+# Extra keys of the hosts that are not host vars (see enoslib.api)
+SSH_EXTRA_KEYS = ['gateway', 'gateway_user', 'forward_agent']
+
+SECTION = re.compile(r'^\[([^\]:]+)(?::(children|vars))?\]')
+
+
+def _ssh_common_args(host):
+    # Same as `enoslib.api._generate_inventory_string`
+    common_args = ["-o StrictHostKeyChecking=no",
+                   "-o UserKnownHostsFile=/dev/null"]
+    if host.extra.get('forward_agent', False):
+        common_args.append("-o ForwardAgent=yes")
+    gateway = host.extra.get('gateway')
+    if gateway is not None:
+        proxy_cmd = ["ssh -W %h:%p",
+                     "-o StrictHostKeyChecking=no",
+                     "-o UserKnownHostsFile=/dev/null"]
+        gateway_user = host.extra.get('gateway_user', host.user)
+        if gateway_user is not None:
+            proxy_cmd.append("-l %s" % gateway_user)
+        proxy_cmd.append(gateway)
+        common_args.append("-o ProxyCommand=\"%s\"" % " ".join(proxy_cmd))
+    return " ".join(common_args)
+
+
+def host_vars(host):
+    """Returns the (ordered) list of (var, value) of host."""
+    hvars = [('ansible_host', host.address)]
+    if host.user is not None:
+        hvars.append(('ansible_ssh_user', host.user))
+    if host.port is not None:
+        hvars.append(('ansible_port', host.port))
+    if host.keyfile is not None:
+        hvars.append(('ansible_ssh_private_key_file', host.keyfile))
+    hvars.append(('ansible_ssh_common_args', _ssh_common_args(host)))
+    hvars.extend((k, v) for k, v in sorted(host.extra.items())
+                 if k not in SSH_EXTRA_KEYS)
+    return hvars
+
+
+def _ini_value(key, value):
+    if key == 'ansible_ssh_common_args':
+        return "'%s'" % value
+    if isinstance(value, list):
+        # [a, b, c] -> "['a','b','c']"
+        return "\"[%s]\"" % ','.join("'%s'" % x for x in value)
+    return value
+
+
+def host_line(host):
+    """Returns the line of host in an INI inventory."""
+    return " ".join([host.alias] + ["%s=%s" % (k, _ini_value(k, v))
+                                    for k, v in host_vars(host)])
+
+
+def inventory_ini(roles, base_inventory, mandatory_groups):
+    """Returns the INI inventory of the roles.
+
+    The groups of the roles come first (sorted by name, the hosts keep
+    their order), then the mandatory groups without hosts and the base
+    inventory. The same roles always give the same inventory.
+    """
+    lines = []
+    for role in sorted(roles):
+        lines.append("[%s]" % role)
+        lines.extend(host_line(h) for h in roles[role])
+    lines.append("")
+    lines.extend("[%s]" % g for g in mandatory_groups if g not in roles)
+    with open(base_inventory, 'r') as f:
+        return "\n".join(lines) + "\n" + f.read()
+
+
+def _parse_vars(tokens):
+    hvars = {}
+    for token in tokens:
+        key, _, value = token.partition('=')
+        hvars[key] = value
+    return hvars
+
+
+def parse_groups(base_inventory):
+    """Returns the groups of an INI inventory.
+
+    Only the groups (with their hosts, children and vars) are parsed:
+    values are kept as strings.
+    """
+    groups = {}
+    hostvars = {}
+    group, kind = 'ungrouped', None
+    with open(base_inventory, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(('#', ';')):
+                continue
+            section = SECTION.match(line)
+            if section:
+                group, kind = section.groups()
+                groups.setdefault(group, {})
+                continue
+            entry = groups.setdefault(group, {})
+            if kind == 'children':
+                entry.setdefault('children', []).append(line.split()[0])
+            elif kind == 'vars':
+                entry.setdefault('vars', {}).update(_parse_vars([line]))
+            else:
+                tokens = shlex.split(line)
+                entry.setdefault('hosts', []).append(tokens[0])
+                hostvars.setdefault(tokens[0], {}).update(
+                    _parse_vars(tokens[1:]))
+    return groups, hostvars
+
+
+def inventory_dict(roles, base_inventory, mandatory_groups):
+    """Returns the inventory of the roles as a dynamic inventory.
+
+    This is the same inventory as `inventory_ini` in the JSON format of
+    the Ansible dynamic inventories (groups and `_meta.hostvars`), so that
+    Ansible does not have to parse it.
+    """
+    groups, hostvars = parse_groups(base_inventory)
+    for role in sorted(roles):
+        hosts = groups.setdefault(role, {}).setdefault('hosts', [])
+        for host in roles[role]:
+            if host.alias not in hosts:
+                hosts.append(host.alias)
+            hostvars.setdefault(host.alias, {}).update(host_vars(host))
+    for group in mandatory_groups:
+        groups.setdefault(group, {})
+    groups['_meta'] = {'hostvars': hostvars}
+    return groups
+
+
+def digest(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def write_if_changed(path, content):
+    """Writes content in path (atomically) unless it is already there.
+
+    Returns whether path has been written.
+    """
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    tmp_path = '%s.%s' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+    return True
+
+
+def write_inventory(roles, base_inventory, mandatory_groups, dest):
+    """Writes the inventory of the roles in dest (INI) and its JSON form.
+
+    Files are only written if their content changed, so that their mtime
+    tells when the inventory changed. Returns the digest of the INI
+    inventory.
+    """
+    ini = inventory_ini(roles, base_inventory, mandatory_groups)
+    inventory = inventory_dict(roles, base_inventory, mandatory_groups)
+    write_if_changed(INVENTORY_JSON % dest,
+                     json.dumps(inventory, indent=1, sort_keys=True))
+    write_if_changed(dest, ini)
+    return digest(ini)
+
+
+def _cache_key(resultdir, base_inventory):
+    # The env and the base inventory make the dynamic inventory
+    key = hashlib.sha1()
+    with open(os.path.join(resultdir, ENV_FILE), 'rb') as f:
+        key.update(f.read())
+    key.update(base_inventory.encode('utf-8'))
+    key.update(str(os.path.getmtime(base_inventory)).encode('utf-8'))
+    return key.hexdigest()
+
+
+def dynamic_inventory(resultdir, base_inventory, mandatory_groups):
+    """Returns the dynamic inventory (JSON) of the env of resultdir.
+
+    The inventory is made from the roles of the env (see
+    `inventory_dict`) and cached in INVENTORY_CACHE with the hash of the
+    env: it is made again only if the env (or the base inventory) changed.
+    """
+    key = _cache_key(resultdir, base_inventory)
+    cache_path = os.path.join(resultdir, INVENTORY_CACHE)
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'r') as f:
+            if f.readline().strip() == key:
+                return f.read()
+
+    env = load_env(resultdir, keys=['rsc'])
+    inventory = json.dumps(inventory_dict(env.get('rsc', {}), base_inventory,
+                                          mandatory_groups), sort_keys=True)
+    write_if_changed(cache_path, '%s\n%s' % (key, inventory))
+    return inventory
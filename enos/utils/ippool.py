@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from netaddr import IPAddress
+
+# Key of the env holding the state of the ip pools
+IP_POOLS = 'ip_pools'
+
+
+class IPPool(object):
+    """Allocates the ips of a provider network.
+
+    Ips are first taken in the isolated ips of the network (`extra_ips`)
+    and then from the end of its [start, end] range. The range is never
+    materialised: the next ip of the range is an integer decremented on
+    each allocation. `start` itself is never allocated so that the range
+    is never empty.
+
+    Ips are allocated by name: allocating a name twice gives the same ip.
+    Released ips are allocated again first. Reserved ips are never
+    allocated.
+
+    The state of the pool is a plain dict (see :func:`get_ip_pool` to keep
+    it in the env). If `network` is given, its `end` is updated so that the
+    range only contains the ips that have not been allocated yet (e.g. for
+    the allocation pool of neutron).
+    """
+
+    def __init__(self, state, network=None):
+        self.state = state
+        self.network = network
+        self._sync_network()
+
+    @staticmethod
+    def new_state(network):
+        "Returns the state of a new pool of the ips of network."
+        start = IPAddress(network['start'])
+        return {
+            'cidr': network.get('cidr'),
+            'version': start.version,
+            'start': int(start),
+            'next': int(IPAddress(network['end'])),
+            'free': list(network.get('extra_ips', [])),
+            'reserved': [],
+            'allocated': {}
+        }
+
+    def _ip(self, value):
+        return str(IPAddress(value, version=self.state['version']))
+
+    def _sync_network(self):
+        if self.network is not None:
+            self.network['end'] = self._ip(self.state['next'])
+
+    def _pop_range(self):
+        state = self.state
+        reserved = state['reserved']
+        while state['next'] > state['start']:
+            ip = self._ip(state['next'])
+            state['next'] -= 1
+            if ip in reserved:
+                reserved.remove(ip)
+                continue
+            self._sync_network()
+            return ip
+        raise Exception("No more ip available in %s" % state['cidr'])
+
+    def allocate(self, name=None):
+        """Allocates an ip to name (the ip itself if `None`).
+
+        Returns the ip already allocated to name, if any.
+        """
+        allocated = self.state['allocated']
+        if name in allocated:
+            return allocated[name]
+        if self.state['free']:
+            ip = self.state['free'].pop()
+        else:
+            ip = self._pop_range()
+        allocated[name or ip] = ip
+        return ip
+
+    def reserve(self, ip, name=None):
+        """Marks ip as allocated (to name) so that it is never allocated."""
+        ip = str(ip)
+        state = self.state
+        if ip in state['free']:
+            state['free'].remove(ip)
+        elif state['start'] <= int(IPAddress(ip)) <= state['next']:
+            state['reserved'].append(ip)
+        state['allocated'][name or ip] = ip
+
+    def release(self, name):
+        """Puts the ip allocated to name (or this ip) back in the pool."""
+        ip = self.state['allocated'].pop(name, None)
+        if ip is not None:
+            self.state['free'].append(ip)
+
+
+def _in_range(state, network):
+    # Whether the pool has been made from (the range of) network
+    if state['start'] != int(IPAddress(network['start'])):
+        return False
+    return state['next'] <= int(IPAddress(network['end']))
+
+
+def get_ip_pool(env, network):
+    """Returns the ip pool of network.
+
+    Pools are identified by the cidr of their network and their state is
+    kept in the env (under IP_POOLS), so that an ip allocated to a name
+    stays the same when `enos up` is run again on the same env. A pool is
+    reset if the range of its network changed.
+    """
+    pools = env.setdefault(IP_POOLS, {})
+    key = network.get('cidr') or network['start']
+    state = pools.get(key)
+    if state is None or not _in_range(state, network):
+        state = pools[key] = IPPool.new_state(network)
+    return IPPool(state, network=network)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+from .constants import VENV_KOLLA
+from .extra import check_call_in_venv
+
+import git
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from subprocess import CalledProcessError, check_call, call
+
+# Shared cache of the kolla-ansible sources and virtualenvs
+KOLLA_CACHE = os.getenv('ENOS_KOLLA_CACHE') or os.path.join(
+    os.path.expanduser('~'), '.enos', 'kolla')
+
+# Time (in seconds) after which a mirror is fetched again
+DEFAULT_MIRROR_TTL = 24 * 3600
+
+# Kolla recommends installing ansible manually.
+# Currently anything over 2.3.0 is supported, not sure about the future
+# So we hardcode the version to something reasonnable for now
+KOLLA_ANSIBLE = 'ansible==2.5.7'
+
+# Marks the complete entries (wheelhouse, virtualenv) of the cache
+READY = '.enos-ready'
+
+# Touched on each fetch of a mirror
+FETCHED = 'enos-fetched'
+
+
+def _digest(*values):
+    return hashlib.sha1('@'.join(values).encode('utf-8')).hexdigest()[:16]
+
+
+def _ready(path):
+    return os.path.isfile(os.path.join(path, READY))
+
+
+def _mark_ready(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, READY), 'w'):
+        pass
+
+
+class KollaCache(object):
+    """Cache of kolla-ansible shared by the environments of the user.
+
+    The cache holds:
+    - a bare mirror of each `kolla_repo` (`mirrors/<digest>.git`), checkouts
+      are cloned from it locally (objects are hardlinked). The mirror is
+      fetched again once older than `ttl` seconds, or if the requested ref
+      is missing. A failed fetch is ignored if the ref is already there.
+    - for each `kolla_repo` and commit, a wheelhouse of kolla-ansible and
+      its dependencies, and a virtualenv installed from it
+      (`<digest>/{wheelhouse,venv}`). The wheel is built from a pristine
+      clone of the mirror, never from the (patched) checkout of an env.
+
+    Entries are built under a lock, so concurrent runs build them once.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_MIRROR_TTL):
+        self.path = path or KOLLA_CACHE
+        self.ttl = ttl
+
+    @contextlib.contextmanager
+    def _lock(self, name):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, '%s.lock' % name), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def mirror_path(self, repo):
+        return os.path.join(self.path, 'mirrors', '%s.git' % _digest(repo))
+
+    def entry_path(self, repo, commit):
+        return os.path.join(self.path, _digest(repo, commit))
+
+    def _has_ref(self, mirror, ref):
+        with open(os.devnull, 'w') as devnull:
+            return call(['git', '--git-dir', mirror, 'rev-parse', '--verify',
+                         '--quiet', '%s^{commit}' % ref],
+                        stdout=devnull) == 0
+
+    def _fetched(self, mirror):
+        with open(os.path.join(mirror, FETCHED), 'w'):
+            pass
+
+    def _stale(self, mirror):
+        fetched = os.path.join(mirror, FETCHED)
+        if not os.path.exists(fetched):
+            return True
+        return time.time() - os.path.getmtime(fetched) > self.ttl
+
+    def mirror(self, repo, ref):
+        """Returns the path of the mirror of repo, with ref in it."""
+        mirror = self.mirror_path(repo)
+        with self._lock(_digest(repo)):
+            if not os.path.isdir(mirror):
+                logging.info("Mirroring %s in %s" % (repo, mirror))
+                check_call(['git', 'clone', '--mirror', '--quiet', repo,
+                            mirror])
+                self._fetched(mirror)
+            elif self._stale(mirror) or not self._has_ref(mirror, ref):
+                logging.info("Fetching %s in %s" % (repo, mirror))
+                try:
+                    check_call(['git', '--git-dir', mirror, 'fetch',
+                                '--quiet', '--prune'])
+                    self._fetched(mirror)
+                except CalledProcessError:
+                    if not self._has_ref(mirror, ref):
+                        raise
+                    logging.warning("Cannot fetch %s, using the mirror "
+                                    "as is" % repo)
+        return mirror
+
+    def checkout(self, repo, ref, dest):
+        """Checks out ref of repo in dest (from the mirror)."""
+        mirror = self.mirror(repo, ref)
+        check_call(['git', 'clone', '--quiet', '--branch', ref, mirror,
+                    dest])
+        # The checkout tracks the actual repository, not the mirror
+        check_call(['git', '-C', dest, 'remote', 'set-url', 'origin', repo])
+        return dest
+
+    def update(self, repo, ref, dest):
+        """Moves the checkout dest to ref of repo, if needed.
+
+        Ref is fetched from the mirror, the checkout is only reset when
+        its HEAD is not the commit of ref. Returns whether it was reset.
+        """
+        mirror = self.mirror(repo, ref)
+        checkout = git.Repo(dest)
+        checkout.git.fetch('--quiet', mirror, ref)
+        commit = checkout.commit('FETCH_HEAD').hexsha
+        if checkout.head.commit.hexsha == commit:
+            return False
+        logging.info("Moving %s to %s (%s)" % (dest, ref, commit))
+        if self._has_ref(mirror, 'refs/heads/%s' % ref):
+            checkout.git.checkout('--quiet', '--force', '-B', ref, commit)
+        else:
+            checkout.git.checkout('--quiet', '--force', commit)
+        reset_checkout(dest)
+        return True
+
+    def _build_wheelhouse(self, repo, commit, venv, wheelhouse):
+        mirror = self.mirror(repo, commit)
+        # A local clone (not `git archive`): pbr versions kolla-ansible
+        # from the git metadata
+        src = tempfile.mkdtemp(prefix='kolla-ansible-', dir=self.path)
+        try:
+            check_call(['git', 'clone', '--quiet', '--no-checkout', mirror,
+                        src])
+            check_call(['git', '-C', src, 'checkout', '--quiet', commit])
+            check_call_in_venv(venv, 'pip wheel --quiet --wheel-dir %s '
+                               '%s %s' % (wheelhouse, src, KOLLA_ANSIBLE))
+        finally:
+            shutil.rmtree(src)
+        _mark_ready(wheelhouse)
+
+    def venv(self, repo, commit):
+        """Returns the path of a virtualenv with kolla-ansible installed.
+
+        The virtualenv is the one of the commit of repo (see `head_commit`),
+        built once.
+        """
+        entry = self.entry_path(repo, commit)
+        venv = os.path.join(entry, 'venv')
+        wheelhouse = os.path.join(entry, 'wheelhouse')
+        with self._lock(_digest(repo, commit)):
+            if _ready(venv):
+                return venv
+            # Leftovers of an interrupted build
+            if os.path.isdir(venv):
+                shutil.rmtree(venv)
+            logging.info("Building the kolla virtualenv in %s" % venv)
+            if not _ready(wheelhouse):
+                self._build_wheelhouse(repo, commit, venv, wheelhouse)
+            check_call_in_venv(venv, 'pip install --quiet --no-index '
+                               '--find-links %s kolla-ansible %s' %
+                               (wheelhouse, KOLLA_ANSIBLE))
+            _mark_ready(venv)
+        return venv
+
+
+def link_venv(venv, link=VENV_KOLLA):
+    """Makes link (the kolla virtualenv of enos) point to venv.
+
+    Returns False if link is an actual virtualenv, which is kept.
+    """
+    if os.path.exists(link) and not os.path.islink(link):
+        logging.warning("%s is not a link to the kolla cache, remove it to "
+                        "use the cache" % link)
+        return False
+    tmp_link = '%s.%s' % (link, os.getpid())
+    os.symlink(venv, tmp_link)
+    os.rename(tmp_link, link)
+    return True
+
+
+def head_commit(path):
+    """Returns the commit of the checkout path."""
+    return git.Repo(path).head.commit.hexsha
+
+
+def reset_checkout(path):
+    """Reverts the changes of the checkout path (e.g. patches)."""
+    checkout = git.Repo(path)
+    checkout.git.reset('--quiet', '--hard')
+    checkout.git.clean('-d', '--force', '--quiet')
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from .extra import load_config, make_provider
+
+import copy
+import logging
+import multiprocessing
+
+# Name of the inventory (in the result dir) of the hosts of a region
+REGION_INVENTORY = 'multinode-%s'
+
+
+def region_configs(config):
+    """Yields (region name, configuration) for each region of config.
+
+    The configuration of a region is the top level configuration (without
+    the `regions` key) overridden by the keys of the region. The
+    `provider` keys are merged so that the common provider options (e.g
+    the job name) can be set once at the top level.
+    """
+    base = copy.deepcopy(config)
+    regions = base.pop('regions', [])
+    for region in regions:
+        region = copy.deepcopy(region)
+        name = region.pop('name')
+        conf = copy.deepcopy(base)
+        provider = region.pop('provider', None)
+        if isinstance(provider, dict) and \
+           isinstance(conf.get('provider'), dict):
+            conf['provider'] = dict(conf['provider'], **provider)
+        elif provider is not None:
+            conf['provider'] = provider
+        conf.update(region)
+        yield name, conf
+
+
+def init_region(args):
+    """Gets the resources of a region.
+
+    `args` is a tuple (name, config, force). Returns a tuple (name,
+    config with the provider defaults, roles, networks).
+    """
+    name, config, force = args
+    provider = make_provider(config['provider'])
+    config = load_config(config, provider.default_config())
+    logging.info("Initializing region %s with %s" % (name, provider))
+    rsc, networks = provider.init(config, force)
+    return name, config, rsc, networks
+
+
+def init_regions(config, force=False):
+    """Gets the resources of all the regions of config concurrently.
+
+    Each region is initialized by its own provider, in its own process, so
+    that a long reservation on a site does not delay the others.
+
+    Returns a list of (name, config, roles, networks), one per region in
+    the order of the configuration.
+    """
+    args = [(name, conf, force) for name, conf in region_configs(config)]
+    if len(args) <= 1:
+        return [init_region(a) for a in args]
+    pool = multiprocessing.Pool(len(args))
+    try:
+        return pool.map(init_region, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def merge_regions(regions):
+    """Merges the roles and networks of the regions.
+
+    The hosts of a region are also put in a group named after the region.
+    Networks shared by several regions are merged (and the regions
+    updated to reference the merged one). Returns a tuple (roles,
+    networks).
+    """
+    roles = {}
+    networks = []
+    for name, _, rsc, nets in regions:
+        hosts = []
+        for role, role_hosts in rsc.items():
+            roles.setdefault(role, []).extend(role_hosts)
+            hosts.extend(h for h in role_hosts if h not in hosts)
+        roles.setdefault(name, []).extend(hosts)
+        for i, network in enumerate(nets):
+            if network in networks:
+                # Regions sharing a network share its ip pool too
+                nets[i] = networks[networks.index(network)]
+            else:
+                networks.append(network)
+    return roles, networks
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+from .backup import LATEST, MIRROR_DIR
+
+import fnmatch
+import glob
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import tarfile
+
+# Default name of the index (in the result dir)
+RESULTS_DB = 'results.sqlite'
+
+# Rally tarballs made by `enos backup` (gzip or zstd compressed)
+RALLY_TARBALL = '*-rally.tar.*'
+
+# Rally directories of the last snapshots of `enos backup --incremental`
+RALLY_MIRROR = os.path.join(MIRROR_DIR, '*', LATEST, 'rally')
+
+PERCENTILES = [50, 95, 99]
+
+_UUID_LEN = 36
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS sources (
+           id INTEGER PRIMARY KEY,
+           path TEXT UNIQUE,
+           size INTEGER,
+           mtime REAL)""",
+    """CREATE TABLE IF NOT EXISTS runs (
+           id INTEGER PRIMARY KEY,
+           source_id INTEGER,
+           host TEXT,
+           scenario TEXT,
+           task_uuid TEXT,
+           workload TEXT,
+           args TEXT)""",
+    """CREATE TABLE IF NOT EXISTS iterations (
+           run_id INTEGER,
+           idx INTEGER,
+           timestamp REAL,
+           duration REAL,
+           idle_duration REAL,
+           error INTEGER)""",
+    "CREATE INDEX IF NOT EXISTS runs_source ON runs(source_id)",
+    "CREATE INDEX IF NOT EXISTS runs_task ON runs(scenario, task_uuid)",
+    "CREATE INDEX IF NOT EXISTS iterations_run ON iterations(run_id)",
+]
+
+
+def connect(db_path):
+    "Opens (and creates if needed) the results index."
+    conn = sqlite3.connect(db_path)
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def _split_name(name, prefix):
+    """Returns the (scenario, uuid) of a rally file name.
+
+    e.g report-nova-boot-list-cc.yml-<uuid>.json gives
+    (nova-boot-list-cc.yml, <uuid>) with the `report-` prefix.
+    """
+    basename = os.path.basename(name)
+    if not (basename.startswith(prefix) and basename.endswith('.json')):
+        return None
+    stem = basename[len(prefix):-len('.json')]
+    if len(stem) <= _UUID_LEN + 1 or stem[-_UUID_LEN - 1] != '-':
+        return None
+    return stem[:-_UUID_LEN - 1], stem[-_UUID_LEN:]
+
+
+def iter_workloads(report):
+    """Yields (workload name, iterations) for each workload of a report.
+
+    Iterations are dicts with the `timestamp`, `duration`,
+    `idle_duration` and `error` keys. Both the current report format
+    (rally >= 0.10, with a `tasks` key) and the former one (list of
+    `key`/`result`) are supported.
+    """
+    if isinstance(report, dict):
+        for task in report.get('tasks', []):
+            for subtask in task.get('subtasks', []):
+                for workload in subtask.get('workloads', []):
+                    yield workload.get('name'), workload.get('data', [])
+    else:
+        for workload in report:
+            yield workload['key']['name'], workload.get('result', [])
+
+
+def _iter_files(path):
+    """Yields (name, file object) for the files of a rally source.
+
+    Sources are directories or tarballs. Tarballs are read as a stream,
+    members are never extracted. zstd tarballs are decompressed by the
+    zstd command.
+    """
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    yield name, f
+        return
+    zstd = None
+    if path.endswith('.zst'):
+        zstd = subprocess.Popen(['zstd', '-q', '-d', '-c', path],
+                                stdout=subprocess.PIPE)
+        tar = tarfile.open(fileobj=zstd.stdout, mode='r|')
+    else:
+        tar = tarfile.open(path, 'r|*')
+    try:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member)
+    finally:
+        tar.close()
+        if zstd is not None:
+            zstd.stdout.close()
+            zstd.wait()
+
+
+def _host(path):
+    if os.path.isdir(path):
+        # <backup_dir>/mirrors/<host>/latest/rally
+        return os.path.basename(os.path.dirname(os.path.dirname(path)))
+    return os.path.basename(path).split('-rally.tar.')[0]
+
+
+def _stat(path):
+    """Returns the (size, mtime) of a rally source.
+
+    Those of a directory are the total size and the last mtime of its
+    files (files of a snapshot are never modified, see
+    `enos.utils.backup`).
+    """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    size = 0
+    mtime = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            size = size + stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+    return size, mtime
+
+
+def _index_source(conn, source_id, path):
+    """Streams a rally source (tarball or directory) in the index.
+
+    Returns the number of runs indexed.
+    """
+    host = _host(path)
+    args = {}
+    runs = 0
+    for name, f in _iter_files(path):
+        report_key = _split_name(name, 'report-')
+        args_key = _split_name(name, 'args-')
+        if report_key is None and args_key is None:
+            continue
+        content = json.loads(f.read().decode())
+        if args_key is not None:
+            args[args_key] = json.dumps(content, sort_keys=True)
+            continue
+        scenario, uuid = report_key
+        for name, iterations in iter_workloads(content):
+            cursor = conn.execute(
+                "INSERT INTO runs (source_id, host, scenario, task_uuid,"
+                " workload) VALUES (?, ?, ?, ?, ?)",
+                (source_id, host, scenario, uuid, name))
+            conn.executemany(
+                "INSERT INTO iterations VALUES (?, ?, ?, ?, ?, ?)",
+                ((cursor.lastrowid, idx, it.get('timestamp'),
+                  it.get('duration'), it.get('idle_duration'),
+                  1 if it.get('error') else 0)
+                 for idx, it in enumerate(iterations)))
+            runs = runs + 1
+
+    # args may come after the reports in the source
+    for (scenario, uuid), value in args.items():
+        conn.execute(
+            "UPDATE runs SET args = ? WHERE source_id = ? AND scenario = ?"
+            " AND task_uuid = ?", (value, source_id, scenario, uuid))
+    return runs
+
+
+def _sources(backup_dir):
+    tarballs = [os.path.join(backup_dir, name)
+                for name in sorted(os.listdir(backup_dir))
+                if fnmatch.fnmatch(name, RALLY_TARBALL)]
+    mirrors = sorted(glob.glob(os.path.join(backup_dir, RALLY_MIRROR)))
+    return [os.path.abspath(path) for path in tarballs + mirrors]
+
+
+def index_results(db_path, backup_dir):
+    """Indexes the rally backups of backup_dir in the db_path index.
+
+    Rally backups are the <host>-rally.tar.<gz|zst> tarballs made by
+    `enos backup` and the rally directories of the last snapshots of
+    `enos backup --incremental` (mirrors/<host>/latest/rally). Their JSON
+    reports (report-<scenario>-<uuid>.json) are streamed in the index,
+    each iteration being tagged with the args of the scenario
+    (args-<scenario>-<uuid>.json).
+
+    Backups already indexed and unchanged since are skipped. Returns the
+    number of runs indexed.
+    """
+    conn = connect(db_path)
+    runs = 0
+    try:
+        for path in _sources(backup_dir):
+            size, mtime = _stat(path)
+            row = conn.execute(
+                "SELECT id, size, mtime FROM sources WHERE path = ?",
+                (path,)).fetchone()
+            if row is not None:
+                if (row[1], row[2]) == (size, mtime):
+                    logging.debug("%s already indexed" % path)
+                    continue
+                # The backup changed, drop what has been indexed so far
+                conn.execute(
+                    "DELETE FROM iterations WHERE run_id IN"
+                    " (SELECT id FROM runs WHERE source_id = ?)", (row[0],))
+                conn.execute("DELETE FROM runs WHERE source_id = ?",
+                             (row[0],))
+                conn.execute("DELETE FROM sources WHERE id = ?", (row[0],))
+            logging.info("Indexing %s" % path)
+            source_id = conn.execute(
+                "INSERT INTO sources (path, size, mtime) VALUES (?, ?, ?)",
+                (path, size, mtime)).lastrowid
+            runs = runs + _index_source(conn, source_id, path)
+            conn.commit()
+    finally:
+        conn.close()
+    return runs
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of the sorted values.
+
+    Linear interpolation between the closest ranks is used.
+    """
+    if not values:
+        return None
+    rank = (len(values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def query_results(db_path, scenario=None):
+    """Returns duration stats grouped by scenario, workload and args.
+
+    Each row is a dict with the `scenario`, `workload`, `args`, `runs`,
+    `iterations`, `errors` keys and a `p<N>` key per percentile of
+    PERCENTILES. Failed iterations are excluded from the percentiles.
+    """
+    conn = connect(db_path)
+    query = ("SELECT r.scenario, r.workload, r.args, r.id, i.duration,"
+             " i.error FROM runs r JOIN iterations i ON i.run_id = r.id")
+    params = ()
+    if scenario is not None:
+        query = query + " WHERE r.scenario = ?"
+        params = (scenario,)
+    query = query + " ORDER BY r.scenario, r.workload, r.args, i.duration"
+
+    rows = []
+    current = None
+    try:
+        for scn, workload, args, run_id, duration, error in \
+                conn.execute(query, params):
+            key = (scn, workload, args)
+            if current is None or current['key'] != key:
+                current = {'key': key, 'runs': set(), 'durations': [],
+                           'iterations': 0, 'errors': 0}
+                rows.append(current)
+            current['runs'].add(run_id)
+            current['iterations'] = current['iterations'] + 1
+            if error:
+                current['errors'] = current['errors'] + 1
+            elif duration is not None:
+                current['durations'].append(duration)
+    finally:
+        conn.close()
+
+    results = []
+    for row in rows:
+        scn, workload, args = row['key']
+        result = {
+            'scenario': scn,
+            'workload': workload,
+            'args': json.loads(args) if args else {},
+            'runs': len(row['runs']),
+            'iterations': row['iterations'],
+            'errors': row['errors']
+        }
+        for p in PERCENTILES:
+            result['p%s' % p] = percentile(row['durations'], p)
+        results.append(result)
+    return results
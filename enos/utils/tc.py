@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+from .constants import ANSIBLE_DIR
+
+import json
+import logging
+import os
+import re
+import yaml
+
+# Docker bridge, never constrained (see enoslib.api._build_ip_constraints)
+DOCKER_BRIDGE_IP = '172.17.0.1'
+
+# Addresses and devices of the hosts (in the result dir)
+TC_IPS = 'tc-ips.yml'
+
+# Record (in the result dir) of the tc rules applied on each device
+TC_RULES = 'tc-rules.json'
+
+# Handle of the u32 hash table of the destinations, bucketed by the last
+# byte of their address (at offset 16 of the IP header)
+HASH_TABLE = 2
+
+# Handles of the netem qdiscs are the class numbers plus this offset
+NETEM_OFFSET = 0x10
+
+# Range of groups in the network constraints, e.g. grp[1-3]
+GROUP_RANGE = re.compile(r'(?P<name>.+)\[(?P<start>\d+)-(?P<end>\d+)\]')
+
+
+def _expand_groups(grp):
+    m = GROUP_RANGE.match(grp)
+    if m is None:
+        return [grp]
+    return ['%s%s' % (m.group('name'), i)
+            for i in range(int(m.group('start')), int(m.group('end')) + 1)]
+
+
+def _user_constraints(network_constraints):
+    # One constraint per (src, dst) pair of groups, and its symmetric one
+    actual = []
+    for desc in network_constraints.get('constraints', []):
+        for src in _expand_groups(desc['src']):
+            for dst in _expand_groups(desc['dst']):
+                actual.append(dict(desc, src=src, dst=dst))
+                if 'symetric' in desc:
+                    actual.append(dict(desc, src=dst, dst=src))
+    return actual
+
+
+def group_constraints(roles, network_constraints):
+    """Returns the constraints between the groups of the roles.
+
+    Same as `enoslib.api._build_grp_constraints` (private, hence kept
+    here): a default constraint between each pair of distinct groups
+    (`groups`, all the roles by default, but the `except` ones), updated
+    by the user `constraints` of the same pair (with their symmetric one
+    if `symetric`). Groups constrained with themselves are kept.
+    """
+    actual = _user_constraints(network_constraints)
+    excluded = network_constraints.get('except', [])
+    grps = [g for grp in network_constraints.get('groups', roles.keys())
+            for g in _expand_groups(grp) if g not in excluded]
+    itself = set(c['src'] for c in actual if c['src'] == c['dst'])
+    constraints = [{
+        'src': src,
+        'dst': dst,
+        'delay': network_constraints.get('default_delay'),
+        'rate': network_constraints.get('default_rate'),
+        'loss': network_constraints.get('default_loss', 0)
+    } for src in grps for dst in grps if src != dst or src in itself]
+    for override in actual:
+        for c in constraints:
+            if (c['src'], c['dst']) == (override['src'], override['dst']):
+                c.update(override)
+                break
+    return constraints
+
+
+def host_index(roles):
+    """Indexes the hosts of the roles.
+
+    Returns the sorted aliases of the hosts and the mask of each role: bit
+    i of a mask is set if the host of index i is in the role.
+    """
+    aliases = sorted(set(h.alias for hosts in roles.values() for h in hosts))
+    index = dict((alias, i) for i, alias in enumerate(aliases))
+    masks = {}
+    for role, hosts in roles.items():
+        mask = 0
+        for host in hosts:
+            mask |= 1 << index[host.alias]
+        masks[role] = mask
+    return aliases, masks
+
+
+def _bits(mask):
+    i = 0
+    while mask:
+        if mask & 1:
+            yield i
+        mask >>= 1
+        i += 1
+
+
+def _devices(host_ips):
+    # Same devices as the htb qdisc of `enoslib` (active ethernet ones)
+    return [d['device'] for d in host_ips.get('devices') or []
+            if d.get('active') and d.get('type') == 'ether']
+
+
+def _loss(loss):
+    return loss not in (None, 0, '0', '0%')
+
+
+def device_rules(device, classes, filters):
+    """Returns the `tc -batch` lines of a device.
+
+    There is one htb class (and netem qdisc) per distinct (delay, rate,
+    loss) of `classes` and the destinations of `filters` ((ip, class
+    number) pairs) are matched in a u32 hash table, so that a packet is
+    classified with one lookup whatever the number of destinations.
+    """
+    if not classes:
+        return []
+    rules = ['qdisc add dev %s root handle 1: htb' % device]
+    for n, (delay, rate, loss) in enumerate(classes, 1):
+        rules.append('class add dev %s parent 1: classid 1:%x htb rate %s'
+                     % (device, n, rate))
+        netem = 'qdisc add dev %s parent 1:%x handle %x: netem delay %s' \
+            % (device, n, n + NETEM_OFFSET, delay)
+        if _loss(loss):
+            netem += ' loss %s' % loss
+        rules.append(netem)
+    rules.append('filter add dev %s parent 1: prio 1 handle %x: protocol ip '
+                 'u32 divisor 256' % (device, HASH_TABLE))
+    rules.append('filter add dev %s parent 1: prio 1 protocol ip u32 '
+                 'ht 800:: match ip dst 0.0.0.0/0 hashkey mask 0x000000ff '
+                 'at 16 link %x:' % (device, HASH_TABLE))
+    for ip, n in filters:
+        rules.append('filter add dev %s parent 1: prio 1 protocol ip u32 '
+                     'ht %x:%x: match ip dst %s/32 flowid 1:%x'
+                     % (device, HASH_TABLE, int(ip.split('.')[-1]), ip, n))
+    return rules
+
+
+def compile_constraints(roles, ips, constraints):
+    """Compiles the group constraints into the tc rules of each device.
+
+    `constraints` are the group constraints of `group_constraints` and
+    `ips` the addresses and devices of the hosts. Destinations are sets of
+    hosts (masks over the host index, see `host_index`): as with
+    `enoslib`, the first constraint that matches a destination wins.
+    Returns {alias: {device: rules}}.
+    """
+    aliases, masks = host_index(roles)
+    hosts = dict((h.alias, h) for hs in roles.values() for h in hs)
+    dst_ips = [[ip for ip in ips[alias]['all_ipv4_addresses']
+                if ip != DOCKER_BRIDGE_IP] for alias in aliases]
+
+    rules = {}
+    for i, alias in enumerate(aliases):
+        bit = 1 << i
+        mine = [c for c in constraints if masks[c['src']] & bit]
+        rules[alias] = {}
+        for device in _devices(ips[alias]):
+            classes = []
+            filters = []
+            claimed = 0
+            seen = set()
+            for c in mine:
+                network = c.get('network')
+                if network and hosts[alias].extra.get(network) != device:
+                    continue
+                dsts = masks[c['dst']] & ~claimed
+                if not dsts:
+                    continue
+                claimed |= dsts
+                params = (c['delay'], c['rate'], c.get('loss', 0))
+                if params not in classes:
+                    classes.append(params)
+                n = classes.index(params) + 1
+                for j in _bits(dsts):
+                    for ip in dst_ips[j]:
+                        if ip not in seen:
+                            seen.add(ip)
+                            filters.append((ip, n))
+            rules[alias][device] = device_rules(device, classes, filters)
+    return rules
+
+
+def changed_rules(rules, applied):
+    """Returns the batches of the devices whose rules are not the applied
+    ones: {alias: {'devices': [device], 'rules': [rule]}}."""
+    batches = {}
+    for alias, devices in rules.items():
+        done = applied.get(alias, {})
+        changed = sorted(d for d in devices if done.get(d) != devices[d])
+        batches[alias] = {
+            'devices': changed,
+            'rules': [r for d in changed for r in devices[d]]
+        }
+    return batches
+
+
+def load_applied(resultdir):
+    path = os.path.join(resultdir, TC_RULES)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _htb_devices(host_ips):
+    # Devices with the root htb qdisc of `device_rules` (`tc qdisc show`)
+    devices = set()
+    for line in host_ips.get('qdiscs') or []:
+        fields = line.split()
+        if fields[:3] == ['qdisc', 'htb', '1:'] and 'root' in fields:
+            devices.add(fields[fields.index('dev') + 1])
+    return devices
+
+
+def installed_rules(applied, ips):
+    """Returns the applied rules still in place on the devices.
+
+    The record of the applied rules outlives the hosts (e.g. rebooted or
+    deployed again): the rules of a device are only kept if it has a root
+    htb qdisc exactly when it has rules.
+    """
+    installed = {}
+    for alias, devices in applied.items():
+        htb = _htb_devices(ips.get(alias, {}))
+        installed[alias] = dict((d, rules) for d, rules in devices.items()
+                                if bool(rules) == (d in htb))
+    return installed
+
+
+def emulate_network(roles, inventory, network_constraints, resultdir,
+                    force=False):
+    """Enforces the network constraints on the hosts of the roles.
+
+    Same constraints as `enoslib.api.emulate_network`, but compiled by
+    `compile_constraints` and applied with `tc -batch`, only on the devices
+    whose rules changed since the last run, or are no longer in place (all
+    of them if `force`).
+    """
+    # Imported here since it imports ansible (see `enos.cli`)
+    from enoslib.api import run_ansible
+    utils_playbook = os.path.join(ANSIBLE_DIR, 'utils.yml')
+
+    ips_file = os.path.join(resultdir, TC_IPS)
+    run_ansible([utils_playbook], inventory,
+                extra_vars={'action': 'ips', 'ips_file': ips_file})
+    with open(ips_file, 'r') as f:
+        ips = yaml.safe_load(f)
+
+    if network_constraints.get('enable', True):
+        constraints = group_constraints(roles, network_constraints)
+    else:
+        constraints = []
+    rules = compile_constraints(roles, ips, constraints)
+    applied = {} if force else installed_rules(load_applied(resultdir), ips)
+    batches = changed_rules(rules, applied)
+    changed = sum(len(b['devices']) for b in batches.values())
+    logging.info("Applying the tc rules of %s devices" % changed)
+    if changed:
+        run_ansible([utils_playbook], inventory,
+                    extra_vars={'action': 'tc_batch', 'tc_batches': batches})
+
+    with open(os.path.join(resultdir, TC_RULES), 'w') as f:
+        json.dump(rules, f, indent=1, sort_keys=True)
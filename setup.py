@@ -47,6 +47,9 @@ setup(
             'influxdb==4.0.0'
         ]
     },
-    entry_points={'console_scripts': ['enos = enos.cli:main']},
+    entry_points={'console_scripts': [
+        'enos = enos.cli:main',
+        'enos-inventory = enos.cli:inventory_script'
+    ]},
     include_package_data=True
 )
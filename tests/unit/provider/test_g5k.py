@@ -1,9 +1,17 @@
+import json
 import operator
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
 import mock
 
-from enos.provider.g5k import (_build_enoslib_conf, _count_common_interfaces, _get_sites)
+from enos.provider.g5k import (_build_enoslib_conf, _count_common_interfaces, _get_sites,
+                               _provision, _ProvisionProgress, PROVISION_MARKER,
+                               ReferenceCache)
+from enoslib.host import Host
 
 PROVIDER = {'type': 'g5k',
             'job_name': 'enos-test'}
@@ -13,6 +21,10 @@ INTERFACES = {"paravance": ["link01", "link02"],
 
 CLUSTERS_SITES = { "paravance": "rennes", "grisou": "nancy" }
 
+# Recorded reference cache
+REFERENCE_FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures',
+                                 'g5k_reference.json')
+
 
 class TestGenEnoslibRoles(unittest.TestCase):
 
@@ -171,3 +183,113 @@ class TestGenEnoslibRoles(unittest.TestCase):
 
         nodes = sum([x['nodes'] for x in machines])
         self.assertEquals(39, nodes)
+
+
+def _process(address, ok=True, start=0, end=1):
+    process = mock.Mock(ok=ok, start_date=start, end_date=end, stderr='boom')
+    process.host.address = address
+    return process
+
+
+class TestProvision(unittest.TestCase):
+
+    @mock.patch("enos.provider.g5k.ex.Remote")
+    def test_provision(self, mock_remote):
+        mock_remote.return_value.processes = [_process('node-1', end=3),
+                                              _process('node-2', end=5)]
+        roles = {'control': [Host('node-1')],
+                 'compute': [Host('node-1'), Host('node-2')]}
+        timings = _provision(roles)
+        # a single script runs on each node (once)
+        self.assertEqual(1, mock_remote.call_count)
+        self.assertEqual(['node-1', 'node-2'], mock_remote.call_args[0][1])
+        self.assertEqual(3, timings['node-1']['duration'])
+        self.assertEqual(5, timings['node-2']['duration'])
+
+    @mock.patch("enos.provider.g5k.ex.Remote")
+    def test_provision_failed(self, mock_remote):
+        mock_remote.return_value.processes = [_process('node-1'),
+                                              _process('node-2', ok=False)]
+        with self.assertRaises(Exception) as ctx:
+            _provision({'compute': [Host('node-1'), Host('node-2')]})
+        self.assertIn('node-2', str(ctx.exception))
+        self.assertNotIn('node-1', str(ctx.exception))
+
+    def test_progress(self):
+        progress = _ProvisionProgress()
+        process = _process('node-1', start=0)
+        progress.read_line(process, 0, 'Reading package lists...', False,
+                           False)
+        progress.read_line(process, 0, '%s python skipped\n' %
+                           PROVISION_MARKER, False, False)
+        progress.read_line(process, 0, '%s nova done\n' % PROVISION_MARKER,
+                           False, False)
+        self.assertEqual([('python', 'skipped'), ('nova', 'done')],
+                         [s[:2] for s in progress.steps['node-1']])
+
+
+class TestReferenceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'g5k_reference.json')
+        shutil.copy(REFERENCE_FIXTURE, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch("enoslib.infra.enos_g5k.api.get_clusters_sites")
+    @mock.patch("enoslib.infra.enos_g5k.api.get_clusters_interfaces")
+    def test_offline(self, mock_interfaces, mock_sites):
+        conf = {
+            'resources': {'paravance': {'control': 1, 'compute': 1}},
+            'provider': dict(PROVIDER, reference_offline=True)
+        }
+        with mock.patch("enos.provider.g5k.REFERENCE_CACHE", self.path):
+            enoslib_conf = _build_enoslib_conf(conf)
+        self.assertFalse(mock_sites.called)
+        self.assertFalse(mock_interfaces.called)
+        self.assertNotIn('reference_offline', enoslib_conf)
+        networks = enoslib_conf['resources']['networks']
+        self.assertEqual(2, len(networks))
+        self.assertEqual(set(['rennes']), set([n['site'] for n in networks]))
+
+    def test_offline_missing(self):
+        cache = ReferenceCache(self.path, offline=True)
+        with self.assertRaises(Exception):
+            _get_sites(['paravance', 'chetemi'], cache=cache)
+
+    def test_ttl(self):
+        fetch = mock.Mock(return_value={'chetemi': 'lille'})
+        cache = ReferenceCache(self.path, ttl=time.time())
+        sites = cache.get('sites', ['paravance', 'chetemi'], fetch)
+        self.assertEqual({'paravance': 'rennes', 'chetemi': 'lille'}, sites)
+        # only the missing cluster is fetched, and cached
+        fetch.assert_called_once_with(['chetemi'])
+        cache.get('sites', ['chetemi'], fetch)
+        self.assertEqual(1, fetch.call_count)
+
+        # the recorded clusters are expired
+        fetch = mock.Mock(return_value={'paravance': 'rennes'})
+        ReferenceCache(self.path).get('sites', ['paravance'], fetch)
+        fetch.assert_called_once_with(['paravance'])
+
+    def test_ttl_zero(self):
+        fetch = mock.Mock(return_value={'paravance': 'rennes'})
+        cache = ReferenceCache(self.path, ttl=0)
+        cache.get('sites', ['paravance'], fetch)
+        cache.get('sites', ['paravance'], fetch)
+        self.assertEqual(2, fetch.call_count)
+
+    def test_invalidate(self):
+        cache = ReferenceCache(self.path)
+        cache.invalidate(['paravance'])
+        with open(self.path) as f:
+            data = json.load(f)
+        self.assertNotIn('paravance', data['sites'])
+        self.assertNotIn('paravance', data['interfaces'])
+        self.assertIn('parasilo', data['sites'])
+        cache.invalidate()
+        with open(self.path) as f:
+            self.assertEqual({}, json.load(f))
+
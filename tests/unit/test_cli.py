@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from enos.utils.envstore import save_env
+
+# Max time (in seconds) of `enos info`, it is called by scripts
+INFO_BUDGET = 1.5
+
+# Modules that `enos info` must not import
+HEAVY_MODULES = ('ansible', 'enoslib.api', 'enoslib.infra', 'execo', 'git',
+                 'netaddr', 'enos.provider.g5k')
+
+INFO_SCRIPT = """
+import json, sys, time
+start = time.time()
+sys.argv = ['enos', 'info', '--env', sys.argv[1], '--out', 'json']
+import enos.cli
+enos.cli.main()
+sys.stderr.write('\\n' + json.dumps({'time': time.time() - start,
+                             'modules': sorted(sys.modules)}))
+"""
+
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.resultdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.resultdir)
+        save_env({'resultdir': self.resultdir, 'config': {'vip': '1.2.3.4'}})
+
+    def run_info(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [p for p in [env.get('PYTHONPATH')] if p])
+        process = subprocess.Popen(
+            [sys.executable, '-c', INFO_SCRIPT, self.resultdir],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+            cwd=self.resultdir)
+        out, err = process.communicate()
+        self.assertEqual(0, process.returncode, err)
+        # Stats are on the last line (after the logs)
+        return (json.loads(out.decode()),
+                json.loads(err.decode().splitlines()[-1]))
+
+    def test_info_startup(self):
+        out, stats = self.run_info()
+        self.assertEqual('1.2.3.4', out['config']['vip'])
+        heavy = [m for m in stats['modules'] if m.startswith(HEAVY_MODULES)]
+        self.assertEqual([], heavy)
+        self.assertLess(stats['time'], INFO_BUDGET)
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from enos.utils.backup import *
+
+MTIME = 1500000000
+
+
+class TestDedupBackup(unittest.TestCase):
+
+    def setUp(self):
+        self.mirror_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.mirror_dir)
+
+    def _write(self, path, content, mtime=MTIME):
+        path = os.path.join(self.mirror_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        # rsync preserves the times of the files
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def _objects(self):
+        objects = []
+        for _, _, files in os.walk(os.path.join(self.mirror_dir,
+                                                OBJECTS_DIR)):
+            objects.extend(files)
+        return objects
+
+    def test_dedup(self):
+        a = self._write('host-1/kolla-conf/nova.conf', 'same')
+        b = self._write('host-2/kolla-conf/nova.conf', 'same')
+        self._write('host-2/kolla-logs/nova.log', 'other')
+
+        hashed, saved = dedup_backup(self.mirror_dir)
+        self.assertEqual(3, hashed)
+        self.assertEqual(len('same'), saved)
+        self.assertEqual(2, len(self._objects()))
+        self.assertEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+        with open(b) as f:
+            self.assertEqual('same', f.read())
+
+        # a second pass doesn't hash anything
+        self.assertEqual((0, 0), dedup_backup(self.mirror_dir))
+
+    def test_changed_files(self):
+        path = self._write('host-1/rally/report.json', 'v1')
+        dedup_backup(self.mirror_dir)
+        # rsync replaces the changed files
+        os.remove(path)
+        self._write('host-1/rally/report.json', 'v2')
+        hashed, _ = dedup_backup(self.mirror_dir)
+        self.assertEqual(1, hashed)
+        # the object of the previous version is removed
+        self.assertEqual(1, len(self._objects()))
+
+    def test_attributes(self):
+        a = self._write('host-1/s1/kolla-conf/nova.conf', 'same')
+        b = self._write('host-2/s1/kolla-conf/nova.conf', 'same')
+        c = self._write('host-3/s1/kolla-conf/nova.conf', 'same', mtime=0)
+        os.chmod(b, 0o600)
+        dedup_backup(self.mirror_dir)
+        # links share their attributes: only identical files are linked
+        self.assertEqual(3, len(self._objects()))
+        self.assertEqual(0o600, os.stat(b).st_mode & 0o777)
+        self.assertEqual(0, os.stat(c).st_mtime)
+        self.assertNotEqual(os.stat(a).st_mode, os.stat(b).st_mode)
+
+    def test_promote_snapshot(self):
+        self._write('host-1/s1/rally/report.json', 'v1')
+        self._write('host-2/s1/rally/report.json', 'v1')
+        promote_snapshot(self.mirror_dir, 's1')
+        self._write('host-1/s2/rally/report.json', 'v2')
+        promote_snapshot(self.mirror_dir, 's2')
+        latest = os.path.join(self.mirror_dir, 'host-%s', LATEST,
+                              'rally/report.json')
+        with open(latest % 1) as f:
+            self.assertEqual('v2', f.read())
+        # hosts without the snapshot keep their previous one
+        with open(latest % 2) as f:
+            self.assertEqual('v1', f.read())
+        # links are not walked
+        dedup_backup(self.mirror_dir)
+        self.assertEqual(2, len(self._objects()))
+
+
+if __name__ == '__main__':
+    unittest.main()
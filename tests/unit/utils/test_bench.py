@@ -0,0 +1,235 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from enos.utils.bench import *
+from enos.utils.errors import EnosError
+
+
+def _bench(name, reset=False):
+    bench = {'type': 'rally',
+             'file': name,
+             'scenario_location': name,
+             'args': {'times': 1},
+             'reset': reset}
+    bench['id'] = bench_id(bench)
+    return bench
+
+
+# Playbook standing for run-bench.yml: Ansible runs each task (and the
+# fact gathering) in a process of its own
+PLAYBOOK = """---
+- hosts: "{{ bench_host | default('all') }}"
+  gather_subset: ['!all']
+  tasks:
+    - fail:
+      when: bench.file == 'boom'
+"""
+
+INVENTORY = """[disco/bench]
+bench-1 ansible_connection=local ansible_python_interpreter=%(python)s
+bench-2 ansible_connection=local ansible_python_interpreter=%(python)s
+"""
+
+
+class TestExpandWorkload(unittest.TestCase):
+
+    def test_cartesian(self):
+        points = cartesian({'times': [1, 2], 'concurrency': [1, 2, 3],
+                            'sla': 10})
+        # the expansion is lazy
+        self.assertFalse(isinstance(points, list))
+        points = list(points)
+        self.assertEqual(6, len(points))
+        self.assertIn({'times': 2, 'concurrency': 3, 'sla': 10}, points)
+
+    def test_scenario_args_do_not_leak(self):
+        workload = {
+            'rally': {
+                'args': {'times': [1, 2]},
+                'scenarios': [
+                    {'file': 'a.yml', 'args': {'concurrency': 4}},
+                    {'file': 'b.yml'}]}}
+        benchs = list(expand_workload(workload, '/workload'))
+        self.assertEqual(4, len(benchs))
+        b = [x for x in benchs if x['file'] == 'b.yml']
+        self.assertEqual([{'times': 1}, {'times': 2}],
+                         sorted([x['args'] for x in b],
+                                key=lambda x: x['times']))
+        self.assertEqual({'times': [1, 2]}, workload['rally']['args'])
+
+    def test_reset_and_enabled(self):
+        workload = {
+            'rally': {
+                'scenarios': [
+                    {'file': 'a.yml'},
+                    {'file': 'b.yml'},
+                    {'file': 'c.yml', 'enabled': False}]},
+            'shaker': {
+                'enabled': False,
+                'scenarios': [{'file': 'd'}]}}
+        benchs = list(expand_workload(workload, '/workload', reset=True))
+        self.assertEqual([('a.yml', True), ('b.yml', False)],
+                         [(b['file'], b['reset']) for b in benchs])
+
+    def test_dedup(self):
+        workload = {
+            'rally': {
+                'args': {'times': [1, 1]},
+                'scenarios': [{'file': 'a.yml'}, {'file': 'a.yml'}]}}
+        benchs = list(expand_workload(workload, '/workload'))
+        self.assertEqual(1, len(benchs))
+
+    def test_stable_id(self):
+        workload = {'rally': {'args': {'times': [1, 2]},
+                              'scenarios': [{'file': 'a.yml'}]}}
+        ids = [b['id'] for b in expand_workload(workload, '/workload')]
+        self.assertEqual(
+            ids, [b['id'] for b in expand_workload(workload, '/other')])
+        self.assertEqual(2, len(set(ids)))
+
+
+class TestScheduleBenchs(unittest.TestCase):
+
+    def setUp(self):
+        self.resultdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.resultdir)
+
+    def _index(self):
+        with open(os.path.join(self.resultdir, BENCH_INDEX)) as f:
+            return json.load(f)['benchs']
+
+    def _local_bench(self):
+        """Runs the workers against local bench hosts, for real."""
+        for name, content in [('playbook.yml', PLAYBOOK),
+                              ('ansible.cfg', ''),
+                              ('inventory',
+                               INVENTORY % {'python': sys.executable})]:
+            with open(os.path.join(self.resultdir, name), 'w') as f:
+                f.write(content)
+        patcher = mock.patch("enos.utils.bench.RUN_BENCH",
+                             os.path.join(self.resultdir, 'playbook.yml'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(os.environ, {
+            'ANSIBLE_CONFIG': os.path.join(self.resultdir, 'ansible.cfg')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return os.path.join(self.resultdir, 'inventory')
+
+    def test_sequential(self):
+        inventory = self._local_bench()
+        benchs = [_bench('a'), _bench('b')]
+        records = schedule_benchs(benchs, {}, inventory, self.resultdir)
+        self.assertEqual(['a', 'b'], [r['file'] for r in records])
+        self.assertEqual(['a', 'b'], [r['file'] for r in self._index()])
+        # points target every bench hosts
+        for record in records:
+            self.assertIsNone(record['host'])
+            self.assertEqual(STATUS_OK, record['status'],
+                             record.get('error'))
+        # facts are cached in the resultdir, and not gathered again
+        facts_dir = os.path.join(self.resultdir, BENCH_FACTS)
+        self.assertEqual(['bench-1', 'bench-2'], sorted(os.listdir(facts_dir)))
+        mtime = os.path.getmtime(os.path.join(facts_dir, 'bench-1'))
+        schedule_benchs([_bench('c')], {}, inventory, self.resultdir)
+        self.assertEqual(mtime,
+                         os.path.getmtime(os.path.join(facts_dir, 'bench-1')))
+
+    def test_sequential_stops_on_failure(self):
+        inventory = self._local_bench()
+        benchs = [_bench('boom'), _bench('b')]
+        with self.assertRaises(EnosError):
+            schedule_benchs(benchs, {}, inventory, self.resultdir)
+        index = self._index()
+        self.assertEqual(1, len(index))
+        self.assertEqual(STATUS_FAILED, index[0]['status'])
+
+    def test_resume(self):
+        inventory = self._local_bench()
+        schedule_benchs([_bench('a')], {}, inventory, self.resultdir)
+        self.assertEqual(set([_bench('a')['id']]),
+                         load_bench_journal(self.resultdir))
+        records = schedule_benchs([_bench('a'), _bench('b')], {},
+                                  inventory, self.resultdir, resume=True)
+        self.assertEqual(['b'], [r['file'] for r in records])
+        self.assertEqual(['a', 'b'], [r['file'] for r in self._index()])
+        # starting over resets the journal
+        schedule_benchs([_bench('b')], {}, inventory, self.resultdir)
+        self.assertEqual(set([_bench('b')['id']]),
+                         load_bench_journal(self.resultdir))
+
+    def test_worker_starts_processes(self):
+        # The worker is a child process and Ansible starts a process per
+        # task in it
+        worker = BenchWorker(self._local_bench(), bench_host='bench-1')
+        self.addCleanup(worker.kill)
+        record = worker.run({'bench': _bench('a')})
+        self.assertEqual(STATUS_OK, record['status'], record.get('error'))
+        self.assertEqual('bench-1', record['host'])
+        self.assertEqual(STATUS_FAILED,
+                         worker.run({'bench': _bench('boom')})['status'])
+        worker.stop()
+        self.assertEqual(0, worker.process.returncode)
+
+    def test_parallel(self):
+        inventory = self._local_bench()
+        benchs = [_bench('reset', reset=True)]
+        benchs.extend([_bench(str(i)) for i in range(4)])
+        records = schedule_benchs(benchs, {}, inventory, self.resultdir,
+                                  hosts=['bench-1', 'bench-2'])
+        self.assertEqual(5, len(records))
+        # the reset point runs first, alone and on every bench hosts
+        self.assertEqual('reset', records[0]['file'])
+        self.assertIsNone(records[0]['host'])
+        for record in records[1:]:
+            self.assertIn(record['host'], ['bench-1', 'bench-2'])
+            self.assertEqual(STATUS_OK, record['status'],
+                             record.get('error'))
+        self.assertEqual(set(['bench-1', 'bench-2']),
+                         set(r['host'] for r in records[1:]))
+        self.assertEqual(5, len(self._index()))
+
+    def test_parallel_stops_on_failure(self):
+        inventory = self._local_bench()
+        benchs = [_bench('boom')] + [_bench(str(i)) for i in range(4)]
+        with self.assertRaises(EnosError):
+            schedule_benchs(benchs, {}, inventory, self.resultdir,
+                            hosts=['bench-1'])
+        self.assertEqual(['boom'], [r['file'] for r in self._index()])
+
+    @mock.patch('enos.utils.bench.BenchWorker')
+    def test_parallel_worker_error(self, bench_worker):
+        # e.g. garbage on the output of the worker
+        bench_worker.return_value.run.side_effect = ValueError('No JSON')
+        benchs = [_bench('a'), _bench('b'), _bench('c')]
+        errors = []
+
+        def _schedule():
+            try:
+                schedule_benchs(benchs, {}, 'inventory', self.resultdir,
+                                hosts=['bench-1'])
+            except EnosError as e:
+                errors.append(e)
+        schedule = threading.Thread(target=_schedule)
+        schedule.daemon = True
+        schedule.start()
+        schedule.join(10)
+        self.assertFalse(schedule.is_alive())
+        self.assertEqual(1, len(errors))
+        index = self._index()
+        self.assertEqual(['a'], [r['file'] for r in index])
+        self.assertEqual(STATUS_FAILED, index[0]['status'])
+        self.assertEqual('bench-1', index[0]['host'])
+        self.assertIn('No JSON', index[0]['error'])
+
+if __name__ == '__main__':
+    unittest.main()
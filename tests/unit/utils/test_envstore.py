@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+from enoslib.host import Host
+
+from enos.utils.envstore import *
+
+
+class TestEnvStore(unittest.TestCase):
+
+    def setUp(self):
+        self.resultdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.resultdir)
+        host = Host('10.0.0.1', alias='node-1', user='root',
+                    extra={'network_interface': 'eth0'})
+        self.env = {
+            'resultdir': self.resultdir,
+            'config': {'vip': '10.0.0.250', 'kolla': {'a': [1, 2]}},
+            'rsc': {'control': [host], 'network': [host]},
+            'networks': [{'cidr': '10.0.0.0/24', 'roles': ['network']}],
+            'versions': (1, 2)
+        }
+
+    def test_save_load(self):
+        save_env(self.env)
+        env = load_env(self.resultdir)
+        self.assertEqual(sorted(self.env), sorted(env))
+        self.assertEqual(self.env['config'], env['config'])
+        self.assertEqual(self.env['networks'], env['networks'])
+        self.assertEqual((1, 2), env['versions'])
+        host = env['rsc']['control'][0]
+        self.assertIsInstance(host, Host)
+        self.assertEqual(('10.0.0.1', 'node-1', 'root', None, None,
+                          {'network_interface': 'eth0'}),
+                         tuple(getattr(host, f) for f in HOST_FIELDS))
+        # Hosts are shared as before saving
+        self.assertIs(host, env['rsc']['network'][0])
+        self.assertEqual([ENV_FILE], os.listdir(self.resultdir))
+
+    def test_partial_load(self):
+        save_env(self.env)
+        env = load_env(self.resultdir, keys=['config'])
+        self.assertEqual({'config': self.env['config']}, env)
+
+    def test_other_objects(self):
+        self.env['date'] = set([1])
+        save_env(self.env)
+        self.assertEqual(set([1]), load_env(self.resultdir)['date'])
+
+    def test_legacy_env(self):
+        with open(os.path.join(self.resultdir, ENV_FILE), 'w') as f:
+            yaml.dump(self.env, f)
+        env = load_env(self.resultdir)
+        self.assertEqual('10.0.0.1', env['rsc']['control'][0].address)
+
+    def test_newer_env(self):
+        with open(os.path.join(self.resultdir, ENV_FILE), 'w') as f:
+            f.write(HEADER % (ENV_VERSION + 1))
+        with self.assertRaises(Exception):
+            load_env(self.resultdir)
+
+    def test_make_env_reloads_config(self):
+        config_file = os.path.join(self.resultdir, 'reservation.yaml')
+        with open(config_file, 'w') as f:
+            yaml.dump({'vip': '10.0.0.251'}, f)
+        self.env['config_file'] = config_file
+        save_env(self.env)
+        env = make_env(self.resultdir, keys=['config'])
+        self.assertEqual('10.0.0.251', env['config']['vip'])
+        self.assertNotIn('rsc', env)
@@ -7,6 +7,7 @@ import copy
 import contextlib
 import os, shutil
 import tempfile
+import yaml
 import mock
 import ddt
 
@@ -186,6 +187,110 @@ class TestPathLoading(unittest.TestCase):
                 seekpath(unexisting)
 
 
+class TestKollaDefaults(unittest.TestCase):
+
+    def setUp(self):
+        self.resultdir = tempfile.mkdtemp()
+        self.kolla = os.path.join(self.resultdir, 'kolla')
+        os.makedirs(os.path.join(self.kolla, 'ansible', 'group_vars'))
+        self.write_defaults('a: 1\nb: [1, 2]\n')
+        self.env = {
+            'resultdir': self.resultdir,
+            'cwd': self.resultdir,
+            'config': {
+                'vip': '10.0.0.1',
+                'influx_vip': '10.0.0.2',
+                'kolla_ref': 'stable/queens',
+                'kolla': {'b': 3},
+                'network_interface': 'eth0'
+            }
+        }
+        self.addCleanup(shutil.rmtree, self.resultdir)
+        self.addCleanup(mock.patch.stopall)
+        mock.patch.dict('enos.utils.extra._KOLLA_DEFAULTS', clear=True).start()
+        mock.patch.dict('enos.utils.extra._ENOS_VALUES', clear=True).start()
+
+    def write_defaults(self, content):
+        path = os.path.join(self.kolla, 'ansible', 'group_vars', 'all.yml')
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_load_kolla_defaults_parsed_once(self):
+        with mock.patch('enos.utils.extra.yaml.load',
+                        side_effect=yaml.load) as load:
+            values = load_kolla_defaults(self.kolla, self.resultdir)
+            self.assertEqual({'a': 1, 'b': [1, 2]}, values)
+            self.assertEqual(values,
+                             load_kolla_defaults(self.kolla, self.resultdir))
+            self.assertEqual(1, load.call_count)
+
+    def test_load_kolla_defaults_snapshot(self):
+        load_kolla_defaults(self.kolla, self.resultdir)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.resultdir, KOLLA_DEFAULTS_SNAPSHOT)))
+        # A new process only has the snapshot
+        with mock.patch.dict('enos.utils.extra._KOLLA_DEFAULTS', clear=True):
+            with mock.patch('enos.utils.extra.yaml.load') as load:
+                self.assertEqual({'a': 1, 'b': [1, 2]},
+                                 load_kolla_defaults(self.kolla,
+                                                     self.resultdir))
+                load.assert_not_called()
+
+    def test_load_kolla_defaults_same_content(self):
+        load_kolla_defaults(self.kolla, self.resultdir)
+        path = self.write_defaults('a: 1\nb: [1, 2]\n')
+        os.utime(path, (0, 0))
+        with mock.patch('enos.utils.extra.yaml.load') as load:
+            load_kolla_defaults(self.kolla, self.resultdir)
+            load.assert_not_called()
+
+    def test_load_kolla_defaults_changed(self):
+        load_kolla_defaults(self.kolla, self.resultdir)
+        path = self.write_defaults('a: 2\n')
+        os.utime(path, (0, 0))
+        self.assertEqual({'a': 2},
+                         load_kolla_defaults(self.kolla, self.resultdir))
+
+    def test_mk_enos_values(self):
+        values = mk_enos_values(self.env)
+        self.assertEqual(1, values['a'])
+        self.assertEqual(3, values['b'])
+        self.assertEqual('10.0.0.1', values['kolla_internal_vip_address'])
+        self.assertEqual(self.resultdir, values['cwd'])
+        self.assertNotIn('network_interface', values)
+        self.assertNotIn('kolla', values)
+
+    def test_mk_enos_values_memoized(self):
+        values = mk_enos_values(self.env)
+        values.update(bench='mutated')
+        with mock.patch('enos.utils.extra.mk_kolla_values') as mk:
+            self.assertNotIn('bench', mk_enos_values(self.env))
+            mk.assert_not_called()
+
+    def test_mk_enos_values_snapshot(self):
+        values = mk_enos_values(self.env)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.resultdir, ENOS_VALUES_SNAPSHOT)))
+        # A new process (e.g. the next phase) only has the snapshot
+        with mock.patch.dict('enos.utils.extra._ENOS_VALUES', clear=True):
+            with mock.patch('enos.utils.extra.mk_kolla_values') as mk:
+                self.assertEqual(values, mk_enos_values(self.env))
+                mk.assert_not_called()
+
+    def test_mk_enos_values_config_changed(self):
+        mk_enos_values(self.env)
+        self.env['config']['kolla']['b'] = 4
+        self.assertEqual(4, mk_enos_values(self.env)['b'])
+
+    def test_bootstrap_digest(self):
+        digest = bootstrap_digest(self.env, 'a' * 40)
+        self.assertEqual(digest, bootstrap_digest(self.env, 'a' * 40))
+        self.assertNotEqual(digest, bootstrap_digest(self.env, 'b' * 40))
+        self.env['config']['kolla']['b'] = 4
+        self.assertNotEqual(digest, bootstrap_digest(self.env, 'a' * 40))
+
+
 @contextlib.contextmanager
 def working_directory(path):
     """A context manager which changes the working directory to the given
@@ -0,0 +1,68 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from enos.utils.constants import ANSIBLE_DIR
+from enos.utils.fingerprint import *
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.inventory = os.path.join(self.tmp, 'multinode')
+        with open(self.inventory, 'w') as f:
+            f.write('[control]\n10.0.0.1\n')
+        self.playbook = os.path.join(ANSIBLE_DIR, 'up.yml')
+        self.config = {'registry': {'type': 'none'},
+                       'enable_monitoring': True,
+                       'unrelated_key': 1}
+
+    def fingerprint(self, role='registry'):
+        return role_fingerprint(role, self.playbook, self.inventory,
+                                self.config)
+
+    def test_same_inputs(self):
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+        self.assertNotEqual(self.fingerprint(), self.fingerprint('common'))
+
+    def test_config_subset(self):
+        fingerprint = self.fingerprint()
+        self.config['unrelated_key'] = 2
+        self.assertEqual(fingerprint, self.fingerprint())
+        self.config['registry'] = {'type': 'internal'}
+        self.assertNotEqual(fingerprint, self.fingerprint())
+
+    def test_inventory(self):
+        fingerprint = self.fingerprint()
+        with open(self.inventory, 'a') as f:
+            f.write('10.0.0.2\n')
+        self.assertNotEqual(fingerprint, self.fingerprint())
+
+    def test_boot_ids(self):
+        fingerprint = role_fingerprint('registry', self.playbook,
+                                       self.inventory, self.config,
+                                       boot_ids={'10.0.0.1': 'a'})
+        self.assertNotEqual(fingerprint, self.fingerprint())
+        # e.g. the node has been deployed again
+        self.assertNotEqual(fingerprint, role_fingerprint(
+            'registry', self.playbook, self.inventory, self.config,
+            boot_ids={'10.0.0.1': 'b'}))
+
+    def test_local_boot_ids(self):
+        inventory = os.path.join(self.tmp, 'local')
+        with open(inventory, 'w') as f:
+            f.write('local-1 ansible_connection=local '
+                    'ansible_python_interpreter=%s\n' % sys.executable)
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            self.assertEqual({'local-1': f.read().strip()},
+                             boot_ids(inventory))
+
+    def test_outdated_roles(self):
+        fingerprints = dict((r, self.fingerprint(r)) for r in UP_ROLES)
+        self.assertEqual(UP_ROLES, outdated_roles({}, fingerprints))
+        env = {UP_FINGERPRINTS: dict(fingerprints, influx='old')}
+        self.assertEqual(['influx'], outdated_roles(env, fingerprints))
@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+import mock
+import unittest
+from collections import OrderedDict
+
+from enoslib.api import _generate_inventory_string
+from enoslib.host import Host
+
+from enos.utils.constants import INVENTORY_DIR
+from enos.utils.extra import KOLLA_MANDATORY_GROUPS
+from enos.utils.inventory import *
+
+BASE_INVENTORY = os.path.join(INVENTORY_DIR, 'inventory.sample')
+
+
+def _roles():
+    control = Host('10.0.0.1', alias='node-1', user='root',
+                   extra={'network_interface': 'eth0',
+                          'enos_devices': ['eth0', 'eth1']})
+    compute = Host('10.0.0.2', alias='node-2', port=2222,
+                   extra={'gateway': 'access.grid5000.fr'})
+    return {'control': [control], 'compute': [compute],
+            'network': [control]}
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_host_line_as_enoslib(self):
+        for hosts in _roles().values():
+            for host in hosts:
+                line = host_line(host)
+                # Extra vars are sorted
+                host.extra = OrderedDict(sorted(host.extra.items()))
+                self.assertEqual(_generate_inventory_string(host), line)
+
+    def test_deterministic(self):
+        roles = _roles()
+        ini = inventory_ini(roles, BASE_INVENTORY, KOLLA_MANDATORY_GROUPS)
+        roles['control'][0].extra = dict(
+            reversed(list(roles['control'][0].extra.items())))
+        self.assertEqual(ini, inventory_ini(dict(reversed(list(
+            roles.items()))), BASE_INVENTORY, KOLLA_MANDATORY_GROUPS))
+        self.assertIn('[storage]\n', ini)
+
+    def test_inventory_dict(self):
+        inventory = inventory_dict(_roles(), BASE_INVENTORY,
+                                   KOLLA_MANDATORY_GROUPS)
+        self.assertEqual(['node-1'], inventory['control']['hosts'])
+        self.assertEqual({}, inventory['storage'])
+        self.assertEqual(['control'], inventory['disco/registry']['children'])
+        self.assertIn('compute', inventory['external-compute']['children'])
+        hostvars = inventory['_meta']['hostvars']
+        self.assertEqual('10.0.0.1', hostvars['node-1']['ansible_host'])
+        self.assertEqual(['eth0', 'eth1'], hostvars['node-1']['enos_devices'])
+        self.assertNotIn('gateway', hostvars['node-2'])
+
+    def test_same_groups_as_ini(self):
+        from ansible.inventory.manager import InventoryManager
+        from ansible.parsing.dataloader import DataLoader
+        dest = os.path.join(self.tmp, 'multinode')
+        write_inventory(_roles(), BASE_INVENTORY, KOLLA_MANDATORY_GROUPS,
+                        dest)
+        ini = InventoryManager(loader=DataLoader(), sources=dest)
+        with open(INVENTORY_JSON % dest) as f:
+            inventory = json.load(f)
+        for name, group in ini.groups.items():
+            if name in ['all', 'ungrouped']:
+                continue
+            self.assertEqual(sorted(h.name for h in group.hosts),
+                             sorted(inventory[name].get('hosts', [])))
+            self.assertEqual(sorted(c.name for c in group.child_groups),
+                             sorted(inventory[name].get('children', [])))
+
+    def test_write_inventory(self):
+        dest = os.path.join(self.tmp, 'multinode')
+        digest = write_inventory(_roles(), BASE_INVENTORY,
+                                 KOLLA_MANDATORY_GROUPS, dest)
+        with open(INVENTORY_JSON % dest) as f:
+            self.assertIn('_meta', json.load(f))
+        os.utime(dest, (0, 0))
+        self.assertEqual(digest, write_inventory(_roles(), BASE_INVENTORY,
+                                                 KOLLA_MANDATORY_GROUPS,
+                                                 dest))
+        # Not written again
+        self.assertEqual(0, os.path.getmtime(dest))
+
+    def test_dynamic_inventory_cache(self):
+        from enos.utils.envstore import save_env
+        env = {'resultdir': self.tmp, 'rsc': _roles()}
+        save_env(env)
+        inventory = dynamic_inventory(self.tmp, BASE_INVENTORY,
+                                      KOLLA_MANDATORY_GROUPS)
+        self.assertEqual(['node-1'], json.loads(inventory)['control']['hosts'])
+        # Hit: the env is not read again
+        with mock.patch('enos.utils.inventory.load_env') as load_env:
+            self.assertEqual(inventory, dynamic_inventory(
+                self.tmp, BASE_INVENTORY, KOLLA_MANDATORY_GROUPS))
+            load_env.assert_not_called()
+        # Miss: the env changed
+        env['rsc']['control'] = env['rsc']['compute']
+        save_env(env)
+        inventory = dynamic_inventory(self.tmp, BASE_INVENTORY,
+                                      KOLLA_MANDATORY_GROUPS)
+        self.assertEqual(['node-2'], json.loads(inventory)['control']['hosts'])
@@ -0,0 +1,65 @@
+import unittest
+
+from enos.utils.ippool import *
+
+
+def _network(**kwargs):
+    network = {'cidr': '10.0.0.0/16',
+               'start': '10.0.0.10',
+               'end': '10.0.255.250'}
+    network.update(kwargs)
+    return network
+
+
+class TestIPPool(unittest.TestCase):
+
+    def test_order(self):
+        network = _network(extra_ips=['10.1.0.1', '10.1.0.2'])
+        pool = get_ip_pool({}, network)
+        self.assertEqual(['10.1.0.2', '10.1.0.1', '10.0.255.250',
+                          '10.0.255.249'],
+                         [pool.allocate(str(i)) for i in range(4)])
+        # the range of the network excludes the allocated ips
+        self.assertEqual('10.0.255.248', network['end'])
+
+    def test_named(self):
+        pool = get_ip_pool({}, _network())
+        vip = pool.allocate('vip')
+        self.assertEqual(vip, pool.allocate('vip'))
+        self.assertNotEqual(vip, pool.allocate('influx_vip'))
+
+    def test_reserve_and_release(self):
+        pool = get_ip_pool({}, _network())
+        pool.reserve('10.0.255.250', 'gateway')
+        self.assertEqual('10.0.255.249', pool.allocate('vip'))
+        pool.release('vip')
+        self.assertEqual('10.0.255.249', pool.allocate('registry_vip'))
+        self.assertEqual('10.0.255.248', pool.allocate('vip'))
+
+    def test_exhausted(self):
+        network = _network(start='10.0.0.1', end='10.0.0.3')
+        pool = get_ip_pool({}, network)
+        self.assertEqual('10.0.0.3', pool.allocate('a'))
+        self.assertEqual('10.0.0.2', pool.allocate('b'))
+        # start is never allocated, the range keeps at least one ip
+        with self.assertRaises(Exception):
+            pool.allocate('c')
+        self.assertEqual('10.0.0.1', network['end'])
+
+    def test_persisted_in_env(self):
+        env = {}
+        vip = get_ip_pool(env, _network()).allocate('vip')
+        get_ip_pool(env, _network()).allocate('influx_vip')
+        self.assertIn(IP_POOLS, env)
+        # an other run with a fresh network gives the same ips
+        network = _network()
+        pool = get_ip_pool(env, network)
+        self.assertEqual(vip, pool.allocate('vip'))
+        self.assertEqual('10.0.255.248', network['end'])
+        # the pool is reset when the network changes
+        pool = get_ip_pool(env, _network(start='10.0.1.0'))
+        self.assertEqual('10.0.255.250', pool.allocate('vip'))
+
+
+if __name__ == '__main__':
+    unittest.main()
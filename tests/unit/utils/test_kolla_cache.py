@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from subprocess import check_call, check_output
+
+import mock
+
+from enos.utils.kolla_cache import *
+
+
+def _git(repo, *args):
+    return check_output(['git', '-C', repo] + list(args)).decode().strip()
+
+
+def _commit(repo, content):
+    with open(os.path.join(repo, 'README'), 'w') as f:
+        f.write(content)
+    _git(repo, 'add', 'README')
+    _git(repo, '-c', 'user.name=enos', '-c', 'user.email=enos@localhost',
+         'commit', '--quiet', '-m', content)
+    return _git(repo, 'rev-parse', 'HEAD')
+
+
+@unittest.skipIf(find_executable('git') is None, "git is not installed")
+class TestKollaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.repo = os.path.join(self.tmp, 'kolla-ansible')
+        check_call(['git', 'init', '--quiet', self.repo])
+        _git(self.repo, 'checkout', '--quiet', '-b', 'stable/queens')
+        self.head = _commit(self.repo, 'queens')
+        self.cache = KollaCache(path=os.path.join(self.tmp, 'cache'))
+
+    def test_checkout(self):
+        dest = os.path.join(self.tmp, 'kolla')
+        self.cache.checkout(self.repo, 'stable/queens', dest)
+        self.assertEqual(self.head, _git(dest, 'rev-parse', 'HEAD'))
+        self.assertEqual(self.repo, _git(dest, 'remote', 'get-url', 'origin'))
+        self.assertTrue(os.path.isdir(self.cache.mirror_path(self.repo)))
+
+    def test_mirror_offline(self):
+        mirror = self.cache.mirror(self.repo, 'stable/queens')
+        shutil.rmtree(self.repo)
+        # The mirror is stale but has the ref
+        self.cache.ttl = -1
+        self.assertEqual(mirror, self.cache.mirror(self.repo,
+                                                   'stable/queens'))
+
+    def test_mirror_fetch_missing_ref(self):
+        self.cache.mirror(self.repo, 'stable/queens')
+        _git(self.repo, 'checkout', '--quiet', '-b', 'stable/rocky')
+        head = _commit(self.repo, 'rocky')
+        dest = os.path.join(self.tmp, 'kolla')
+        self.cache.checkout(self.repo, 'stable/rocky', dest)
+        self.assertEqual(head, _git(dest, 'rev-parse', 'HEAD'))
+
+    def test_update(self):
+        dest = os.path.join(self.tmp, 'kolla')
+        self.cache.checkout(self.repo, 'stable/queens', dest)
+        self.assertFalse(self.cache.update(self.repo, 'stable/queens', dest))
+        head = _commit(self.repo, 'queens.1')
+        self.cache.ttl = -1
+        self.assertTrue(self.cache.update(self.repo, 'stable/queens', dest))
+        self.assertEqual(head, head_commit(dest))
+        self.assertEqual('stable/queens', _git(dest, 'rev-parse',
+                                               '--abbrev-ref', 'HEAD'))
+
+    def test_update_tag(self):
+        dest = os.path.join(self.tmp, 'kolla')
+        self.cache.checkout(self.repo, 'stable/queens', dest)
+        _commit(self.repo, '6.0.0')
+        _git(self.repo, 'tag', '6.0.0')
+        _commit(self.repo, 'queens.1')
+        self.assertTrue(self.cache.update(self.repo, '6.0.0', dest))
+        self.assertEqual(_git(self.repo, 'rev-parse', '6.0.0'),
+                         head_commit(dest))
+
+    def test_reset_checkout(self):
+        dest = os.path.join(self.tmp, 'kolla')
+        self.cache.checkout(self.repo, 'stable/queens', dest)
+        # e.g. patches
+        with open(os.path.join(dest, 'README'), 'w') as f:
+            f.write('patched')
+        open(os.path.join(dest, 'new'), 'w').close()
+        reset_checkout(dest)
+        with open(os.path.join(dest, 'README')) as f:
+            self.assertEqual('queens', f.read())
+        self.assertFalse(os.path.exists(os.path.join(dest, 'new')))
+
+    @mock.patch('enos.utils.kolla_cache.check_call_in_venv')
+    def test_venv_built_once(self, check_call_in_venv):
+        venv = self.cache.venv(self.repo, self.head)
+        self.assertEqual(2, check_call_in_venv.call_count)
+        self.assertEqual(venv, self.cache.venv(self.repo, self.head))
+        self.assertEqual(2, check_call_in_venv.call_count)
+        # A moved branch gets its own virtualenv
+        head = _commit(self.repo, 'queens.1')
+        self.cache.ttl = -1
+        self.assertNotEqual(venv, self.cache.venv(self.repo, head))
+
+    @mock.patch('enos.utils.kolla_cache.check_call_in_venv')
+    def test_venv_pristine_sources(self, check_call_in_venv):
+        dest = os.path.join(self.tmp, 'kolla')
+        self.cache.checkout(self.repo, 'stable/queens', dest)
+        # e.g. patches of the env
+        with open(os.path.join(dest, 'README'), 'w') as f:
+            f.write('patched')
+        sources = []
+
+        def pip(venv, command):
+            if command.startswith('pip wheel'):
+                with open(os.path.join(command.split()[5], 'README')) as f:
+                    sources.append(f.read())
+        check_call_in_venv.side_effect = pip
+
+        self.cache.venv(self.repo, head_commit(dest))
+        self.assertEqual(['queens'], sources)
+
+    def test_link_venv(self):
+        link = os.path.join(self.tmp, 'venv_kolla')
+        self.assertTrue(link_venv('/cache/a', link))
+        self.assertTrue(link_venv('/cache/b', link))
+        self.assertEqual('/cache/b', os.readlink(link))
+        os.remove(link)
+        os.mkdir(link)
+        self.assertFalse(link_venv('/cache/b', link))
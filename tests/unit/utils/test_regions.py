@@ -0,0 +1,74 @@
+import unittest
+
+import mock
+
+from enoslib.host import Host
+
+from enos.utils.regions import *
+
+CONFIG = {
+    'provider': {'type': 'g5k', 'job_name': 'enos'},
+    'kolla_ref': 'stable/queens',
+    'regions': [
+        {'name': 'RegionOne',
+         'provider': {'job_name': 'enos-one'},
+         'resources': {'paravance': {'control': 1, 'compute': 1}}},
+        {'name': 'RegionTwo',
+         'provider': 'static',
+         'resources': {'grisou': {'control': 1}}}]
+}
+
+
+def _init(config, force):
+    cluster = list(config['resources'])[0]
+    control = Host('%s-1' % cluster)
+    rsc = {'control': [control], 'compute': [control]}
+    networks = [{'cidr': '10.0.0.0/24', 'roles': ['network_interface']},
+                {'cidr': '10.%s.0.0/24' % len(cluster),
+                 'roles': ['neutron_external_interface']}]
+    return rsc, networks
+
+
+class TestRegions(unittest.TestCase):
+
+    def test_region_configs(self):
+        configs = dict(region_configs(CONFIG))
+        self.assertEqual(['RegionOne', 'RegionTwo'], sorted(configs))
+        one = configs['RegionOne']
+        self.assertEqual({'type': 'g5k', 'job_name': 'enos-one'},
+                         one['provider'])
+        self.assertEqual('stable/queens', one['kolla_ref'])
+        self.assertNotIn('regions', one)
+        self.assertEqual('static', configs['RegionTwo']['provider'])
+        # the configuration is left untouched
+        self.assertEqual('enos', CONFIG['provider']['job_name'])
+
+    @mock.patch('enos.utils.regions.make_provider')
+    def test_init_regions(self, mock_make_provider):
+        provider = mock_make_provider.return_value
+        provider.default_config.return_value = {'walltime': '02:00:00'}
+        provider.init.side_effect = _init
+        regions = init_regions(CONFIG, force=True)
+        self.assertEqual(['RegionOne', 'RegionTwo'],
+                         [r[0] for r in regions])
+        self.assertEqual('02:00:00', regions[0][1]['provider']['walltime'])
+        self.assertEqual('grisou-1',
+                         regions[1][2]['control'][0].address)
+
+    def test_merge_regions(self):
+        regions = []
+        for name, config in region_configs(CONFIG):
+            rsc, networks = _init(config, False)
+            regions.append((name, config, rsc, networks))
+        roles, networks = merge_regions(regions)
+        self.assertEqual(['paravance-1', 'grisou-1'],
+                         [h.address for h in roles['control']])
+        self.assertEqual(['paravance-1'],
+                         [h.address for h in roles['RegionOne']])
+        # the network shared by the regions is merged
+        self.assertEqual(3, len(networks))
+        self.assertIs(regions[0][3][0], regions[1][3][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+from distutils.spawn import find_executable
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from enos.utils.results import *
+
+UUID1 = '11111111-2222-3333-4444-555555555555'
+UUID2 = '66666666-7777-8888-9999-000000000000'
+
+
+def _report(durations, errors=0):
+    data = [{'timestamp': i, 'duration': d, 'idle_duration': 0,
+             'error': []} for i, d in enumerate(durations)]
+    data.extend([{'timestamp': 0, 'duration': 0.1, 'idle_duration': 0,
+                  'error': ['boom']}] * errors)
+    return {'info': {},
+            'tasks': [{'subtasks': [{'workloads': [{
+                'name': 'NovaServers.boot_and_list_server',
+                'data': data}]}]}]}
+
+
+def _legacy_report(durations):
+    return [{'key': {'name': 'NovaServers.boot_and_list_server'},
+             'result': [{'duration': d, 'error': []} for d in durations]}]
+
+
+class TestResults(unittest.TestCase):
+
+    def setUp(self):
+        self.backup_dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.backup_dir, RESULTS_DB)
+
+    def tearDown(self):
+        shutil.rmtree(self.backup_dir)
+
+    def _tarball(self, host, files):
+        path = os.path.join(self.backup_dir, '%s-rally.tar.gz' % host)
+        with tarfile.open(path, 'w:gz') as tar:
+            for name, content in files:
+                data = json.dumps(content).encode()
+                info = tarfile.TarInfo('root/rally_home/%s' % name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return path
+
+    def test_index_and_query(self):
+        self._tarball('bench-1', [
+            ('report-a.yml-%s.json' % UUID1, _report([1, 2, 3, 4, 5], 1)),
+            ('args-a.yml-%s.json' % UUID1, {'times': 5}),
+            ('report-a.yml-%s.json' % UUID2, _legacy_report([10, 20])),
+            ('args-a.yml-%s.json' % UUID2, {'times': 2}),
+            ('rally.db', {})])
+        self.assertEqual(2, index_results(self.db, self.backup_dir))
+        # unchanged tarballs are not indexed again
+        self.assertEqual(0, index_results(self.db, self.backup_dir))
+
+        rows = query_results(self.db)
+        self.assertEqual(2, len(rows))
+        rows = dict((r['args']['times'], r) for r in rows)
+        self.assertEqual('a.yml', rows[5]['scenario'])
+        self.assertEqual(6, rows[5]['iterations'])
+        self.assertEqual(1, rows[5]['errors'])
+        self.assertEqual(3, rows[5]['p50'])
+        self.assertAlmostEqual(4.8, rows[5]['p95'])
+        self.assertEqual(15, rows[2]['p50'])
+        self.assertEqual([], query_results(self.db, scenario='b.yml'))
+
+    @unittest.skipUnless(find_executable('zstd'), 'zstd is not installed')
+    def test_index_zstd(self):
+        path = self._tarball('bench-1', [
+            ('report-a.yml-%s.json' % UUID1, _report([1, 2]))])
+        with open(path, 'rb') as f:
+            tar = subprocess.Popen(['gzip', '-d', '-c'], stdin=f,
+                                   stdout=subprocess.PIPE).communicate()[0]
+        os.remove(path)
+        zst = os.path.join(self.backup_dir, 'bench-1-rally.tar.zst')
+        with open(zst, 'wb') as f:
+            p = subprocess.Popen(['zstd', '-q', '-c'], stdin=subprocess.PIPE,
+                                 stdout=f)
+            p.communicate(tar)
+        self.assertEqual(1, index_results(self.db, self.backup_dir))
+        self.assertEqual(2, query_results(self.db)[0]['iterations'])
+
+    def test_reindex_changed_tarball(self):
+        path = self._tarball('bench-1', [
+            ('report-a.yml-%s.json' % UUID1, _report([1]))])
+        index_results(self.db, self.backup_dir)
+        self._tarball('bench-1', [
+            ('report-a.yml-%s.json' % UUID1, _report([1, 2, 3]))])
+        os.utime(path, (0, 0))
+        self.assertEqual(1, index_results(self.db, self.backup_dir))
+        rows = query_results(self.db)
+        self.assertEqual(1, len(rows))
+        self.assertEqual(3, rows[0]['iterations'])
+
+    def _snapshot(self, host, snapshot, files):
+        from enos.utils.backup import MIRROR_DIR, promote_snapshot
+        mirror_dir = os.path.join(self.backup_dir, MIRROR_DIR)
+        rally_dir = os.path.join(mirror_dir, host, snapshot, 'rally')
+        os.makedirs(rally_dir)
+        for name, content in files:
+            with open(os.path.join(rally_dir, name), 'w') as f:
+                json.dump(content, f)
+        promote_snapshot(mirror_dir, snapshot)
+
+    def test_index_incremental_backup(self):
+        self._snapshot('bench-1', 's1', [
+            ('report-a.yml-%s.json' % UUID1, _report([1])),
+            ('args-a.yml-%s.json' % UUID1, {'times': 1})])
+        self.assertEqual(1, index_results(self.db, self.backup_dir))
+        self.assertEqual(0, index_results(self.db, self.backup_dir))
+        # only the last snapshot of a host is indexed
+        self._snapshot('bench-1', 's2', [
+            ('report-a.yml-%s.json' % UUID1, _report([1, 2, 3])),
+            ('args-a.yml-%s.json' % UUID1, {'times': 3})])
+        self.assertEqual(1, index_results(self.db, self.backup_dir))
+        rows = query_results(self.db)
+        self.assertEqual(1, len(rows))
+        self.assertEqual({'times': 3}, rows[0]['args'])
+        self.assertEqual(3, rows[0]['iterations'])
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(1, percentile([1], 99))
+        self.assertEqual(2.5, percentile([1, 2, 3, 4], 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import re
+import unittest
+
+# enoslib is the reference of the compiled constraints
+from enoslib.api import _build_grp_constraints, _build_ip_constraints
+from enoslib.host import Host
+
+from enos.utils.tc import *
+
+CONSTRAINTS = {
+    'default_delay': '25ms',
+    'default_rate': '100mbit',
+    'default_loss': '0.1%',
+    'constraints': [{
+        'src': 'grp1',
+        'dst': 'grp[2-3]',
+        'delay': '10ms',
+        'rate': '1gbit',
+        'loss': 0,
+        'symetric': True
+    }]
+}
+
+FILTER = re.compile(r'ht 2:[0-9a-f]+: match ip dst ([0-9.]+)/32 flowid (\S+)')
+CLASS = re.compile(r'parent 1:(\S+) handle \S+ netem delay (\S+)')
+
+
+def _hosts(n, offset):
+    return [Host('10.0.0.%s' % (offset + i), alias='node-%s' % (offset + i),
+                 extra={'network_interface': 'eth0'}) for i in range(n)]
+
+
+def _roles():
+    return {'grp1': _hosts(2, 1), 'grp2': _hosts(3, 3),
+            'grp3': _hosts(3, 6)}
+
+
+def _ips(roles):
+    ips = {}
+    for host in (h for hs in roles.values() for h in hs):
+        ips[host.alias] = {
+            'all_ipv4_addresses': [host.address, '172.17.0.1'],
+            'devices': [
+                {'device': 'eth0', 'active': True, 'type': 'ether'},
+                {'device': 'lo', 'active': True, 'type': 'loopback'}
+            ]
+        }
+    return ips
+
+
+def _delays(device_rules):
+    """Returns the delay of each destination of the rules."""
+    delays = dict(CLASS.search(r).groups() for r in device_rules
+                  if 'netem' in r)
+    return dict((ip, delays[flowid.split(':')[1]])
+                for ip, flowid in (FILTER.search(r).groups()
+                                   for r in device_rules if 'ht 2:' in r))
+
+
+class TestTc(unittest.TestCase):
+
+    def test_group_constraints_same_as_enoslib(self):
+        roles = _roles()
+        roles['grp4'] = _hosts(1, 20)
+        for network_constraints in [
+                CONSTRAINTS,
+                {'default_delay': '20ms', 'default_rate': '1gbit'},
+                dict(CONSTRAINTS, groups=['grp[1-3]'], **{'except': ['grp2']}),
+                {'default_delay': '20ms', 'default_rate': '1gbit',
+                 'constraints': [{'src': 'grp1', 'dst': 'grp1',
+                                  'delay': '1ms', 'rate': '1gbit'},
+                                 {'src': 'grp[1-2]', 'dst': 'grp4',
+                                  'delay': '5ms', 'rate': '1gbit',
+                                  'loss': '1%'}]}]:
+            self.assertEqual(
+                _build_grp_constraints(roles, network_constraints),
+                group_constraints(roles, network_constraints))
+
+    def test_host_index(self):
+        aliases, masks = host_index(_roles())
+        self.assertEqual('node-1', aliases[0])
+        self.assertEqual(0b11, masks['grp1'])
+        self.assertEqual(6, bin(masks['grp2'] | masks['grp3']).count('1'))
+
+    def test_same_as_enoslib(self):
+        roles = _roles()
+        ips = _ips(roles)
+        constraints = group_constraints(roles, CONSTRAINTS)
+        rules = compile_constraints(roles, ips, constraints)
+
+        for alias, host_ips in _build_ip_constraints(roles, ips,
+                                                     constraints).items():
+            # The first rule of a destination wins
+            expected = {}
+            for c in host_ips.get('tc', []):
+                expected.setdefault(c['target'], c['delay'])
+            self.assertEqual(expected, _delays(rules[alias]['eth0']))
+            self.assertNotIn('lo', rules[alias])
+
+    def test_one_class_per_constraint(self):
+        roles = _roles()
+        roles['grp2'].extend(_hosts(100, 10))
+        rules = compile_constraints(roles, _ips(roles),
+                                    group_constraints(roles,
+                                                           CONSTRAINTS))
+        # grp1->grp2 and grp1->grp3 share a class, whatever the number of
+        # destinations
+        node_rules = rules['node-1']['eth0']
+        self.assertEqual(1, len([r for r in node_rules if 'netem' in r]))
+        self.assertEqual(106, len([r for r in node_rules if 'ht 2:' in r]))
+        netems = [r for r in rules['node-3']['eth0'] if 'netem' in r]
+        self.assertEqual(2, len(netems))
+        self.assertTrue(any(r.endswith('netem delay 25ms loss 0.1%')
+                            for r in netems))
+
+    def test_no_devices(self):
+        roles = _roles()
+        ips = _ips(roles)
+        # e.g. no active ethernet device
+        ips['node-1']['devices'] = None
+        ips['node-2']['devices'] = []
+        rules = compile_constraints(roles, ips,
+                                    group_constraints(roles, CONSTRAINTS))
+        self.assertEqual({}, rules['node-1'])
+        self.assertEqual({}, rules['node-2'])
+
+    def test_disabled(self):
+        roles = _roles()
+        rules = compile_constraints(roles, _ips(roles), [])
+        self.assertEqual({'eth0': []}, rules['node-1'])
+
+    def test_changed_rules(self):
+        roles = _roles()
+        ips = _ips(roles)
+        rules = compile_constraints(roles, ips, group_constraints(
+            roles, CONSTRAINTS))
+        batches = changed_rules(rules, {})
+        self.assertEqual(['eth0'], batches['node-1']['devices'])
+        self.assertEqual(rules['node-1']['eth0'], batches['node-1']['rules'])
+
+        # Only the hosts of grp2 and grp3 see the new default delay
+        constraints = dict(CONSTRAINTS, default_delay='50ms')
+        new_rules = compile_constraints(roles, ips, group_constraints(
+            roles, constraints))
+        batches = changed_rules(new_rules, rules)
+        self.assertEqual([], batches['node-1']['devices'])
+        self.assertEqual([], batches['node-1']['rules'])
+        self.assertEqual(['eth0'], batches['node-3']['devices'])
+
+    def test_installed_rules(self):
+        roles = _roles()
+        ips = _ips(roles)
+        rules = compile_constraints(roles, ips, group_constraints(
+            roles, CONSTRAINTS))
+        for alias in rules:
+            ips[alias]['qdiscs'] = [
+                'qdisc htb 1: dev eth0 root refcnt 2 r2q 10 default 0',
+                'qdisc netem 11: dev eth0 parent 1:1 limit 1000 delay 25.0ms',
+                'qdisc noqueue 0: dev lo root refcnt 2']
+        # e.g. node-1 has been rebooted
+        ips['node-1']['qdiscs'] = ['qdisc noqueue 0: dev lo root refcnt 2']
+        batches = changed_rules(rules, installed_rules(rules, ips))
+        self.assertEqual(['eth0'], batches['node-1']['devices'])
+        self.assertEqual([], batches['node-2']['devices'])
+        # devices without rules must not have any
+        self.assertEqual({}, installed_rules({'node-2': {'eth0': []}},
+                                             ips)['node-2'])